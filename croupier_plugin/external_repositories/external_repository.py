@@ -25,6 +25,7 @@ external_repository.py: Holds the external repository common behaviour
 '''
 
 
+from croupier_plugin.metrics import instrumented
 from croupier_plugin.ssh import SshClient
 
 
@@ -42,6 +43,7 @@ class ExternalRepository(object):
     def __init__(self, publish_item):
         self.er_type = publish_item['dataset']['type']
 
+    @instrumented
     def publish(self,
                 ssh_client,
                 logger,
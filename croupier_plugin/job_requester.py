@@ -25,81 +25,599 @@ job_requester.py: Holds the functions that requests jobs information
 '''
 
 
+import heapq
+import re
+import socket
+import sqlite3
 import time
-from threading import Lock
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
 
 import requests
+from paramiko import ssh_exception
 
+from croupier_plugin.monitor_agent import AGENT_FILE
+from croupier_plugin.ssh import SshClient, SshExecutor
+from croupier_plugin.status_cache import StatusCache
+from croupier_plugin.utilities import shlex_quote
 from croupier_plugin.workload_managers.workload_manager import (
+    COMPLETION_FILE,
     WorkloadManager,
     state_int_to_str)
 
 
+class PollScheduler(object):
+    """
+    Decides when to poll each host again, from the states of its jobs
+
+    Hosts are polled every `period` seconds while the states of their jobs
+    change. The interval doubles while every job stays pending, up to
+    `max_period`, and shrinks to the expected end of the running jobs with
+    a known walltime, down to `min_period`. The next polls are kept in a
+    heap of deadlines, so the earliest one is found without visiting every
+    host.
+    """
+
+    def __init__(self):
+        # host -> last poll, next poll, interval, job states and the times
+        # the jobs were first seen running
+        self._hosts = {}
+        # (next poll, host), entries no longer matching the host are stale
+        self._deadlines = []
+
+    def is_due(self, host, settings, now=None):
+        """ True if the host has to be polled """
+        now = time.time() if now is None else now
+        poll = self._hosts.get(host)
+        if poll is None:
+            return True
+        if set(settings['names']) - set(poll['states']) and \
+                poll['last'] + settings['period'] < poll['next']:
+            # new jobs are polled at the regular period
+            self._schedule(host, poll['last'] + settings['period'])
+        return now >= poll['next']
+
+    def update(self, host, settings, states, now=None):
+        """ Schedules the next poll, after one that got `states` (None if
+        it failed) """
+        now = time.time() if now is None else now
+        period = settings['period']
+        min_period = min(settings.get('min_period', period), period)
+        max_period = max(settings.get('max_period', period), period)
+        poll = self._hosts.setdefault(host, {'interval': period,
+                                             'states': {},
+                                             'started': {}})
+        interval = period
+        if states is not None:
+            current = dict((name, states.get(name))
+                           for name in settings['names'])
+            if current == poll['states'] and \
+                    all(state == 'PENDING' for state in current.values()):
+                interval = poll['interval'] * 2
+
+            walltimes = settings.get('walltimes', {})
+            for name, state in current.iteritems():
+                if state != 'RUNNING':
+                    poll['started'].pop(name, None)
+                    continue
+                started = poll['started'].setdefault(name, now)
+                if walltimes.get(name):
+                    interval = min(interval,
+                                   started + walltimes[name] - now)
+            poll['states'] = current
+
+        poll['interval'] = max(min_period, min(max_period, interval))
+        poll['last'] = now
+        self._schedule(host, now + poll['interval'])
+
+    def forget(self, host):
+        """ Stops scheduling the polls of the host """
+        self._hosts.pop(host, None)
+
+    def next_poll(self, now=None):
+        """ Seconds to the next due poll, None if no host is known """
+        now = time.time() if now is None else now
+        while self._deadlines:
+            deadline, host = self._deadlines[0]
+            poll = self._hosts.get(host)
+            if poll is not None and poll['next'] == deadline:
+                return max(deadline - now, 0)
+            heapq.heappop(self._deadlines)
+        return None
+
+    def reset(self):
+        """ Forgets every host """
+        self._hosts = {}
+        self._deadlines = []
+
+    def _schedule(self, host, deadline):
+        self._hosts[host]['next'] = deadline
+        heapq.heappush(self._deadlines, (deadline, host))
+
+
+class JobEventListener(object):
+    """
+    Follows the completion records that the jobs of a host append to the
+    completion file of its workdir
+
+    The file is followed with `tail -F` over a long-lived channel of its
+    own connection, reopened when it breaks. Workdirs relative to `$HOME`
+    or `~` are resolved on the host first. Records of other jobs, or of
+    previous jobs with the same name but another id, are ignored.
+    """
+    # seconds before the channel is reopened, and between reconnections
+    stream_timeout = 3600
+    retry_delay = 10
+
+    def __init__(self, credentials, workdir, logger):
+        self._credentials = credentials
+        self._workdir = workdir
+        self._logger = logger
+        self._lock = Lock()
+        self._stopped = Event()
+        self._stream = None
+        # (name, job id) -> state of its last record, oldest first
+        self._records = OrderedDict()
+        self._watched = {}
+        self._thread = Thread(target=self._follow)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, names, job_ids=None):
+        """ Sets the jobs to report, with their ids when known """
+        job_ids = job_ids or {}
+        with self._lock:
+            self._watched = dict((name, job_ids.get(name)) for name in names)
+
+    def has_states(self):
+        """ True if some watched job reported its completion """
+        with self._lock:
+            return any(self._matches(key) for key in self._records)
+
+    def pop_states(self):
+        """ States of the watched jobs that reported their completion """
+        states = {}
+        with self._lock:
+            for key in [key for key in self._records if self._matches(key)]:
+                states[key[0]] = self._records.pop(key)
+        return states
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def close(self):
+        self._stopped.set()
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+
+    def _matches(self, key):
+        # must be called holding the lock
+        name, job_id = key
+        if name not in self._watched:
+            return False
+        # several ids are kept separated by spaces
+        return not job_id or not self._watched[name] or \
+            job_id in self._watched[name].split()
+
+    def _command(self, workdir):
+        return "tail -n +1 -F " + shlex_quote(workdir + '/' + COMPLETION_FILE)
+
+    def _follow(self):
+        while not self._stopped.is_set():
+            client = None
+            try:
+                client = SshClient(self._credentials)
+                self._stream = client.stream_shell_command(
+                    self._command(client._resolve_remote_path(self._workdir)),
+                    exec_timeout=self.stream_timeout)
+                if self._stopped.is_set():
+                    continue
+                for line in self._stream:
+                    self._add(line)
+            except (EOFError,
+                    IOError,
+                    socket.error,
+                    ssh_exception.SSHException) as err:
+                if not self._stopped.is_set():
+                    self._logger.warning(
+                        "Cannot follow the completion of the jobs of '" +
+                        self._credentials['host'] + "': " + str(err))
+            finally:
+                if self._stream is not None:
+                    self._stream.close()
+                    self._stream = None
+                if client is not None:
+                    client.close_connection()
+            self._stopped.wait(self.retry_delay)
+
+    def _add(self, line):
+        fields = line.strip().split('|')
+        if len(fields) != 4:
+            return
+        name, job_id, exit_code, _ = fields
+        self._record(name,
+                     job_id,
+                     'COMPLETED' if exit_code == '0' else 'FAILED')
+
+    def _record(self, name, job_id, state):
+        with self._lock:
+            self._records.pop((name, job_id), None)
+            self._records[(name, job_id)] = state
+
+
+class JobAgentListener(JobEventListener):
+    """
+    Follows the states of the jobs of a host, as seen by the monitoring
+    agent running on it
+
+    The agent of the workdir is run in `follow` mode, sharing with every
+    other deployment of the user a single poller of the workload manager,
+    that prints every state change as a "name|job id|state|timestamp" line
+    and a "#" line from time to time.
+    """
+
+    def __init__(self, credentials, workdir, wm_type, period, logger):
+        self._wm_type = wm_type
+        self._period = period
+        super(JobAgentListener, self).__init__(credentials, workdir, logger)
+
+    def _command(self, workdir):
+        return ("cd " + shlex_quote(workdir) + " && " +
+                "\"$(command -v python3 || command -v python)\" " +
+                AGENT_FILE + " follow " + self._wm_type + " " +
+                str(self._period))
+
+    def _add(self, line):
+        fields = line.strip().split('|')
+        if len(fields) != 4:
+            return  # heartbeats
+        name, job_id, state, _ = fields
+        self._record(name, job_id, state)
+
+
+class _HostFuture(object):
+    """
+    Future of the states of one host, out of a batched request
+
+    Cancelling it only stops waiting for the host. The batch is cancelled
+    once every host of the batch gave up on it, so the rest still get their
+    states.
+    """
+
+    def __init__(self, future, host, waiting):
+        self._future = future
+        self._host = host
+        # hosts of the batch still waiting for it, shared by their futures
+        self._waiting = waiting
+
+    def add_done_callback(self, callback):
+        self._future.add_done_callback(lambda _: callback(self))
+
+    def cancel(self):
+        self._waiting.discard(self._host)
+        if self._waiting:
+            return False
+        return self._future.cancel()
+
+    def done(self):
+        return self._future.done()
+
+    def get(self, timeout=None):
+        states = self._future.get(timeout)
+        return None if states is None else states.get(self._host, {})
+
+
+def _promql_regex(values):
+    """ PromQL string of a regex matching any of the values """
+    regex = '|'.join(re.sub(r'([.^$*+?()\[\]{}|\\])', r'\\\1', value)
+                     for value in values)
+    return '"' + regex.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
 class JobRequester(object):
     """ Safely gets the jobs status when requested """
     class __JobRequester(object):
-        _last_time = {}
+        _scheduler = PollScheduler()
+        _running = {}
+        # hosts whose jobs report their completion or are followed by the
+        # monitoring agent -> JobEventListener
+        _listeners = {}
+        # requests that timed out, their states are merged once they arrive
+        _late = {}
         _lock = Lock()
+        # seconds to wait for the states of each host, can be overridden
+        # with the `timeout` of the host settings
+        request_timeout = 60
+        # hosts that timed out in the last request
+        timed_out = []
+        # seconds to wait for Prometheus, whose connections are kept alive
+        # in a session shared by every request
+        prometheus_timeout = 30
+        _session = None
+        # StatusCache shared with the other executions, if any
+        status_cache = None
 
         def request(self, monitor_jobs, logger):
             """ Retrieves the status of every job"""
             states = {}
+            # states reported by the jobs, newer than the polled ones
+            event_states = {}
+
+            # jobs that report their completion, or whose states are
+            # followed through the agent, are only polled to reconcile
+            # their states, every max period
+            for host in self._listeners.keys():
+                if self._listener_class(monitor_jobs.get(host, {})) is not \
+                        self._listeners[host].__class__:
+                    self._listeners.pop(host).close()
+            monitor_jobs = dict(monitor_jobs)
+            for host, settings in monitor_jobs.iteritems():
+                listener_class = self._listener_class(settings)
+                if listener_class is None:
+                    continue
+                listener = self._listeners.get(host)
+                if listener is None or not listener.is_alive():
+                    if listener_class is JobAgentListener:
+                        listener = JobAgentListener(settings['config'],
+                                                    settings['workdir'],
+                                                    settings['type'],
+                                                    settings['period'],
+                                                    logger)
+                    else:
+                        listener = JobEventListener(settings['config'],
+                                                    settings['workdir'],
+                                                    logger)
+                    self._listeners[host] = listener
+                listener.watch(settings['names'], settings.get('ids'))
+                event_states.update(listener.pop_states())
+                monitor_jobs[host] = dict(
+                    settings,
+                    period=max(settings['period'],
+                               settings.get('max_period', 0)),
+                    walltimes={})
 
+            for host, (future, settings) in self._late.items():
+                if future.done():
+                    del self._late[host]
+                    states.update(self._collect_states(host,
+                                                       settings,
+                                                       future,
+                                                       0,
+                                                       logger))
+
+            # hosts are queried at the same time, each in its own worker
+            pending = {}
+            deadlines = {}
+            completed = Queue()
+            # hosts monitored by the same Prometheus are queried at once
+            batches = {}
+            for host in self._running.keys():
+                if host not in monitor_jobs:
+                    self._scheduler.forget(host)
             for host, settings in monitor_jobs.iteritems():
-                # Only get info when it is safe
-                if host in self._last_time:
-                    seconds_to_wait = settings['period'] - \
-                        (time.time() - self._last_time[host])
-                    if seconds_to_wait > 0:
-                        continue
+                # Only get info when it is due
+                if not self._scheduler.is_due(host, settings):
+                    continue
+                # a request that timed out may still be running, it is
+                # retried later as a failed poll
+                if host in self._running and not self._running[host].done():
+                    self._scheduler.update(host, settings, None)
+                    continue
 
                 logger.debug("Reading job status..")
-                self._last_time[host] = time.time()
-
-                if settings['type'] == "PROMETHEUS":  # external
-                    partial_states = self._get_prometheus(
-                        host,
-                        settings['config'],
-                        settings['names'])
-                else:  # internal
-                    wm = WorkloadManager.factory(settings['type'])
-                    if wm:
-                        partial_states = wm.get_states(
-                            settings['workdir'],
-                            settings['config'],
-                            settings['names'],
-                            logger
-                        )
-                    else:
-                        partial_states = self._no_states(
-                            host,
-                            settings['type'],
-                            settings['names'],
-                            logger)
-                states.update(partial_states)
+                if settings['type'] == "PROMETHEUS":
+                    batches.setdefault(settings['config']['url'],
+                                       {})[host] = settings['names']
+                    continue
+                # another execution may have just polled the host
+                cached = self._use_cache(logger,
+                                         'get',
+                                         host,
+                                         self._cache_settings(settings))
+                if cached is not None:
+                    states.update(cached)
+                    self._scheduler.update(host, settings, cached)
+                    continue
+                pending[host] = SshExecutor().submit(self._get_states,
+                                                     host,
+                                                     settings,
+                                                     logger)
+            for url, names in batches.iteritems():
+                future = SshExecutor().submit(self._get_prometheus,
+                                              url,
+                                              names)
+                waiting = set(names)
+                for host in names:
+                    pending[host] = _HostFuture(future, host, waiting)
+            for host in pending:
+                deadlines[host] = time.time() + \
+                    monitor_jobs[host].get('timeout', self.request_timeout)
+                self._running[host] = pending[host]
+                pending[host].add_done_callback(
+                    lambda future, host=host: completed.put(host))
+
+            # states are merged as they arrive, until every host answers or
+            # runs out of time
+            timed_out = []
+            while pending:
+                try:
+                    host = completed.get(
+                        timeout=max(min(deadlines.values()) - time.time(),
+                                    0))
+                except Empty:
+                    now = time.time()
+                    for host in [host for host in pending
+                                 if deadlines[host] <= now]:
+                        future = pending.pop(host)
+                        del deadlines[host]
+                        if not future.cancel():
+                            self._late[host] = (future, monitor_jobs[host])
+                        self._scheduler.update(host, monitor_jobs[host], None)
+                        timed_out.append(host)
+                    continue
+                if host in pending:
+                    future = pending.pop(host)
+                    del deadlines[host]
+                    states.update(self._collect_states(host,
+                                                       monitor_jobs[host],
+                                                       future,
+                                                       None,
+                                                       logger))
+
+            self.timed_out = timed_out
+            if timed_out:
+                logger.warning("Timed out reading job status from '" +
+                               "', '".join(sorted(timed_out)) +
+                               "', it will be retried")
 
+            states.update(event_states)
             return states
 
-        def _get_prometheus(self, host, config, names):
-            states = {}
-            url = config['url']
-            if len(names) == 1:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D%22')
+        def next_poll(self):
+            """ Seconds to the next due poll, None if nothing was polled """
+            return self._scheduler.next_poll()
+
+        def has_events(self):
+            """ True if some job reported its completion, or the agent a
+            new state, since the last request """
+            return any(listener.has_states()
+                       for listener in self._listeners.values())
+
+        def _listener_class(self, settings):
+            if settings.get('agent'):
+                return JobAgentListener
+            if settings.get('events'):
+                return JobEventListener
+            return None
+
+        def use_status_cache(self, path):
+            """ Shares the job states with the other executions of the
+            manager through the file, stops sharing them if it is None """
+            if self.status_cache is not None:
+                self.status_cache.close()
+            self.status_cache = StatusCache(path) if path else None
+
+        def close_listeners(self):
+            """ Stops following the completion of the jobs """
+            for host in self._listeners.keys():
+                self._listeners.pop(host).close()
+
+        def reset(self):
+            """ Forgets the polls and listeners of the last execution, the
+            next one starts from scratch """
+            self.close_listeners()
+            self._scheduler.reset()
+            self._running.clear()
+            self._late.clear()
+            self.timed_out = []
+
+        def _collect_states(self, host, settings, future, timeout, logger):
+            """ States got by the request, scheduling the next one """
+            try:
+                partial_states = future.get(timeout)
+            except (EOFError,
+                    socket.error,
+                    ssh_exception.SSHException,
+                    requests.RequestException,
+                    ValueError,
+                    TimeoutError) as err:
+                # unreachable hosts must not stop polling the rest
+                logger.warning("Cannot read job status from '" + host +
+                               "', it will be retried: " + str(err))
+                self._scheduler.update(host, settings, None)
+                return {}
+            if partial_states is None:
+                # the request was cancelled, it did not poll anything
+                self._scheduler.update(host, settings, None)
+                return {}
+            self._scheduler.update(host, settings, partial_states)
+            return partial_states
+
+        def _use_cache(self, logger, method, *args):
+            """ Result of the status cache method, None without cache """
+            if self.status_cache is None:
+                return None
+            try:
+                return getattr(self.status_cache, method)(*args)
+            except (sqlite3.Error, OSError) as err:
+                logger.warning("Cannot use the status cache: " + str(err))
+                return None
+
+        @staticmethod
+        def _cache_settings(settings):
+            """ Settings of the host in the status cache, scoped to the
+            workdir if the workload manager reads the states from it """
+            wm = WorkloadManager.factory(settings['type'])
+            if wm and wm.workdir_states:
+                return dict(settings, scope=settings['workdir'])
+            return settings
+
+        def _get_states(self, host, settings, logger):
+            # external monitors are queried in batches by `request`
+            wm = WorkloadManager.factory(settings['type'])
+            if wm:
+                # the jobs of every execution are polled at once
+                shared = self._use_cache(logger,
+                                         'shared_settings',
+                                         host,
+                                         self._cache_settings(settings)) or \
+                    settings
+                states = wm.get_states(
+                    settings['workdir'],
+                    settings['config'],
+                    shared['names'],
+                    logger,
+                    job_ids=shared.get('ids')
+                ) or {}
+                self._use_cache(logger, 'put', host, shared, states)
+                return dict((name, state) for name, state in states.items()
+                            if name in settings['names'])
             else:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D~%22')
-            query += '|'.join(names) + '%22%7D'
+                return self._no_states(
+                    host,
+                    settings['type'],
+                    settings['names'],
+                    logger)
+
+        def _prometheus_session(self):
+            """ Session shared by the concurrent Prometheus queries """
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_maxsize=SshExecutor().max_workers)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                return self._session
 
-            payload = requests.get(query)
+        def _get_prometheus(self, url, names):
+            """
+            States of the jobs of many hosts monitored by the same
+            Prometheus, by host, with a single query
+            """
+            session = self._prometheus_session()
+            all_names = set()
+            for host_names in names.values():
+                all_names.update(host_names)
+            query = ('job_status{job=~' + _promql_regex(sorted(names)) +
+                     ',name=~' + _promql_regex(sorted(all_names)) + '}')
 
+            payload = session.get(url + '/api/v1/query',
+                                  params={'query': query},
+                                  timeout=self.prometheus_timeout)
+            payload.raise_for_status()
             response = payload.json()
 
+            states = dict((host, {}) for host in names)
             for item in response["data"]["result"]:
-                states[item["metric"]["name"]] = state_int_to_str(
-                    item["value"][1])
+                host = item["metric"].get("job")
+                name = item["metric"].get("name")
+                if host in names and name in names[host]:
+                    states[host][name] = state_int_to_str(item["value"][1])
 
             return states
 
@@ -0,0 +1,190 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+metrics.py: In-process registry of counters and histograms
+'''
+
+
+import bisect
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+_local = threading.local()
+
+
+def current_operation():
+    """ Innermost operation running in this thread, if any """
+    stack = getattr(_local, 'operations', None)
+    return stack[-1] if stack else ''
+
+
+@contextmanager
+def operation(name):
+    """ Tags the metrics recorded inside the block with the operation """
+    if not hasattr(_local, 'operations'):
+        _local.operations = []
+    _local.operations.append(name)
+    try:
+        yield
+    finally:
+        _local.operations.pop()
+
+
+def instrumented(function):
+    """ Decorator that tags the metrics recorded by the function with its
+    name """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with operation(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def with_operation(function):
+    """ Wraps the function to run it tagged with the current operation, to
+    keep the tag when it is run by another thread """
+    name = current_operation()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with operation(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class Metrics(object):
+    """
+    Process-wide registry of counters and histograms
+
+    Every metric is identified by its name and labels. The registry can be
+    read as a dictionary with `snapshot` or in Prometheus text format with
+    `to_prometheus`.
+    """
+    class __Metrics(object):
+        # upper bounds of the histograms buckets, in seconds
+        buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120)
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self._counters = {}
+            self._histograms = {}
+
+        def inc(self, name, value=1, **labels):
+            """ Increments a counter """
+            key = (name, tuple(sorted(labels.items())))
+            with self._lock:
+                self._counters[key] = self._counters.get(key, 0) + value
+
+        def observe(self, name, value, **labels):
+            """ Adds a value to a histogram """
+            key = (name, tuple(sorted(labels.items())))
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = {'counts': [0] * (len(self.buckets) + 1),
+                                 'sum': 0.0,
+                                 'count': 0}
+                    self._histograms[key] = histogram
+                histogram['counts'][
+                    bisect.bisect_left(self.buckets, value)] += 1
+                histogram['sum'] += value
+                histogram['count'] += 1
+
+        def snapshot(self):
+            """
+            Copy of every metric, as a dictionary of names to lists of
+            samples with their labels. Histograms buckets are cumulative.
+            """
+            snapshot = {}
+            with self._lock:
+                for (name, labels), value in self._counters.iteritems():
+                    snapshot.setdefault(name, []).append(
+                        {'labels': dict(labels), 'value': value})
+                for (name, labels), histogram in \
+                        self._histograms.iteritems():
+                    cumulative = 0
+                    buckets = []
+                    for bound, count in zip(self.buckets + ('+Inf',),
+                                            histogram['counts']):
+                        cumulative += count
+                        buckets.append((bound, cumulative))
+                    snapshot.setdefault(name, []).append(
+                        {'labels': dict(labels),
+                         'buckets': buckets,
+                         'sum': histogram['sum'],
+                         'count': histogram['count']})
+            return snapshot
+
+        def to_prometheus(self):
+            """ Every metric in Prometheus text exposition format """
+            lines = []
+            for name, samples in sorted(self.snapshot().iteritems()):
+                if 'buckets' in samples[0]:
+                    lines.append('# TYPE ' + name + ' histogram')
+                    for sample in samples:
+                        for bound, count in sample['buckets']:
+                            lines.append(
+                                name + '_bucket' +
+                                _format_labels(sample['labels'],
+                                               le=str(bound)) +
+                                ' ' + str(count))
+                        lines.append(name + '_sum' +
+                                     _format_labels(sample['labels']) +
+                                     ' ' + repr(sample['sum']))
+                        lines.append(name + '_count' +
+                                     _format_labels(sample['labels']) +
+                                     ' ' + str(sample['count']))
+                else:
+                    lines.append('# TYPE ' + name + ' counter')
+                    for sample in samples:
+                        lines.append(name +
+                                     _format_labels(sample['labels']) +
+                                     ' ' + str(sample['value']))
+            return '\n'.join(lines) + '\n'
+
+        def reset(self):
+            """ Drops every metric """
+            with self._lock:
+                self._counters = {}
+                self._histograms = {}
+
+    instance = None
+
+    def __init__(self):
+        if not Metrics.instance:
+            Metrics.instance = Metrics.__Metrics()
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"'
+        for key, value in sorted(labels.iteritems())) + '}'
@@ -0,0 +1,329 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+monitor_agent.py: Job states agent, run on the HPC login nodes
+
+It is uploaded to the workdir and run with the python of the login node, so
+it only uses the standard library of python 2.6+ and 3.
+
+`follow <scheduler> [period] [state dir]` prints the states of the jobs of
+the user, as "name|job id|state|timestamp" lines, and then their changes as
+they happen, with a "#" line every period without changes, until nobody
+reads them. The states are read
+by one poller per user and scheduler, shared by every deployment, that
+queries the scheduler once every period for all the jobs of the user and
+appends the changes to the states log of the state dir. The poller is
+started by the first follower and exits when none is left.
+'''
+
+import errno
+import fcntl
+import os
+import subprocess
+import sys
+import time
+
+# name of the agent in the workdir
+AGENT_FILE = '.croupier_agent.py'
+# one state dir per scheduler, as "~/.croupier/agent-slurm"
+DEFAULT_STATE_DIR = '~/.croupier/agent-'
+DEFAULT_PERIOD = 30
+
+LOG_FILE = 'states.log'
+POLLER_LOCK = 'poller.lock'
+FOLLOWERS_LOCK = 'followers.lock'
+
+# seconds between the checks of the poller by the followers
+CHECK_PERIOD = 10
+# lines of the log before it is compacted, and seconds the finished jobs
+# are kept when it is
+COMPACT_LINES = 10000
+FINISHED_TTL = 86400
+
+FINISHED_STATES = ('BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE',
+                   'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED',
+                   'REVOKED', 'TIMEOUT')
+
+# states that prevail when the tasks of a job array differ, the first
+# found wins
+_STATES_PRECEDENCE = ('FAILED', 'NODE_FAIL', 'BOOT_FAIL', 'OUT_OF_MEMORY',
+                      'CANCELLED', 'REVOKED', 'TIMEOUT', 'DEADLINE',
+                      'SPECIAL_EXIT', 'STOPPED', 'SUSPENDED', 'PREEMPTED',
+                      'RUNNING', 'CONFIGURING', 'COMPLETING', 'PENDING')
+
+_TORQUE_STATES = {'Q': 'PENDING',
+                  'W': 'PENDING',
+                  'H': 'PENDING',
+                  'T': 'PENDING',
+                  'R': 'RUNNING',
+                  'E': 'COMPLETING',
+                  'S': 'SUSPENDED'}
+
+
+def _run(command):
+    """ Output of the shell command, None if it fails """
+    process = subprocess.Popen(command,
+                               shell=True,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    return output
+
+
+def _merge(states, key, state):
+    """ Sets the state of the job, keeping the prevailing one of arrays """
+    current = states.get(key)
+    if current is None or current == state:
+        states[key] = state
+        return
+    for prevailing in _STATES_PRECEDENCE:
+        if prevailing in (current, state):
+            states[key] = prevailing
+            return
+
+
+def query_slurm(since):
+    """
+    States of the jobs of the user by name and job id: the queued ones and
+    the ones that finished after `since`
+    """
+    finished = _run(
+        "sacct -n -X -P -u \"$USER\" -o JobName,JobID,State -S " +
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(since)) +
+        " -s BF,CA,CD,DL,F,NF,OOM,PR,TO")
+    queued = _run("squeue -h -u \"$USER\" -o '%j|%F|%T'")
+    if finished is None or queued is None:
+        return None
+
+    states = {}
+    for line in finished.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 3:
+            # array tasks are reported as "<job id>_<index>"
+            _merge(states,
+                   (fields[0], fields[1].split('_')[0].split('.')[0]),
+                   fields[2].split(' ')[0])
+    # the tasks of an array still queued override the finished ones
+    queued_states = {}
+    for line in queued.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 3:
+            _merge(queued_states, (fields[0], fields[1]), fields[2])
+    states.update(queued_states)
+    return states
+
+
+def query_torque(since):
+    """ States of the jobs of the user by name and job id, as long as the
+    server keeps them """
+    output = _run("qselect -u \"$USER\" | xargs -r qstat -f")
+    if output is None:
+        return None
+
+    states = {}
+    job = {}
+    for line in output.splitlines() + ['Job Id: ']:
+        if line.startswith('Job Id: '):
+            if 'Job_Name' in job and 'job_state' in job:
+                if job['job_state'] == 'C':
+                    state = 'COMPLETED' \
+                        if job.get('exit_status', '0') == '0' else 'FAILED'
+                else:
+                    state = _TORQUE_STATES.get(job['job_state'], 'PENDING')
+                states[(job['Job_Name'], job['Job_Id'])] = state
+            job = {'Job_Id': line[len('Job Id: '):].strip()}
+        elif ' = ' in line:
+            key, value = line.strip().split(' = ', 1)
+            job[key] = value
+    return states
+
+
+_QUERIES = {'SLURM': query_slurm, 'TORQUE': query_torque}
+# workload managers whose job states the agent follows
+SCHEDULERS = tuple(sorted(_QUERIES))
+
+
+def _lock(path, mode, wait=False):
+    """ Open file holding the lock, None if it is held by others """
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock.fileno(), mode if wait else mode | fcntl.LOCK_NB)
+    except IOError as err:
+        lock.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock
+
+
+def _read_log(path):
+    """ Last state and time of every job in the log """
+    states = {}
+    if os.path.exists(path):
+        with open(path) as log:
+            for line in log:
+                fields = line.rstrip('\n').split('|')
+                if len(fields) == 4:
+                    states[(fields[0], fields[1])] = (fields[2],
+                                                      float(fields[3]))
+    return states
+
+
+def _compact_log(path, states, now):
+    """ Rewrites the log with the last states, without the old jobs """
+    temp = path + '.tmp'
+    with open(temp, 'w') as log:
+        for (name, job_id), (state, when) in sorted(states.items()):
+            if state not in FINISHED_STATES or now - when < FINISHED_TTL:
+                log.write('|'.join((name, job_id, state, repr(when))) + '\n')
+    os.rename(temp, path)
+    return _read_log(path)
+
+
+def poll(scheduler, period, state_dir):
+    """ Appends the changes of the jobs states to the log, while someone
+    follows it """
+    lock = _lock(os.path.join(state_dir, POLLER_LOCK), fcntl.LOCK_EX)
+    if lock is None:
+        return 0  # another poller is running
+    path = os.path.join(state_dir, LOG_FILE)
+    states = _read_log(path)
+    lines = len(states)
+    since = time.time() - FINISHED_TTL
+    while True:
+        followers = _lock(os.path.join(state_dir, FOLLOWERS_LOCK),
+                          fcntl.LOCK_EX)
+        if followers is not None:
+            followers.close()
+            return 0
+
+        now = time.time()
+        current = _QUERIES[scheduler](since)
+        if current is not None:
+            # finished jobs are queried again with a margin, as they may
+            # be accounted late
+            since = now - 2 * period
+            changes = [(key, state) for key, state in current.items()
+                       if key not in states or states[key][0] != state]
+            if changes:
+                with open(path, 'a') as log:
+                    for (name, job_id), state in changes:
+                        log.write('|'.join((name, job_id, state,
+                                            repr(now))) + '\n')
+                        states[(name, job_id)] = (state, now)
+                lines += len(changes)
+            if lines > COMPACT_LINES:
+                states = _compact_log(path, states, now)
+                lines = len(states)
+        time.sleep(period)
+
+
+def _start_poller(scheduler, period, state_dir):
+    """ Starts the poller in the background, if it is not running """
+    lock = _lock(os.path.join(state_dir, POLLER_LOCK), fcntl.LOCK_EX)
+    if lock is None:
+        return None
+    lock.close()
+    devnull = open(os.devnull, 'r+')
+    errors = open(os.path.join(state_dir, 'poller.err'), 'a')
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             'poll', scheduler, str(period), state_dir],
+                            stdin=devnull,
+                            stdout=devnull,
+                            stderr=errors,
+                            close_fds=True,
+                            preexec_fn=os.setsid)
+
+
+def follow(scheduler, period, state_dir):
+    """ Prints the log and its new lines, keeping the poller running """
+    followers = _lock(os.path.join(state_dir, FOLLOWERS_LOCK),
+                      fcntl.LOCK_SH,
+                      wait=True)
+    path = os.path.join(state_dir, LOG_FILE)
+    open(path, 'a').close()
+    log = open(path)
+    poller = None
+    last_write = last_check = 0
+    try:
+        while True:
+            now = time.time()
+            if now - last_check >= CHECK_PERIOD:
+                if poller is not None:
+                    poller.poll()  # reaps it once it exits
+                poller = _start_poller(scheduler, period, state_dir) or \
+                    poller
+                last_check = now
+
+            line = log.readline()
+            if line:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                last_write = now
+                continue
+            # the log is replaced when it is compacted
+            if os.stat(path).st_ino != os.fstat(log.fileno()).st_ino:
+                log.close()
+                log = open(path)
+                continue
+            if now - last_write >= max(period, 1):
+                # also finds out when nobody reads anymore
+                sys.stdout.write('#\n')
+                sys.stdout.flush()
+                last_write = now
+            time.sleep(0.5)
+    except IOError as err:
+        if err.errno != errno.EPIPE:
+            raise
+    finally:
+        log.close()
+        followers.close()
+    return 0
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ('follow', 'poll') or \
+            argv[2] not in _QUERIES:
+        sys.stderr.write("usage: " + argv[0] + " follow|poll SLURM|TORQUE "
+                         "[period] [state dir]\n")
+        return 2
+    period = float(argv[3]) if len(argv) > 3 else DEFAULT_PERIOD
+    state_dir = os.path.expanduser(argv[4] if len(argv) > 4
+                                   else DEFAULT_STATE_DIR + argv[2].lower())
+    if not os.path.isdir(state_dir):
+        try:
+            os.makedirs(state_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    if argv[1] == 'poll':
+        return poll(argv[2], period, state_dir)
+    return follow(argv[2], period, state_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
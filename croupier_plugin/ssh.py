@@ -24,53 +24,178 @@ license information in the project root.
 ssh.py: Wrap of paramiko to send ssh commands
 
 Todo:
-    * read stderr and return it
     * control SSH exceptions and return failures
 '''
 
 
+import atexit
 import io
 import logging
+import posixpath
+import random
 import select
 import socket
-import thread
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Lock, RLock
 
+from croupier_plugin.metrics import (Metrics,
+                                     current_operation,
+                                     with_operation)
 from croupier_plugin.utilities import shlex_quote
 from paramiko import RSAKey, client, ssh_exception
 
-try:
-    import SocketServer
-except ImportError:
-    import socketserver as SocketServer
+# Size of the reads from the ssh channels
+_CHUNK_SIZE = 65536
 
-
-# # @TODO `posixpath` can be used for common pathname manipulations on
-# #       remote HPC systems
-# import posixpath as cli_path
+# Metrics recorded per host and calling operation
+CONNECT_METRIC = 'croupier_ssh_connect_seconds'
+COMMAND_METRIC = 'croupier_ssh_command_seconds'
+UPLOAD_METRIC = 'croupier_ssh_upload_seconds'
+SENT_METRIC = 'croupier_ssh_sent_bytes_total'
+RECEIVED_METRIC = 'croupier_ssh_received_bytes_total'
+RETRIES_METRIC = 'croupier_ssh_retries_total'
+FAILURES_METRIC = 'croupier_ssh_failures_total'
 
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 # Hack to avoid "Error reading SSH protocol banner" random issue
 logging.getLogger('paramiko.transport').addHandler(logging.NullHandler())
 
 
+class HostUnavailableError(ssh_exception.SSHException):
+    """ The host failed too many times in a row and is not tried for now """
+    pass
+
+
+class _CircuitBreaker(object):
+    """
+    Fails fast the connections to hosts that keep failing
+
+    After `threshold` consecutive failures the host is not tried again for
+    `cooldown` seconds. Then one attempt is let through to probe it, closing
+    the circuit if it succeeds or opening it again if it fails.
+    """
+    threshold = 3
+    cooldown = 60
+
+    def __init__(self):
+        self._lock = Lock()
+        # host -> [consecutive failures, time the circuit was opened]
+        self._hosts = {}
+
+    def check(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return
+            remaining = state[1] + self.cooldown - time.time()
+            if remaining > 0:
+                raise HostUnavailableError(
+                    "Host " + host + " failed " + str(state[0]) +
+                    " times in a row, retrying in " + str(int(remaining)) +
+                    " seconds")
+            # half open, the rest keep failing fast while this one probes
+            state[1] = time.time()
+
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, [0, None])
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[1] = time.time()
+
+
+_circuit_breaker = _CircuitBreaker()
+
+
+class _ProbeCache(object):
+    """
+    Results of idempotent remote commands, per host, user and command
+
+    Entries expire after their time to live, or when invalidated.
+    """
+    ttl = 300
+
+    def __init__(self):
+        self._lock = Lock()
+        # (host key, command) -> (result, expiration time)
+        self._entries = {}
+
+    def get(self, host_key, command):
+        with self._lock:
+            entry = self._entries.get((host_key, command))
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._entries[(host_key, command)]
+                return None
+            return entry[0]
+
+    def put(self, host_key, command, result, ttl=None):
+        with self._lock:
+            self._entries[(host_key, command)] = (
+                result, time.time() + (self.ttl if ttl is None else ttl))
+
+    def invalidate(self, host_key=None, command=None):
+        with self._lock:
+            for key in list(self._entries):
+                if (host_key is None or key[0] == host_key) and \
+                        (command is None or key[1] == command):
+                    del self._entries[key]
+
+
+_probe_cache = _ProbeCache()
+
+# Gathers the host facts in one round trip, as `key=value` lines
+_HOST_FACTS_COMMAND = (
+    'echo "os=$(uname -s)"; '
+    'echo "kernel=$(uname -r)"; '
+    'echo "shell=$SHELL"; '
+    'echo "home=$HOME"; '
+    'for bin in sbatch srun sacct squeue scancel qsub qselect qstat qdel; do '
+    'path=$(command -v $bin) && echo "bin.$bin=$path"; done; '
+    'command -v sbatch >/dev/null && '
+    'echo "version.slurm=$(sbatch --version 2>&1 | head -n 1)"; '
+    'command -v qstat >/dev/null && '
+    'echo "version.torque=$(qstat --version 2>&1 | head -n 1)"; '
+    'true')
+# Key of the host facts in the probes cache
+_HOST_FACTS_PROBE = '#host_facts'
+
+
 class SshClient(object):
     """Represents a ssh client"""
     _client = None
 
+    # Seconds between keepalive messages on idle connections
+    keepalive_interval = 30
+    # Seconds to establish the connection
+    connect_timeout = 30
+    # Reconnection attempts of dead connections, with exponential backoff
+    reconnect_retries = 3
+    backoff_base = 1
+    backoff_max = 30
+
     def __init__(self, credentials):
         # Build a tunnel if necessary
         self._tunnel = None
+        self._tunnel_held = False
+        self._closed = False
+        self._connect_lock = Lock()
+        self._executor = None
+        self._executor_lock = Lock()
         self._host = credentials['host']
-        if 'user' in credentials:
-            self._user = credentials['user']
+        self._user = credentials.get('user')
         self._port = int(credentials['port']) if 'port' in credentials else 22
         if 'tunnel' in credentials and credentials['tunnel']:
-            self._tunnel = SshForward(credentials)
-            self._host = "localhost"
-            self._port = self._tunnel.port()
-
-        self._client = client.SSHClient()
-        self._client.set_missing_host_key_policy(client.AutoAddPolicy())
+            # connect through a channel of the shared jump host connection
+            self._tunnel = credentials['tunnel']
 
         # Build the private key if provided
         private_key = None
@@ -100,44 +225,174 @@ class SshClient(object):
         self._login_shell = False
         if 'login_shell' in credentials:
             self._login_shell = credentials['login_shell']
+        self._cache_key = self._get_cache_key(credentials)
+
+        # Keep one login shell alive per connection and run the commands
+        # through it, so the environment setup is paid only once
+        self._persistent_session = False
+        if 'persistent_session' in credentials:
+            self._persistent_session = credentials['persistent_session']
+        self._session = None
+        self._session_lock = Lock()
+
+        # Concurrent commands are limited to the channels per connection
+        # allowed by the server (sshd MaxSessions, 10 by default)
+        self._max_sessions = 10
+        if 'max_sessions' in credentials:
+            self._max_sessions = int(credentials['max_sessions'])
+
+        if 'keepalive_interval' in credentials:
+            self.keepalive_interval = int(credentials['keepalive_interval'])
+
+        self._private_key = private_key
+        self._password = \
+            credentials['password'] if 'password' in credentials else None
+        self._connect()
+
+    def _connect(self):
+        """ Connects once, going through the host circuit breaker """
+        address = self._host + ":" + str(self._port)
+        _circuit_breaker.check(address)
+        try:
+            self._open_transport()
+        except Exception:
+            _circuit_breaker.failure(address)
+            raise
+        _circuit_breaker.success(address)
+
+    def _open_transport(self):
+        self._client = client.SSHClient()
+        self._client.set_missing_host_key_policy(client.AutoAddPolicy())
 
         retries = 5
-        passwd = credentials['password'] if 'password' in credentials else None
         while True:
+            start = time.time()
+            sock = None
+            if self._tunnel is not None:
+                sock = SshTunnelManager().open_channel(self._tunnel,
+                                                       self._host,
+                                                       self._port)
             try:
                 self._client.connect(
                     self._host,
                     port=self._port,
-                    username=credentials['user'],
-                    pkey=private_key,
-                    password=passwd,
-                    look_for_keys=False
+                    username=self._user,
+                    pkey=self._private_key,
+                    password=self._password,
+                    look_for_keys=False,
+                    sock=sock,
+                    timeout=self.connect_timeout
                 )
-            except ssh_exception.SSHException as err:
-                if retries > 0 and \
+            except Exception as err:
+                if sock is not None:
+                    sock.close()
+                    SshTunnelManager().release(self._tunnel)
+                if isinstance(err, ssh_exception.SSHException) and \
+                        retries > 0 and \
                         str(err) == "Error reading SSH protocol banner":
                     retries -= 1
                     logging.getLogger("paramiko").\
                         warning("Retrying SSH connection: " + str(err))
+                    Metrics().inc(RETRIES_METRIC, **self._metric_labels())
                     continue
                 else:
+                    Metrics().inc(FAILURES_METRIC,
+                                  stage='connect',
+                                  **self._metric_labels())
                     raise err
             break
 
+        Metrics().observe(CONNECT_METRIC,
+                          time.time() - start,
+                          **self._metric_labels())
+        self._tunnel_held = sock is not None
+        transport = self.get_transport()
+        if sock is None:
+            # commands are small request/reply exchanges, do not let Nagle's
+            # algorithm hold them back waiting for delayed acks
+            transport.sock.setsockopt(socket.IPPROTO_TCP,
+                                      socket.TCP_NODELAY,
+                                      1)
+        # keep the idle monitoring connections from being dropped
+        transport.set_keepalive(self.keepalive_interval)
+
+    def _drop_transport(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+        if self._client is not None:
+            self._client.close()
+        if self._tunnel_held:
+            self._tunnel_held = False
+            SshTunnelManager().release(self._tunnel)
+
+    def _ensure_connected(self):
+        """
+        Reconnects if the connection died, backing off exponentially with
+        random jitter between attempts
+        """
+        if self._closed or self.is_active():
+            return
+        with self._connect_lock:
+            if self.is_active():
+                return
+            logging.getLogger("paramiko").warning(
+                "SSH connection to " + self._host + " lost, reconnecting")
+            self._drop_transport()
+            attempt = 0
+            while True:
+                try:
+                    self._connect()
+                    return
+                except HostUnavailableError:
+                    raise
+                except (EOFError,
+                        socket.error,
+                        ssh_exception.SSHException) as err:
+                    if attempt >= self.reconnect_retries:
+                        raise
+                    delay = random.uniform(
+                        0, min(self.backoff_max,
+                               self.backoff_base * 2 ** attempt))
+                    attempt += 1
+                    Metrics().inc(RETRIES_METRIC, **self._metric_labels())
+                    logging.getLogger("paramiko").warning(
+                        "Reconnection to " + self._host + " failed (" +
+                        str(err) + "), retrying in " +
+                        "{0:.1f}".format(delay) + " seconds")
+                    time.sleep(delay)
+
+    def _metric_labels(self):
+        return {'host': self._host, 'operation': current_operation()}
+
     def get_transport(self):
         """Gets the transport object of the client (paramiko)"""
         return self._client.get_transport()
 
     def is_open(self):
-        """Check if connection is open"""
-        return self._client is not None
+        """Check if connection is open (not closed by the client)"""
+        return self._client is not None and not self._closed
+
+    def is_active(self):
+        """Check if the connection is alive"""
+        transport = self.get_transport() if self._client else None
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, socket.error, ssh_exception.SSHException):
+            return False
+        return True
 
     def close_connection(self):
         """Closes opened connection"""
-        if self._client is not None:
-            self._client.close()
-        if self._tunnel is not None:
-            self._tunnel.close()
+        self._closed = True
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.terminate()
+                self._executor = None
+        self._drop_transport()
 
     def execute_shell_command(self,
                               cmd,
@@ -156,116 +411,354 @@ class SshClient(object):
             wait_result = False
             cmd = "nohup " + cmd + " &"
 
+        return self.send_command(self._build_call(cmd, workdir, env),
+                                 wait_result=wait_result)
+
+    def stream_shell_command(self,
+                             cmd,
+                             workdir=None,
+                             env=None,
+                             exec_timeout=3000):
+        """
+        Executes the command remotely, accepting the same arguments as
+        `execute_shell_command`, without gathering its output.
+
+        @return CommandStream that yields the output lines as they arrive
+        """
+        return self._open_stream(self._wrap_command(
+            self._build_call(cmd, workdir, env)), exec_timeout)
+
+    @staticmethod
+    def _build_call(cmd, workdir=None, env=None):
         call = ""
         if env is not None:
             for key, value in env.iteritems():
                 call += "export " + key + "=" + value + " && "
 
-        if not workdir:
-            call += cmd
-            return self.send_command(call,
-                                     wait_result=wait_result)
-        else:
+        if workdir:
             # TODO: set scale variables as well
             call += "export CURRENT_WORKDIR=" + workdir + " && "
             call += "cd " + workdir + " && "
-            call += cmd
-            return self.send_command(call,
-                                     wait_result=wait_result)
+        return call + cmd
+
+    def submit_shell_command(self, cmd, workdir=None, env=None):
+        """
+        Executes the command remotely in a parallel channel of the same
+        transport, without waiting for it.
+
+        It is thread-safe, and accepts the same arguments as
+        `execute_shell_command`. At most `max_sessions` commands run at the
+        same time, the rest are queued.
+
+        @return AsyncResult that gives (output, exit_code) on `get()`
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPool(processes=self._max_sessions)
+            executor = self._executor
+        return executor.apply_async(
+            with_operation(self.execute_shell_command),
+            (cmd,),
+            {'workdir': workdir, 'env': env, 'wait_result': True})
+
+    def execute_shell_commands(self, cmds, workdir=None, env=None):
+        """
+        Executes the commands concurrently over the same connection
+
+        @return list of (output, exit_code), in the order of `cmds`
+        """
+        results = [self.submit_shell_command(cmd, workdir=workdir, env=env)
+                   for cmd in cmds]
+        return [result.get() for result in results]
+
+    def execute_batch(self, cmds, workdir=None, env=None, stop_on_error=False):
+        """
+        Executes several commands in a single remote shell invocation
+
+        Each command runs in its own subshell and its stdout, stderr and
+        exit code are framed with delimiters, so N commands cost one round
+        trip instead of N. `workdir` and `env` apply to all of them.
+        - if stop_on_error is set to True: commands after the first one
+          that fails are not executed
+
+        @return list of (stdout, stderr, exit_code) in the order of `cmds`.
+            Commands that were not executed get (None, None, None).
+        """
+        token = uuid.uuid4().hex
+        script = '__croupier_err=$(mktemp) || exit 1\n'
+        for index, cmd in enumerate(cmds):
+            script += "printf '\\n%s\\n' " + \
+                shlex_quote(_batch_mark(token, index, 'out')) + '\n'
+            script += '(\n' + cmd + '\n) 2>"$__croupier_err"\n'
+            script += '__croupier_rc=$?\n'
+            script += "printf '\\n%s\\n' " + \
+                shlex_quote(_batch_mark(token, index, 'err')) + '\n'
+            script += 'cat "$__croupier_err"\n'
+            script += "printf '\\n%s %d\\n' " + \
+                shlex_quote(_batch_mark(token, index, 'rc')) + \
+                ' $__croupier_rc\n'
+            if stop_on_error:
+                script += '[ $__croupier_rc -eq 0 ] || ' + \
+                    '{ rm -f "$__croupier_err"; exit $__croupier_rc; }\n'
+        script += 'rm -f "$__croupier_err"\n'
+
+        output, _ = self.execute_shell_command('{\n' + script + '}',
+                                               workdir=workdir,
+                                               env=env,
+                                               wait_result=True)
+        return _parse_batch_output(output, token, len(cmds))
+
+    def put_file(self, content, remote_path, mode=0o644, workdir=None):
+        """
+        Uploads a file through SFTP, see `put_files`
+
+        @type content: string or file-like object
+        @param content: contents of the file, streamed if it is a file
+        @type remote_path: string
+        @param remote_path: destination path, relative to workdir if set
+        """
+        self.put_files([(content, remote_path, mode)], workdir=workdir)
+
+    def put_files(self, files, workdir=None):
+        """
+        Uploads many files in a single SFTP session
+
+        Every file is written to a temporary name next to its destination,
+        gets its mode set and is then renamed, so a file is never seen
+        half-written and stale contents are replaced, not appended.
+
+        @type files: list
+        @param files: list of (content, remote_path, mode) tuples, being
+            content a string or a file-like object
+        @type workdir: string
+        @param workdir: base directory of relative remote paths. It can use
+            shell variables, like `$HOME`
+        """
+        self._ensure_connected()
+        start = time.time()
+        sent = 0
+        sftp = self._client.open_sftp()
+        try:
+            for content, remote_path, mode in files:
+                if workdir and not posixpath.isabs(remote_path):
+                    remote_path = posixpath.join(workdir, remote_path)
+                remote_path = self._resolve_remote_path(remote_path)
+                tmp_path = posixpath.join(
+                    posixpath.dirname(remote_path),
+                    '.' + posixpath.basename(remote_path) + '.' +
+                    uuid.uuid4().hex[:8] + '.tmp')
+
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                if isinstance(content, str):
+                    content = io.BytesIO(content)
+                try:
+                    sent += sftp.putfo(content, tmp_path).st_size
+                    sftp.chmod(tmp_path, mode)
+                    try:
+                        sftp.posix_rename(tmp_path, remote_path)
+                    except IOError:
+                        # server without the posix-rename extension
+                        try:
+                            sftp.remove(remote_path)
+                        except IOError:
+                            pass
+                        sftp.rename(tmp_path, remote_path)
+                except Exception:
+                    Metrics().inc(FAILURES_METRIC,
+                                  stage='upload',
+                                  **self._metric_labels())
+                    try:
+                        sftp.remove(tmp_path)
+                    except IOError:
+                        pass
+                    raise
+        finally:
+            sftp.close()
+        Metrics().observe(UPLOAD_METRIC,
+                          time.time() - start,
+                          **self._metric_labels())
+        Metrics().inc(SENT_METRIC, sent, **self._metric_labels())
+
+    def _resolve_remote_path(self, path):
+        """ Expands `~` and shell variables, that SFTP does not understand """
+        if path.startswith('~'):
+            path = '$HOME' + path[1:]
+        facts = _probe_cache.get(self._cache_key, _HOST_FACTS_PROBE)
+        if facts and facts.get('home') and path.startswith('$HOME') and \
+                path[5:6] in ('', '/'):
+            path = facts['home'] + path[5:]
+        if '$' not in path and '`' not in path:
+            return path
+        output, exit_code = self.probe('printf %s "' + path + '"')
+        if exit_code != 0:
+            raise IOError("Cannot resolve remote path '" + path + "'")
+        return output
+
+    @staticmethod
+    def _get_cache_key(credentials):
+        """ Connections sharing this key see the same remote environment """
+        return (credentials['host'],
+                int(credentials['port']) if 'port' in credentials else 22,
+                credentials.get('user'),
+                bool(credentials.get('login_shell')))
+
+    def probe(self, command, ttl=None):
+        """
+        Runs an idempotent command and returns its output and exit code,
+        reusing them for `ttl` seconds (5 minutes by default) across the
+        connections to the same host and user. Failures are not cached.
+        """
+        result = _probe_cache.get(self._cache_key, command)
+        if result is None:
+            result = self.send_command(command, wait_result=True)
+            if result[1] == 0:
+                _probe_cache.put(self._cache_key, command, result, ttl)
+        return result
+
+    def invalidate_probes(self, command=None):
+        """ Forgets the cached probes and facts of the host, or only those
+        of `command` """
+        _probe_cache.invalidate(self._cache_key, command)
+
+    def get_host_facts(self, ttl=None):
+        """
+        Facts about the host, gathered in one round trip and cached like
+        the probes: `os`, `kernel`, `shell`, `home`, and the paths and
+        versions of the workload manager commands found, in `binaries` and
+        `versions`. None if they could not be gathered.
+        """
+        facts = _probe_cache.get(self._cache_key, _HOST_FACTS_PROBE)
+        if facts is None:
+            output, exit_code = self.send_command(_HOST_FACTS_COMMAND,
+                                                  wait_result=True)
+            if exit_code != 0:
+                return None
+            facts = _parse_host_facts(output)
+            _probe_cache.put(self._cache_key, _HOST_FACTS_PROBE, facts, ttl)
+        return facts
+
+    @staticmethod
+    def cache_host_facts(credentials, facts, ttl=None):
+        """ Reuses the host facts gathered by a previous operation """
+        if facts:
+            _probe_cache.put(SshClient._get_cache_key(credentials),
+                             _HOST_FACTS_PROBE,
+                             facts,
+                             ttl)
 
     def send_command(self,
                      command,
                      exec_timeout=3000,
                      read_chunk_timeout=500,
                      wait_result=False):
-        """Sends a command and returns stdout, stderr and exitcode"""
+        """
+        Sends a command and, if wait_result is set, returns its output and
+        exit code as soon as the remote process exits.
+        `read_chunk_timeout` is kept for compatibility and no longer used.
+        """
 
         # Check if connection is made previously
         if self._client is not None:
+            self._ensure_connected()
 
-            if self._login_shell:
-                cmd = "bash -l -c {}".format(shlex_quote(command))
-            else:
-                cmd = command
-            # there is one channel per command
-            stdin, stdout, stderr = self._client.exec_command(
-                cmd,
-                timeout=exec_timeout)
+            if wait_result and self._login_shell and \
+                    self._persistent_session:
+                start = time.time()
+                result = self._send_session_command(command, exec_timeout)
+                if result is not None:
+                    labels = self._metric_labels()
+                    Metrics().observe(COMMAND_METRIC,
+                                      time.time() - start,
+                                      **labels)
+                    Metrics().inc(SENT_METRIC, len(command), **labels)
+                    Metrics().inc(RECEIVED_METRIC, len(result[0]), **labels)
+                    return result
 
+            cmd = self._wrap_command(command)
             if wait_result:
-                # get the shared channel for stdout/stderr/stdin
-                channel = stdout.channel
-
-                # we do not need stdin
-                stdin.close()
-                # indicate that we're not going to write to that channel
-                channel.shutdown_write()
-
-                # read stdout/stderr in order to prevent read block hangs
-                stdout_chunks = []
-                stdout_chunks.append(stdout.channel.recv(
-                    len(stdout.channel.in_buffer)))
-                # chunked read to prevent stalls
-                while (not channel.closed
-                       or channel.recv_ready()
-                       or channel.recv_stderr_ready()):
-                    # Stop if channel was closed prematurely,
-                    # and there is no data in the buffers.
-                    got_chunk = False
-                    readq, _, _ = select.select([stdout.channel],
-                                                [],
-                                                [],
-                                                read_chunk_timeout)
-                    for c in readq:
-                        if c.recv_ready():
-                            stdout_chunks.append(stdout.channel.recv(
-                                len(c.in_buffer)))
-                            got_chunk = True
-                        if c.recv_stderr_ready():
-                            # make sure to read stderr to prevent stall
-                            stderr.channel.recv_stderr(len(c.in_stderr_buffer))
-                            got_chunk = True
-                    '''
-                    1) make sure that there are at least 2 cycles with no data
-                        in the input buffers in order to not exit too early
-                        (i.e. cat on a >200k file).
-                    2) if no data arrived in the last loop, check if we already
-                        received the exit code
-                    3) check if input buffers are empty
-                    4) exit the loop
-                    '''
-                    if (not got_chunk
-                            and stdout.channel.exit_status_ready()
-                            and not stderr.channel.recv_stderr_ready()
-                            and not stdout.channel.recv_ready()):
-                        # Indicate that we're not going to read from
-                        # this channel anymore
-                        stdout.channel.shutdown_read()
-                        # close the channel
-                        stdout.channel.close()
-                        # Remote side is finished & our bufferes are empty
-                        break
+                output, _, exit_code = self._run_command(cmd, exec_timeout)
+                return (output, exit_code)
 
+            # there is one channel per command
+            _, stdout, stderr = self._client.exec_command(
+                cmd,
+                timeout=exec_timeout)
+            Metrics().inc(SENT_METRIC, len(cmd), **self._metric_labels())
             # close all the pseudofiles
             stdout.close()
             stderr.close()
-
-            if wait_result:
-                # exit code is always ready at this point
-                exit_code = stdout.channel.recv_exit_status()
-                if exit_code == 0:
-                    output = ''.join(stdout_chunks)
-                else:
-                    output = ''.join(stdout_chunks)  # TODO stderr
-                return (output, exit_code)
-            else:
-                return True
+            return True
         else:
             if wait_result:
                 return (None, None)
             else:
                 return False
 
+    def _wrap_command(self, command):
+        if self._login_shell:
+            return "bash -l -c {}".format(shlex_quote(command))
+        return command
+
+    def _open_stream(self, cmd, timeout):
+        """ Runs the command in its own channel, returning its stream """
+        self._ensure_connected()
+        labels = self._metric_labels()
+        channel = self.get_transport().open_session(timeout=timeout)
+        try:
+            channel.exec_command(cmd)
+            channel.shutdown_write()
+        except Exception:
+            Metrics().inc(FAILURES_METRIC, stage='command', **labels)
+            channel.close()
+            raise
+        Metrics().inc(SENT_METRIC, len(cmd), **labels)
+        return CommandStream(channel, timeout, labels)
+
+    def _run_command(self, cmd, timeout):
+        """
+        Runs the command in its own channel, returning its stdout, stderr
+        and exit code as soon as the remote process exits
+        """
+        with self._open_stream(cmd, timeout) as stream:
+            output = ''.join(stream.chunks())
+            return (output, stream.stderr, stream.exit_code)
+
+    def _send_session_command(self, command, timeout):
+        """
+        Runs the command in the persistent login shell, returning None when
+        the session can not be used so the caller opens its own channel
+        """
+        # a busy session means concurrent commands, that go on their own
+        if not self._session_lock.acquire(False):
+            return None
+        try:
+            if self._session is None or not self._session.is_alive():
+                if self._session is not None:
+                    self._session.close()
+                    self._session = None
+                try:
+                    self._session = _ShellSession(self.get_transport())
+                except (EOFError,
+                        socket.error,
+                        ssh_exception.SSHException) as err:
+                    logging.getLogger("paramiko").warning(
+                        "Persistent shell session not available: " +
+                        str(err))
+                    return None
+            try:
+                return self._session.run(command, timeout)
+            except Exception:
+                Metrics().inc(FAILURES_METRIC,
+                              stage='command',
+                              **self._metric_labels())
+                # the command may have run, so it can not be sent again
+                self._session.close()
+                self._session = None
+                raise
+        finally:
+            self._session_lock.release()
+
     @staticmethod
     def check_ssh_client(ssh_client,
                          logger):
@@ -275,95 +768,602 @@ class SshClient(object):
         return True
 
 
-class SshForward(object):
-    """Represents a ssh port forwarding"""
+class CommandStream(object):
+    """
+    Output of a remote command, read as it arrives
 
-    def __init__(self, credentials):
-        self._client = SshClient(credentials['tunnel'])
-        self._remote_port = \
-            int(credentials['port']) if 'port' in credentials else 22
+    Iterating yields the stdout lines without their line break, so only the
+    chunk being split is kept in memory. Stderr is gathered apart, and both
+    it and the exit code are available once stdout has been consumed (any
+    stdout left is discarded when they are requested).
+
+    The channel wakes the reader on every data, EOF and close event, so no
+    polling cycles are needed, and it is closed on `close()` or on exiting
+    the `with` block.
+    """
+
+    def __init__(self, channel, timeout, metric_labels=None):
+        self._channel = channel
+        self._start = time.time()
+        self._deadline = self._start + timeout
+        self._stderr = bytearray()
+        self._exit_code = None
+        self._received = 0
+        self._metric_labels = metric_labels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.lines()
+
+    def chunks(self):
+        """ Yields the stdout data as it arrives """
+        channel = self._channel
+        while True:
+            # stderr must be drained too, or a full window stalls the command
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(_CHUNK_SIZE)
+                self._received += len(data)
+                self._stderr.extend(data)
+            if channel.recv_ready():
+                data = channel.recv(_CHUNK_SIZE)
+                self._received += len(data)
+                yield data
+            elif channel.eof_received or channel.closed:
+                # every data packet is buffered before the EOF one
+                if not channel.recv_stderr_ready():
+                    return
+            else:
+                remaining = self._deadline - time.time()
+                if remaining <= 0:
+                    self._timed_out()
+                select.select([channel], [], [], remaining)
+
+    def lines(self):
+        """ Yields the stdout lines as they arrive """
+        pending = ''
+        for chunk in self.chunks():
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
+    @property
+    def stderr(self):
+        self._wait()
+        return str(self._stderr)
+
+    @property
+    def exit_code(self):
+        self._wait()
+        return self._exit_code
+
+    def close(self):
+        self._channel.close()
+
+    def _wait(self):
+        if self._exit_code is not None:
+            return
+        for _ in self.chunks():
+            pass
+        # the exit status may come after the EOF, but never after close
+        if not self._channel.status_event.wait(
+                max(self._deadline - time.time(), 0)):
+            self._timed_out()
+        self._exit_code = self._channel.recv_exit_status()
+        if self._metric_labels is not None:
+            Metrics().observe(COMMAND_METRIC,
+                              time.time() - self._start,
+                              **self._metric_labels)
+            Metrics().inc(RECEIVED_METRIC,
+                          self._received,
+                          **self._metric_labels)
 
-        class SubHander(Handler):
-            chain_host = credentials['host']
-            chain_port = self._remote_port
-            ssh_transport = self._client.get_transport()
+    def _timed_out(self):
+        if self._metric_labels is not None:
+            Metrics().inc(FAILURES_METRIC,
+                          stage='command',
+                          **self._metric_labels)
+        raise socket.timeout("Remote command timed out")
 
-        self._server = ForwardServer(("", 0), SubHander)
-        self._port = self._server.server_address[1]
 
-        thread.start_new_thread(self._server.serve_forever, ())
+class _ShellSession(object):
+    """
+    Long-lived `bash -l` on an exec channel, running one command at a time
 
-    def port(self):
-        return self._port
+    Every command runs in a subshell without stdin, followed by a mark with
+    its exit code on stdout and a mark on stderr, so the streams of each
+    command can be told apart without closing the channel.
+    """
+    shell = 'bash -l -s'
+
+    def __init__(self, transport):
+        self._channel = transport.open_session()
+        self._channel.exec_command(self.shell)
+
+    def is_alive(self):
+        return not self._channel.closed and \
+            not self._channel.eof_received and \
+            not self._channel.exit_status_ready()
 
     def close(self):
-        self._server.shutdown()
+        self._channel.close()
+
+    def run(self, command, timeout):
+        """ Runs the command, returning its output and exit code """
+        mark = '#CROUPIER-' + uuid.uuid4().hex + '#'
+        self._channel.sendall('(\n' + command + '\n) </dev/null\n' +
+                              "printf '\\n%s %d\\n' " + shlex_quote(mark) +
+                              ' $?\n' +
+                              "printf '\\n%s\\n' " + shlex_quote(mark) +
+                              ' >&2\n')
+
+        stdout_end = '\n' + mark + ' '
+        stderr_end = '\n' + mark + '\n'
+        stdout = ''
+        stderr = ''
+        stdout_mark = -1
+        searched = 0
+        deadline = time.time() + timeout
+        while stdout_mark < 0 or \
+                stdout.find('\n', stdout_mark + len(stdout_end)) < 0 or \
+                not stderr.endswith(stderr_end):
+            if not self._channel.recv_ready() and \
+                    not self._channel.recv_stderr_ready():
+                if not self.is_alive():
+                    raise EOFError("Persistent shell session closed")
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("Persistent shell command timed out")
+                select.select([self._channel], [], [], min(remaining, 1))
+            while self._channel.recv_ready():
+                stdout += self._channel.recv(_CHUNK_SIZE)
+            while self._channel.recv_stderr_ready():
+                # stderr is discarded, only kept until its mark arrives
+                stderr = (stderr + self._channel.recv_stderr(_CHUNK_SIZE))[
+                    -len(stderr_end):]
+            if stdout_mark < 0:
+                stdout_mark = stdout.find(stdout_end, searched)
+                searched = max(0, len(stdout) - len(stdout_end))
+
+        exit_code = int(stdout[stdout_mark + len(stdout_end):].strip())
+        return (stdout[:stdout_mark], exit_code)
+
+
+def _batch_mark(token, index, stream):
+    return '#CROUPIER-{0}-{1}-{2}#'.format(token, index, stream)
+
+
+def _parse_batch_output(output, token, size):
+    """ Splits the framed output of `SshClient.execute_batch` """
+    results = []
+    position = 0
+    for index in range(size):
+        result = (None, None, None)
+        if output is not None:
+            out_mark = '\n' + _batch_mark(token, index, 'out') + '\n'
+            err_mark = '\n' + _batch_mark(token, index, 'err') + '\n'
+            rc_mark = '\n' + _batch_mark(token, index, 'rc') + ' '
+            out_start = output.find(out_mark, position)
+            err_start = output.find(err_mark, out_start)
+            rc_start = output.find(rc_mark, err_start)
+            if -1 not in (out_start, err_start, rc_start):
+                rc_end = output.find('\n', rc_start + len(rc_mark))
+                result = (
+                    output[out_start + len(out_mark):err_start],
+                    output[err_start + len(err_mark):rc_start],
+                    int(output[rc_start + len(rc_mark):rc_end]))
+                position = rc_end
+        results.append(result)
+    return results
+
+
+def _parse_host_facts(output):
+    """ Host facts from the `key=value` lines of `_HOST_FACTS_COMMAND` """
+    facts = {'binaries': {}, 'versions': {}}
+    for line in output.splitlines():
+        key, separator, value = line.partition('=')
+        if not separator:
+            continue
+        if key.startswith('bin.'):
+            facts['binaries'][key[4:]] = value
+        elif key.startswith('version.'):
+            facts['versions'][key[8:]] = value
+        else:
+            facts[key] = value
+    return facts
 
 
-# Following code taken from paramiko forward demo in github
-# https://github.com/paramiko/paramiko/blob/master/demos/forward.py
+class SshConnectionPool(object):
+    """
+    Process-wide pool of authenticated ssh clients
 
-class ForwardServer(SocketServer.ThreadingTCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
+    Clients are keyed by host, port, user, tunnel and shell mode, so every
+    operation and status poll against the same login node reuses the
+    transport instead of paying a new handshake each time.
+    """
+    class __SshConnectionPool(object):
+        idle_timeout = 300
+        max_connections_per_host = 10
+        checkout_timeout = 120
 
+        def __init__(self):
+            self._idle = {}
+            self._connections_per_host = {}
+            self._cond = Condition()
 
-class Handler(SocketServer.BaseRequestHandler):
+        def acquire(self, credentials):
+            """ Checks out a live client, connecting only if needed """
+            key = self._get_key(credentials)
+            host = key[0]
+            deadline = time.time() + self.checkout_timeout
+            with self._cond:
+                while True:
+                    self._close_expired()
+                    idle = self._idle.get(key, [])
+                    while idle:
+                        ssh_client, _ = idle.pop()
+                        if ssh_client.is_active():
+                            return ssh_client
+                        self._discard(ssh_client)
 
-    def handle(self):
+                    if self._connections_per_host.get(host, 0) < \
+                            self.max_connections_per_host or \
+                            self._evict_idle(host):
+                        # reserve the slot before connecting
+                        self._connections_per_host[host] = \
+                            self._connections_per_host.get(host, 0) + 1
+                        break
+
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ssh_exception.SSHException(
+                            "Timed out waiting for a free ssh connection "
+                            "to " + host)
+                    self._cond.wait(remaining)
+
+            try:
+                ssh_client = SshClient(credentials)
+            except Exception:
+                with self._cond:
+                    self._connections_per_host[host] -= 1
+                    self._cond.notify()
+                raise
+            ssh_client._pool_key = key
+            return ssh_client
+
+        def release(self, ssh_client):
+            """ Returns a client to the pool, closing it if it is dead """
+            key = getattr(ssh_client, '_pool_key', None)
+            if key is None:
+                ssh_client.close_connection()
+                return
+            with self._cond:
+                if ssh_client.is_active():
+                    self._idle.setdefault(key, []).append(
+                        (ssh_client, time.time()))
+                else:
+                    self._discard(ssh_client)
+                self._cond.notify()
+
+        @contextmanager
+        def connection(self, credentials):
+            """ Context manager that acquires and releases a client """
+            ssh_client = self.acquire(credentials)
+            try:
+                yield ssh_client
+            finally:
+                self.release(ssh_client)
+
+        def close_all(self):
+            """ Closes every idle client of the pool """
+            with self._cond:
+                for key in list(self._idle):
+                    for ssh_client, _ in self._idle.pop(key):
+                        self._discard(ssh_client)
+                self._cond.notify_all()
+
+        @classmethod
+        def _get_key(cls, credentials):
+            tunnel = None
+            if 'tunnel' in credentials and credentials['tunnel']:
+                tunnel = cls._get_key(credentials['tunnel'])
+            return (credentials['host'],
+                    int(credentials['port']) if 'port' in credentials
+                    else 22,
+                    credentials.get('user'),
+                    tunnel,
+                    bool(credentials.get('login_shell', False)),
+                    bool(credentials.get('persistent_session', False)))
+
+        def _discard(self, ssh_client):
+            # must be called holding the lock
+            host = ssh_client._pool_key[0]
+            self._connections_per_host[host] -= 1
+            try:
+                ssh_client.close_connection()
+            except Exception:  # pylint: disable=W0703
+                pass
+
+        def _close_expired(self):
+            # must be called holding the lock
+            limit = time.time() - self.idle_timeout
+            for key, idle in self._idle.items():
+                alive = [entry for entry in idle if entry[1] >= limit]
+                for ssh_client, last_used in idle:
+                    if last_used < limit:
+                        self._discard(ssh_client)
+                self._idle[key] = alive
+
+        def _evict_idle(self, host):
+            # frees a slot closing the oldest idle client of other keys
+            oldest = None
+            for key, idle in self._idle.items():
+                if key[0] == host and idle and \
+                        (oldest is None or idle[0][1] < oldest[1][0][1]):
+                    oldest = (key, idle)
+            if oldest is None:
+                return False
+            ssh_client, _ = oldest[1].pop(0)
+            self._discard(ssh_client)
+            return True
+
+    instance = None
+
+    def __init__(self):
+        if not SshConnectionPool.instance:
+            SshConnectionPool.instance = \
+                SshConnectionPool.__SshConnectionPool()
+            atexit.register(SshConnectionPool.instance.close_all)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+class SshFuture(object):
+    """
+    Pending result of an `SshExecutor` operation
+
+    `get` waits for it, raising `multiprocessing.TimeoutError` if the
+    timeout expires first and re-raising the errors of the operation.
+    Operations still queued can be cancelled, `get` returns None for them.
+    """
+
+    def __init__(self, pool, function, args, kwargs):
+        self._lock = Lock()
+        self._state = 'PENDING'
+        self._callbacks = []
+        self._result = pool.apply_async(with_operation(self._run),
+                                        (function, args, kwargs))
+
+    def _run(self, function, args, kwargs):
+        with self._lock:
+            if self._state == 'CANCELLED':
+                return None
+            self._state = 'RUNNING'
         try:
-            chan = self.ssh_transport.open_channel(
-                "direct-tcpip",
-                (self.chain_host, self.chain_port),
-                self.request.getpeername(),
-            )
-        except Exception as e:
-            verbose(
-                "Incoming request to %s:%d failed: %s"
-                % (self.chain_host, self.chain_port, repr(e))
-            )
-            return
-        if chan is None:
-            verbose(
-                "Incoming request to %s:%d was rejected by the SSH server."
-                % (self.chain_host, self.chain_port)
-            )
-            return
+            return function(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._state = 'FINISHED'
+            self._run_callbacks()
 
-        # verbose(
-        #     "Connected!  Tunnel open %r -> %r -> %r"
-        #     % (
-        #         self.request.getpeername(),
-        #         chan.getpeername(),
-        #         (self.chain_host, self.chain_port),
-        #     )
-        # )
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
+    def _run_callbacks(self):
+        with self._lock:
+            callbacks = self._callbacks
+            self._callbacks = None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Calls `callback(future)` once the operation finishes or is
+        cancelled, right away if it already did. It is called from the
+        worker thread, just before the result can be got.
+        """
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        """ Cancels the operation if it did not start, returns if it did """
+        with self._lock:
+            if self._state != 'PENDING':
+                return self._state == 'CANCELLED'
+            self._state = 'CANCELLED'
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == 'CANCELLED'
+
+    def done(self):
+        return self.cancelled() or self._result.ready()
+
+    def get(self, timeout=None):
+        if self.cancelled():
+            return None
+        return self._result.get(timeout)
+
+
+class SshExecutor(object):
+    """
+    Runs ssh operations in the background, on pooled connections
+
+    Every method returns an `SshFuture` right away, so many hosts can be
+    reached at the same time from one thread while the blocking API of
+    `SshClient` is kept. At most `max_workers` operations run at once.
+    """
+    class __SshExecutor(object):
+        max_workers = 16
+
+        def __init__(self):
+            self._pool = None
+            self._lock = Lock()
+
+        def submit(self, function, *args, **kwargs):
+            """ Runs any function in the background """
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(processes=self.max_workers)
+                return SshFuture(self._pool, function, args, kwargs)
+
+        def connect(self, credentials):
+            """ Opens a pooled connection ahead of its use """
+            return self.submit(self._connect, credentials)
+
+        def run(self, credentials, cmd, workdir=None, env=None):
+            """ Future of the (output, exit_code) of a command """
+            return self.submit(self._with_client,
+                               credentials,
+                               'execute_shell_command',
+                               cmd,
+                               workdir=workdir,
+                               env=env,
+                               wait_result=True)
+
+        def run_batch(self,
+                      credentials,
+                      cmds,
+                      workdir=None,
+                      env=None,
+                      stop_on_error=False):
+            """ Future of the results of `SshClient.execute_batch` """
+            return self.submit(self._with_client,
+                               credentials,
+                               'execute_batch',
+                               cmds,
+                               workdir=workdir,
+                               env=env,
+                               stop_on_error=stop_on_error)
+
+        def upload(self, credentials, files, workdir=None):
+            """ Future of `SshClient.put_files` """
+            return self.submit(self._with_client,
+                               credentials,
+                               'put_files',
+                               files,
+                               workdir=workdir)
+
+        def close(self):
+            """ Stops the workers, dropping the operations not started """
+            with self._lock:
+                if self._pool is not None:
+                    self._pool.terminate()
+                    self._pool = None
+
+        @staticmethod
+        def _connect(credentials):
+            with SshConnectionPool().connection(credentials):
+                return True
+
+        @staticmethod
+        def _with_client(credentials, method, *args, **kwargs):
+            with SshConnectionPool().connection(credentials) as ssh_client:
+                return getattr(ssh_client, method)(*args, **kwargs)
+
+    instance = None
+
+    def __init__(self):
+        if not SshExecutor.instance:
+            SshExecutor.instance = SshExecutor.__SshExecutor()
+            atexit.register(SshExecutor.instance.close)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+class SshTunnelManager(object):
+    """
+    Process-wide registry of jump host connections
+
+    One authenticated transport is kept per jump host, and every tunnelled
+    connection opens its own `direct-tcpip` channel on it. Jump hosts are
+    reference counted, and closed when their last channel is released.
+    """
+    class __SshTunnelManager(object):
+        def __init__(self):
+            # key -> [ssh_client, references]
+            self._bastions = {}
+            # reentrant, as jump hosts may be reached through other ones
+            self._lock = RLock()
+
+        def open_channel(self, credentials, host, port):
+            """
+            Opens a channel to host:port through the jump host described by
+            credentials, that must be released when it is closed
+            """
+            key = self._get_key(credentials)
+            with self._lock:
+                bastion = self._bastions.get(key)
+                if bastion is None:
+                    bastion = [SshClient(credentials), 0]
+                    self._bastions[key] = bastion
+                elif not bastion[0].get_transport() or \
+                        not bastion[0].get_transport().is_active():
+                    # the channels on the dead transport are lost anyway
+                    bastion[0].close_connection()
+                    bastion[0] = SshClient(credentials)
                 try:
-                    data = self.request.recv(1024)
-                except socket.error as err:
-                    data = bytes('')
-                    logging.getLogger("paramiko").\
-                        warning("Waiting for data: " + str(err))
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-
-        # peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        # verbose("Tunnel closed from %r" % (peername,))
-
-
-def verbose(s):
-    print(s)
+                    channel = bastion[0].get_transport().open_channel(
+                        'direct-tcpip', (host, port), ('127.0.0.1', 0))
+                except Exception:
+                    if bastion[1] == 0:
+                        del self._bastions[key]
+                        bastion[0].close_connection()
+                    raise
+                bastion[1] += 1
+                return channel
+
+        def release(self, credentials):
+            """ Releases a channel, closing the jump host if unused """
+            key = self._get_key(credentials)
+            with self._lock:
+                bastion = self._bastions.get(key)
+                if bastion is None:
+                    return
+                bastion[1] -= 1
+                if bastion[1] <= 0:
+                    del self._bastions[key]
+                    bastion[0].close_connection()
+
+        def close_all(self):
+            """ Closes every jump host connection """
+            with self._lock:
+                bastions = self._bastions.values()
+                self._bastions = {}
+            for ssh_client, _ in bastions:
+                ssh_client.close_connection()
+
+        @classmethod
+        def _get_key(cls, credentials):
+            tunnel = None
+            if 'tunnel' in credentials and credentials['tunnel']:
+                tunnel = cls._get_key(credentials['tunnel'])
+            return (credentials['host'],
+                    int(credentials['port']) if 'port' in credentials
+                    else 22,
+                    credentials.get('user'),
+                    tunnel)
+
+    instance = None
+
+    def __init__(self):
+        if not SshTunnelManager.instance:
+            SshTunnelManager.instance = \
+                SshTunnelManager.__SshTunnelManager()
+            atexit.register(SshTunnelManager.instance.close_all)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
 
 
 def get_host_port(spec, default_port):
@@ -0,0 +1,247 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+state_store.py: Timeline of the job states, kept on the manager
+'''
+
+
+import errno
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+DEFAULT_PATH = '~/.croupier/job_states.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transitions (
+    deployment TEXT NOT NULL,
+    execution TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    name TEXT NOT NULL,
+    job_id TEXT,
+    state TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_deployment
+    ON transitions (deployment, at);
+CREATE INDEX IF NOT EXISTS transitions_execution
+    ON transitions (execution, at);
+"""
+
+Transition = namedtuple('Transition', ['deployment',
+                                       'execution',
+                                       'instance',
+                                       'name',
+                                       'job_id',
+                                       'state',
+                                       'at'])
+
+
+def _connect(path):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    db = sqlite3.connect(path, timeout=30)
+    # readers do not block the executions that write
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(_SCHEMA)
+    return db
+
+
+class StateStore(object):
+    """
+    Records every state change of the job instances, with its time, in a
+    SQLite file of the manager
+
+    Recording only queues the change, so the monitor loop never waits for
+    the disk: a writer thread commits the queued changes in batches, every
+    `flush_period` seconds or `batch_size` changes. The timeline can be
+    queried by deployment or execution and time range, also by other
+    processes, and the last states of an execution are kept to resume it.
+    """
+    class __StateStore(object):
+        flush_period = 1
+        batch_size = 500
+
+        def __init__(self):
+            self.path = None
+            self._queue = Queue()
+            self._lock = Lock()
+            self._stopped = Event()
+            self._writer = None
+
+        def open(self, path=DEFAULT_PATH):
+            """ Starts recording the changes in the file """
+            self.close()
+            with self._lock:
+                self.path = os.path.expanduser(path)
+                _connect(self.path).close()
+                self._stopped.clear()
+                self._writer = Thread(target=self._write)
+                self._writer.daemon = True
+                self._writer.start()
+
+        def is_open(self):
+            return self._writer is not None
+
+        def record(self,
+                   deployment,
+                   execution,
+                   instance,
+                   name,
+                   job_id,
+                   state,
+                   at=None):
+            """ Queues the state change, if the store is open """
+            if self._writer is None:
+                return
+            self._queue.put(Transition(deployment,
+                                       execution,
+                                       instance,
+                                       name,
+                                       job_id,
+                                       state,
+                                       time.time() if at is None else at))
+
+        def flush(self):
+            """ Waits until the queued changes are written """
+            if self._writer is not None:
+                self._queue.join()
+
+        def close(self):
+            """ Writes the queued changes and stops recording """
+            with self._lock:
+                writer = self._writer
+                if writer is None:
+                    return
+                self._writer = None
+                self._stopped.set()
+            writer.join()
+
+        def timeline(self,
+                     deployment=None,
+                     execution=None,
+                     since=None,
+                     until=None,
+                     path=None):
+            """
+            State changes of a deployment or execution, oldest first
+
+            @type since: float
+            @param since: first time included, all the history if None
+            @type until: float
+            @param until: first time excluded, up to now if None
+            @rtype list
+            @return the Transition tuples of the changes
+            """
+            conditions = []
+            params = []
+            for column, value in [('deployment', deployment),
+                                  ('execution', execution)]:
+                if value is not None:
+                    conditions.append(column + " = ?")
+                    params.append(value)
+            if since is not None:
+                conditions.append("at >= ?")
+                params.append(since)
+            if until is not None:
+                conditions.append("at < ?")
+                params.append(until)
+            query = "SELECT * FROM transitions"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            return self._query(query + " ORDER BY at, rowid", params, path)
+
+        def last_states(self, execution, path=None):
+            """ Last state of every instance of the execution, by instance """
+            return dict((transition.instance, transition)
+                        for transition in self._query(
+                            "SELECT * FROM transitions WHERE execution = ? "
+                            "ORDER BY at, rowid",
+                            (execution,),
+                            path))
+
+        def _query(self, query, params, path):
+            db = _connect(os.path.expanduser(path or self.path or
+                                             DEFAULT_PATH))
+            try:
+                return [Transition(*row)
+                        for row in db.execute(query, params)]
+            finally:
+                db.close()
+
+        def _write(self):
+            db = _connect(self.path)
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch:
+                        try:
+                            with db:
+                                db.executemany(
+                                    "INSERT INTO transitions "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    batch)
+                        except sqlite3.Error as err:
+                            # the history is lost, but not the execution
+                            logging.getLogger(__name__).warning(
+                                "Cannot record %d job states: %s",
+                                len(batch), err)
+                        for _ in batch:
+                            self._queue.task_done()
+                    elif self._stopped.is_set():
+                        return
+            finally:
+                db.close()
+
+        def _next_batch(self):
+            """ Changes queued for the next flush period, up to the batch
+            size """
+            batch = []
+            deadline = time.time() + self.flush_period
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    if self._stopped.is_set() or remaining <= 0:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            return batch
+
+    instance = None
+
+    def __init__(self):
+        if not StateStore.instance:
+            StateStore.instance = StateStore.__StateStore()
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
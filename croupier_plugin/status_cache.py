@@ -0,0 +1,213 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+status_cache.py: Job states shared by the executions of the manager
+'''
+
+
+import errno
+import os
+import sqlite3
+import time
+from threading import Lock
+
+DEFAULT_PATH = '~/.croupier/status_cache.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (
+    host TEXT NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    state TEXT,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (host, user, name)
+);
+CREATE TABLE IF NOT EXISTS watched (
+    host TEXT NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (host, user, name)
+);
+"""
+
+
+class StatusCache(object):
+    """
+    Last states of the jobs of every host, shared through a SQLite file by
+    all the executions that run on the manager
+
+    Executions register the jobs they watch on each host. The one that
+    polls a host asks for the jobs of every execution, so the rest find
+    their states fresh in the cache and skip their polls until their
+    period passes. Jobs whose states are read from a workdir are only
+    shared with the executions that set the same `scope`.
+    """
+    # seconds the finished jobs are kept
+    ttl = 86400
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+        self._db = None
+        self._lock = Lock()
+
+    def get(self, host, settings, now=None):
+        """
+        States of the jobs of the host polled less than a period ago,
+        registering them as watched. None if any is not fresh.
+        """
+        now = time.time() if now is None else now
+        host, user = _key(host, settings)
+        ids = settings.get('ids') or {}
+        # watched for a couple of checks of their execution
+        expires = now + 2 * max(settings['period'],
+                                settings.get('max_period', 0))
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO watched VALUES (?, ?, ?, ?, ?)",
+                [(host, user, name, ids.get(name) or '', expires)
+                 for name in settings['names']])
+            rows = dict((row[0], row[1:]) for row in db.execute(
+                "SELECT name, job_id, state FROM states "
+                "WHERE host = ? AND user = ? AND fetched > ?",
+                (host, user, now - settings['period'])))
+
+        states = {}
+        for name in settings['names']:
+            if name not in rows:
+                return None
+            job_id, state = rows[name]
+            # a job with the same name submitted earlier is not the one
+            if job_id and ids.get(name) and job_id != ids[name]:
+                return None
+            if state is not None:
+                states[name] = state
+        return states
+
+    def shared_settings(self, host, settings, now=None):
+        """ Settings to poll the jobs watched by every execution, that
+        still know the jobs of the execution that polls as `owned` """
+        now = time.time() if now is None else now
+        host, user = _key(host, settings)
+        names = list(settings['names'])
+        ids = dict(settings.get('ids') or {})
+        with self._connect() as db:
+            for name, job_id in db.execute(
+                    "SELECT name, job_id FROM watched "
+                    "WHERE host = ? AND user = ? AND expires > ?",
+                    (host, user, now)):
+                if name not in names:
+                    names.append(name)
+                    if job_id:
+                        ids[name] = job_id
+        return dict(settings,
+                    names=names,
+                    ids=ids,
+                    owned=list(settings['names']))
+
+    def put(self, host, settings, states, now=None):
+        """ Keeps the polled states, also of the jobs of the execution
+        that polls not found. The jobs of the rest not found may not have
+        been submitted yet, so they are left for them to poll. """
+        now = time.time() if now is None else now
+        host, user = _key(host, settings)
+        ids = settings.get('ids') or {}
+        owned = settings.get('owned', settings['names'])
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?, ?)",
+                [(host, user, name, ids.get(name) or '', states.get(name),
+                  now)
+                 for name in settings['names']
+                 if name in states or name in owned])
+            db.executemany(
+                "DELETE FROM states WHERE host = ? AND user = ? AND name = ?",
+                [(host, user, name) for name in settings['names']
+                 if name not in states and name not in owned])
+            db.execute("DELETE FROM states WHERE fetched < ?",
+                       (now - self.ttl,))
+            db.execute("DELETE FROM watched WHERE expires < ?", (now,))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _connect(self):
+        """ Connection to use as a transaction context, held locked """
+        return _Transaction(self)
+
+    def _open(self):
+        # must be called holding the lock
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            try:
+                os.makedirs(directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            self._db = sqlite3.connect(self.path,
+                                       timeout=30,
+                                       check_same_thread=False)
+            # readers do not block the executions that poll
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+
+def _key(host, settings):
+    """ Host, with the scope of its states if any, and user the jobs run
+    as """
+    config = settings['config']
+    host += ':' + str(config.get('port', 22))
+    if settings.get('scope'):
+        host += ':' + settings['scope']
+    return (host, config.get('user', ''))
+
+
+class _Transaction(object):
+    """ Connection of the cache, committed on success """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __enter__(self):
+        self._cache._lock.acquire()
+        try:
+            self._db = self._cache._open()
+        except Exception:
+            self._cache._lock.release()
+            raise
+        return self._db
+
+    def __exit__(self, error_type, error, traceback):
+        try:
+            if error_type is None:
+                self._db.commit()
+            else:
+                self._db.rollback()
+        finally:
+            self._cache._lock.release()
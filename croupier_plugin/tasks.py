@@ -25,17 +25,28 @@ tasks.py: Holds the plugin tasks
 '''
 
 
+import os
 import traceback
 import requests
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
 
-from croupier_plugin.ssh import SshClient
-from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+from croupier_plugin.monitor_agent import AGENT_FILE
+from croupier_plugin.ssh import SshClient, SshConnectionPool
+from croupier_plugin.workload_managers.workload_manager import (
+    COMPLETION_FILE,
+    WorkloadManager)
 from croupier_plugin.external_repositories.external_repository import (
     ExternalRepository)
 
+# Command that must be available for each workload manager
+_SUBMISSION_COMMANDS = {'SLURM': 'sbatch', 'TORQUE': 'qsub'}
+
+# source of the monitoring agent uploaded to the workdirs
+_AGENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'monitor_agent.py')
+
 
 @operation
 def preconfigure_wm(
@@ -86,6 +97,16 @@ def preconfigure_wm(
         ctx.logger.warning('Workload manager simulated')
 
 
+def _get_job_credentials():
+    """ Credentials of the job, reusing the host facts gathered when the
+    workload manager was configured """
+    credentials = ctx.instance.runtime_properties['credentials']
+    SshClient.cache_host_facts(
+        credentials,
+        ctx.instance.runtime_properties.get('host_facts'))
+    return credentials
+
+
 @operation
 def configure_execution(
         config,
@@ -93,6 +114,7 @@ def configure_execution(
         base_dir,
         workdir_prefix,
         simulate,
+        monitor_agent=False,
         **kwargs):  # pylint: disable=W0613
     """ Creates the working directory for the execution """
     ctx.logger.info('Connecting to workload manager..')
@@ -110,34 +132,41 @@ def configure_execution(
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
         try:
-            client = SshClient(credentials)
+            client = SshConnectionPool().acquire(credentials)
         except Exception as exp:
             raise NonRecoverableError(
                 "Failed trying to connect to workload manager: " + str(exp))
 
-        # TODO: use command according to wm
-        _, exit_code = client.execute_shell_command(
-            'uname',
-            wait_result=True)
-
-        if exit_code != 0:
-            client.close_connection()
-            raise NonRecoverableError(
-                "Failed executing on the workload manager: exit code " +
-                str(exit_code))
-
-        ctx.instance.runtime_properties['login'] = exit_code == 0
-
-        prefix = workdir_prefix
-        if workdir_prefix == "":
-            prefix = ctx.blueprint.id
-
-        workdir = wm.create_new_workdir(client, base_dir, prefix, ctx.logger)
-        client.close_connection()
-        if workdir is None:
-            raise NonRecoverableError(
-                "failed to create the working directory, base dir: " +
-                base_dir)
+        try:
+            # gathering the host facts also checks that commands can be run,
+            # they are kept so later operations skip the discovery
+            facts = client.get_host_facts()
+            if facts is None:
+                raise NonRecoverableError(
+                    "Failed executing on the workload manager")
+            if wm_type in _SUBMISSION_COMMANDS and \
+                    _SUBMISSION_COMMANDS[wm_type] not in facts['binaries']:
+                ctx.logger.warning("'" + _SUBMISSION_COMMANDS[wm_type] +
+                                   "' not found in the workload manager path")
+
+            ctx.instance.runtime_properties['login'] = True
+            ctx.instance.runtime_properties['host_facts'] = facts
+
+            prefix = workdir_prefix
+            if workdir_prefix == "":
+                prefix = ctx.blueprint.id
+
+            workdir = wm.create_new_workdir(client, base_dir, prefix,
+                                            ctx.logger)
+            if workdir is None:
+                raise NonRecoverableError(
+                    "failed to create the working directory, base dir: " +
+                    base_dir)
+            if monitor_agent:
+                with open(_AGENT_SCRIPT) as agent:
+                    client.put_file(agent, AGENT_FILE, workdir=workdir)
+        finally:
+            SshConnectionPool().release(client)
         ctx.instance.runtime_properties['workdir'] = workdir
         ctx.logger.info('..workload manager ready to be used on ' + workdir)
     else:
@@ -171,11 +200,10 @@ def cleanup_execution(
 
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
-        client = SshClient(credentials)
-        client.execute_shell_command(
-            'rm -r ' + workdir,
-            wait_result=True)
-        client.close_connection()
+        with SshConnectionPool().connection(credentials) as client:
+            client.execute_shell_command(
+                'rm -r ' + workdir,
+                wait_result=True)
         ctx.logger.info('..all clean.')
     else:
         ctx.logger.warning('clean up simulated.')
@@ -290,6 +318,10 @@ def preconfigure_job(
         job_prefix,
         monitor_period,
         simulate,
+        monitor_min_period=None,
+        monitor_max_period=None,
+        monitor_events=False,
+        monitor_agent=False,
         **kwargs):  # pylint: disable=W0613
     """ Match the job with its credentials """
     ctx.logger.info('Preconfiguring job..')
@@ -314,9 +346,18 @@ def preconfigure_job(
     ctx.source.instance.runtime_properties['simulate'] = simulate
     ctx.source.instance.runtime_properties['job_prefix'] = job_prefix
     ctx.source.instance.runtime_properties['monitor_period'] = monitor_period
+    ctx.source.instance.runtime_properties['monitor_min_period'] = \
+        monitor_min_period if monitor_min_period else monitor_period
+    ctx.source.instance.runtime_properties['monitor_max_period'] = \
+        monitor_max_period if monitor_max_period else monitor_period
+    ctx.source.instance.runtime_properties['monitor_events'] = monitor_events
+    ctx.source.instance.runtime_properties['monitor_agent'] = monitor_agent
 
     ctx.source.instance.runtime_properties['workdir'] = \
         ctx.target.instance.runtime_properties['workdir']
+    if 'host_facts' in ctx.target.instance.runtime_properties:
+        ctx.source.instance.runtime_properties['host_facts'] = \
+            ctx.target.instance.runtime_properties['host_facts']
 
 
 @operation
@@ -333,7 +374,7 @@ def bootstrap_job(
 
     if not simulate and 'bootstrap' in deployment:
         inputs = deployment['inputs'] if 'inputs' in deployment else []
-        credentials = ctx.instance.runtime_properties['credentials']
+        credentials = _get_job_credentials()
         workdir = ctx.instance.runtime_properties['workdir']
         name = "bootstrap_" + ctx.instance.id + ".sh"
         wm_type = ctx.instance.runtime_properties['workload_manager']
@@ -370,7 +411,7 @@ def revert_job(deployment, skip_cleanup, **kwarsgs):  # pylint: disable=W0613
 
         if not simulate and 'revert' in deployment:
             inputs = deployment['inputs'] if 'inputs' in deployment else []
-            credentials = ctx.instance.runtime_properties['credentials']
+            credentials = _get_job_credentials()
             workdir = ctx.instance.runtime_properties['workdir']
             name = "revert_" + ctx.instance.id + ".sh"
             wm_type = ctx.instance.runtime_properties['workload_manager']
@@ -417,38 +458,37 @@ def deploy_job(script,
 
     # Execute the script and manage the output
     success = False
-    client = SshClient(credentials)
-    if wm._create_shell_script(client,
-                               name,
-                               ctx.get_resource(script),
-                               logger,
-                               workdir=workdir):
-        call = "./" + name
-        for dinput in inputs:
-            str_input = str(dinput)
-            if ('\n' in str_input or ' ' in str_input) and str_input[0] != '"':
-                call += ' "' + str_input + '"'
+    with SshConnectionPool().connection(credentials) as client:
+        if wm._create_shell_script(client,
+                                   name,
+                                   ctx.get_resource(script),
+                                   logger,
+                                   workdir=workdir):
+            call = "./" + name
+            for dinput in inputs:
+                str_input = str(dinput)
+                if ('\n' in str_input or ' ' in str_input) and \
+                        str_input[0] != '"':
+                    call += ' "' + str_input + '"'
+                else:
+                    call += ' ' + str_input
+            calls = [call]
+            if not skip_cleanup:
+                calls.append("rm " + name)
+            # the script and its removal are sent in one round trip
+            results = client.execute_batch(calls, workdir=workdir)
+
+            exit_code = results[0][2]
+            if exit_code != 0:
+                logger.warning(
+                    "failed to deploy job: call '" + call + "', exit code " +
+                    str(exit_code))
             else:
-                call += ' ' + str_input
-        _, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        if exit_code != 0:
-            logger.warning(
-                "failed to deploy job: call '" + call + "', exit code " +
-                str(exit_code))
-        else:
-            success = True
+                success = True
 
-        if not skip_cleanup:
-            if not client.execute_shell_command(
-                    "rm " + name,
-                    workdir=workdir):
+            if not skip_cleanup and results[1][2] != 0:
                 logger.warning("failed removing bootstrap script")
 
-    client.close_connection()
-
     return success
 
 
@@ -464,11 +504,10 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
     if not simulate:
         workdir = ctx.instance.runtime_properties['workdir']
         wm_type = ctx.instance.runtime_properties['workload_manager']
-        client = SshClient(ctx.instance.runtime_properties['credentials'])
+        credentials = _get_job_credentials()
 
         wm = WorkloadManager.factory(wm_type)
         if not wm:
-            client.close_connection()
             raise NonRecoverableError(
                 "Workload Manager '" +
                 wm_type +
@@ -477,14 +516,18 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
             'CFY_EXECUTION_ID': ctx.execution_id,
             'CFY_JOB_NAME': name
         }
-        is_submitted = wm.submit_job(client,
-                                     name,
-                                     job_options,
-                                     is_singularity,
-                                     ctx.logger,
-                                     workdir=workdir,
-                                     context=context_vars)
-        client.close_connection()
+        completion_file = None
+        if ctx.instance.runtime_properties.get('monitor_events'):
+            completion_file = workdir + '/' + COMPLETION_FILE
+        with SshConnectionPool().connection(credentials) as client:
+            is_submitted = wm.submit_job(client,
+                                         name,
+                                         job_options,
+                                         is_singularity,
+                                         ctx.logger,
+                                         workdir=workdir,
+                                         context=context_vars,
+                                         completion_file=completion_file)
     else:
         ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
         is_submitted = True
@@ -498,6 +541,10 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
             'Job ' + name + ' (' + ctx.instance.id + ') not sent.')
 
     ctx.instance.runtime_properties['job_name'] = name
+    # the id is used to monitor and stop the job, when the wm gives one
+    job_id = is_submitted if isinstance(is_submitted, basestring) else None
+    ctx.instance.runtime_properties['job_id'] = job_id
+    return job_id
 
 
 @operation
@@ -520,23 +567,21 @@ def cleanup_job(job_options, skip, **kwargs):  # pylint: disable=W0613
             workdir = ctx.instance.runtime_properties['workdir']
             wm_type = ctx.instance.runtime_properties['workload_manager']
 
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
+            credentials = _get_job_credentials()
 
             wm = WorkloadManager.factory(wm_type)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError(
                     "Workload Manager '" +
                     wm_type +
                     "' not supported.")
-            is_clean = wm.clean_job_aux_files(client,
-                                              name,
-                                              job_options,
-                                              is_singularity,
-                                              ctx.logger,
-                                              workdir=workdir)
-
-            client.close_connection()
+            with SshConnectionPool().connection(credentials) as client:
+                is_clean = wm.clean_job_aux_files(client,
+                                                  name,
+                                                  job_options,
+                                                  is_singularity,
+                                                  ctx.logger,
+                                                  workdir=workdir)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_clean = True
@@ -570,23 +615,23 @@ def stop_job(job_options, **kwargs):  # pylint: disable=W0613
         if not simulate:
             workdir = ctx.instance.runtime_properties['workdir']
             wm_type = ctx.instance.runtime_properties['workload_manager']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
+            credentials = _get_job_credentials()
 
             wm = WorkloadManager.factory(wm_type)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError(
                     "Workload Manager '" +
                     wm_type +
                     "' not supported.")
-            is_stopped = wm.stop_job(client,
-                                     name,
-                                     job_options,
-                                     is_singularity,
-                                     ctx.logger,
-                                     workdir=workdir)
-
-            client.close_connection()
+            with SshConnectionPool().connection(credentials) as client:
+                is_stopped = wm.stop_job(
+                    client,
+                    name,
+                    job_options,
+                    is_singularity,
+                    ctx.logger,
+                    workdir=workdir,
+                    job_id=ctx.instance.runtime_properties.get('job_id'))
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_stopped = True
@@ -622,21 +667,19 @@ def publish(publish_list, **kwargs):
         published = True
         if not simulate:
             workdir = ctx.instance.runtime_properties['workdir']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
-
-            for publish_item in publish_list:
-                if not published:
-                    break
-                exrep = ExternalRepository.factory(publish_item)
-                if not exrep:
-                    client.close_connection()
-                    raise NonRecoverableError(
-                        "External repository '" +
-                        publish_item['dataset']['type'] +
-                        "' not supported.")
-                published = exrep.publish(client, ctx.logger, workdir)
-
-            client.close_connection()
+            credentials = _get_job_credentials()
+
+            with SshConnectionPool().connection(credentials) as client:
+                for publish_item in publish_list:
+                    if not published:
+                        break
+                    exrep = ExternalRepository.factory(publish_item)
+                    if not exrep:
+                        raise NonRecoverableError(
+                            "External repository '" +
+                            publish_item['dataset']['type'] +
+                            "' not supported.")
+                    published = exrep.publish(client, ctx.logger, workdir)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
 
@@ -0,0 +1,116 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+fake_hpc.py: Local ssh server emulating a Slurm / Torque login node
+'''
+
+
+import json
+import os
+import sys
+import time
+
+from croupier_plugin.tests import fake_scheduler
+from croupier_plugin.tests.ssh_server import LocalSshServer
+
+_SCHEDULER_SCRIPT = os.path.abspath(
+    os.path.splitext(fake_scheduler.__file__)[0] + '.py')
+
+
+class FakeHpc(LocalSshServer):
+    """
+    Local ssh server with fake `sbatch`, `srun`, `sacct`, `squeue`,
+    `scancel`, `qsub`, `qselect`, `qstat` and `qdel` commands
+
+    The workdir acts as the cluster filesystem and jobs are scheduled by
+    `fake_scheduler`. Queue wait, runtime and command latency accept a
+    constant in seconds, a `[low, high]` uniform range or an
+    `{'exponential': mean}` spec. Jobs are not run unless `execute` is set,
+    in which case their scripts run in the workdir once their queue wait is
+    over and they end when the scripts do.
+    """
+
+    def __init__(self,
+                 workdir=None,
+                 latency=0.0,
+                 command_latency=0,
+                 queue_wait=0,
+                 runtime=0,
+                 failure_rate=0.0,
+                 execute=False,
+                 seed=None):
+        super(FakeHpc, self).__init__(workdir, latency)
+        self.state_dir = os.path.abspath(os.path.join(self.workdir,
+                                                      '.fakehpc'))
+        self.config = {'command_latency': command_latency,
+                       'queue_wait': queue_wait,
+                       'runtime': runtime,
+                       'failure_rate': failure_rate,
+                       'execute': execute,
+                       'seed': seed}
+
+    def start(self):
+        """ Installs the scheduler commands and starts the ssh server """
+        bin_dir = os.path.join(self.state_dir, 'bin')
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+        for command in fake_scheduler.COMMANDS:
+            path = os.path.join(bin_dir, command)
+            with open(path, 'w') as script:
+                script.write('#!/bin/sh\nexec "{0}" "{1}" "{2}" {3} "$@"\n'
+                             .format(sys.executable,
+                                     _SCHEDULER_SCRIPT,
+                                     self.state_dir,
+                                     command))
+            os.chmod(path, 0o755)
+        self.configure()
+        db = fake_scheduler.connect(self.state_dir)
+        # readers do not block the submissions
+        db.execute("PRAGMA journal_mode=WAL")
+        db.close()
+
+        self.environment['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        return super(FakeHpc, self).start()
+
+    def configure(self, **settings):
+        """ Changes the scheduler settings, for the next submitted jobs """
+        self.config.update(settings)
+        with open(os.path.join(self.state_dir, 'config.json'), 'w') as config:
+            json.dump(self.config, config)
+
+    def jobs(self, name=None):
+        """ Jobs submitted so far, as dictionaries with their current state """
+        db = fake_scheduler.connect(self.state_dir)
+        query = "SELECT * FROM jobs"
+        params = ()
+        if name is not None:
+            query += " WHERE name = ?"
+            params = (name,)
+        now = time.time()
+        jobs = []
+        for row in db.execute(query + " ORDER BY id", params):
+            job = dict(zip(row.keys(), row))
+            job['state'] = fake_scheduler.job_state(row, now)
+            jobs.append(job)
+        db.close()
+        return jobs
@@ -0,0 +1,251 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+fake_hpc_tests.py: Holds the workload managers tests against a fake HPC
+'''
+
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from croupier_plugin.ssh import SshClient, SshConnectionPool, _probe_cache
+from croupier_plugin.tests.fake_hpc import FakeHpc
+from croupier_plugin.workload_managers import slurm
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+
+
+class TestFakeHpc(unittest.TestCase):
+    """ Holds the Slurm and Torque lifecycle tests over ssh """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = FakeHpc(self.workdir, queue_wait=0.5, runtime=0.5)
+        self.server.start()
+        self.client = SshClient(self.server.credentials())
+        self.logger = logging.getLogger('TestFakeHpc')
+        with open(os.path.join(self.workdir, 'job.sh'), 'w') as script:
+            script.write('echo done > $1.result\n')
+
+    def tearDown(self):
+        self.client.close_connection()
+        SshConnectionPool().close_all()
+        self.server.stop()
+        _probe_cache.invalidate()
+        slurm._history.clear()
+        shutil.rmtree(self.workdir)
+
+    def _states(self, wm, names):
+        return wm.get_states(self.workdir,
+                             self.server.credentials(),
+                             names,
+                             self.logger)
+
+    def _wait_states(self, wm, names, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            states = self._states(wm, names)
+            if all(states.get(name) not in (None, 'PENDING', 'RUNNING')
+                   for name in names) or time.time() > deadline:
+                return states
+            time.sleep(0.2)
+
+    def _submit(self, wm, name):
+        return wm.submit_job(self.client,
+                             name,
+                             {'type': 'SBATCH',
+                              'command': 'job.sh ' + name},
+                             False,
+                             self.logger,
+                             workdir=self.workdir)
+
+    def test_slurm_lifecycle(self):
+        """ Slurm jobs are queued, run and complete """
+        wm = WorkloadManager.factory("SLURM")
+        self.assertTrue(self._submit(wm, 'slurm_job'))
+        self.assertEqual(self._states(wm, ['slurm_job']),
+                         {'slurm_job': 'PENDING'})
+        self.assertEqual(self._wait_states(wm, ['slurm_job']),
+                         {'slurm_job': 'COMPLETED'})
+
+    def test_slurm_job_ids(self):
+        """ Slurm jobs are monitored and stopped by their ids """
+        self.server.configure(queue_wait=10)
+        wm = WorkloadManager.factory("SLURM")
+        job_id = self._submit(wm, 'slurm_job')
+        self.assertEqual(job_id, str(self.server.jobs('slurm_job')[0]['id']))
+        # the name is not used when the id is known
+        self.assertEqual(wm.get_states(self.workdir,
+                                       self.server.credentials(),
+                                       ['slurm_job', 'other_job'],
+                                       self.logger,
+                                       job_ids={'slurm_job': job_id,
+                                                'other_job': '0'}),
+                         {'slurm_job': 'PENDING'})
+        wm.stop_job(self.client, 'other_job', {'type': 'SBATCH'}, False,
+                    self.logger, workdir=self.workdir, job_id=job_id)
+        self.assertEqual(self._wait_states(wm, ['slurm_job']),
+                         {'slurm_job': 'CANCELLED'})
+
+    def test_slurm_accounting(self):
+        """ Only finished Slurm jobs are read from sacct, once """
+        wm = WorkloadManager.factory("SLURM")
+        sacct = os.path.join(self.server.state_dir, 'bin', 'sacct')
+        os.rename(sacct, sacct + '.disabled')
+        self.assertTrue(self._submit(wm, 'slurm_job'))
+        self.assertEqual(self._states(wm, ['slurm_job']),
+                         {'slurm_job': 'PENDING'})
+
+        os.rename(sacct + '.disabled', sacct)
+        self.assertEqual(self._wait_states(wm, ['slurm_job']),
+                         {'slurm_job': 'COMPLETED'})
+        os.remove(sacct)
+        self.assertEqual(self._states(wm, ['slurm_job']),
+                         {'slurm_job': 'COMPLETED'})
+
+    def test_slurm_resubmitted(self):
+        """ Finished Slurm jobs are kept by id, not by name """
+        wm = WorkloadManager.factory("SLURM")
+        job_ids = {'slurm_job': self._submit(wm, 'slurm_job')}
+        deadline = time.time() + 10
+        while wm.get_states(self.workdir,
+                            self.server.credentials(),
+                            ['slurm_job'],
+                            self.logger,
+                            job_ids=job_ids) != {'slurm_job': 'COMPLETED'}:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.2)
+
+        job_ids = {'slurm_job': self._submit(wm, 'slurm_job')}
+        self.assertEqual(wm.get_states(self.workdir,
+                                       self.server.credentials(),
+                                       ['slurm_job'],
+                                       self.logger,
+                                       job_ids=job_ids),
+                         {'slurm_job': 'PENDING'})
+
+    def test_slurm_cancel(self):
+        """ Stopped Slurm jobs are cancelled """
+        wm = WorkloadManager.factory("SLURM")
+        self.assertTrue(self._submit(wm, 'slurm_job'))
+        wm.stop_job(self.client, 'slurm_job', {'type': 'SBATCH'}, False,
+                    self.logger, workdir=self.workdir)
+        self.assertEqual(self._wait_states(wm, ['slurm_job']),
+                         {'slurm_job': 'CANCELLED'})
+
+    def test_slurm_failures(self):
+        """ Failing jobs are reported as such """
+        self.server.configure(failure_rate=1.0, queue_wait=0, runtime=0)
+        wm = WorkloadManager.factory("SLURM")
+        self.assertTrue(self._submit(wm, 'slurm_job'))
+        self.assertEqual(self._states(wm, ['slurm_job']),
+                         {'slurm_job': 'FAILED'})
+
+    def test_missing_script(self):
+        """ Jobs with missing scripts are rejected """
+        wm = WorkloadManager.factory("SLURM")
+        self.assertFalse(wm.submit_job(self.client,
+                                       'slurm_job',
+                                       {'type': 'SBATCH',
+                                        'command': 'missing.sh'},
+                                       False,
+                                       self.logger,
+                                       workdir=self.workdir))
+        self.assertEqual(self.server.jobs(), [])
+
+    def test_torque_lifecycle(self):
+        """ Torque jobs are queued, run and complete """
+        wm = WorkloadManager.factory("TORQUE")
+        self.assertTrue(self._submit(wm, 'torque_job'))
+        self.assertEqual(self._states(wm, ['torque_job']),
+                         {'torque_job': 'PENDING'})
+        self.assertEqual(self._wait_states(wm, ['torque_job']),
+                         {'torque_job': 'COMPLETED'})
+
+    def test_torque_job_ids(self):
+        """ Torque jobs are monitored by their ids, without qselect """
+        wm = WorkloadManager.factory("TORQUE")
+        job_id = self._submit(wm, 'torque_job')
+        self.assertEqual(job_id, '{0}.fakehpc'.format(
+            self.server.jobs('torque_job')[0]['id']))
+        os.remove(os.path.join(self.server.state_dir, 'bin', 'qselect'))
+        self.assertEqual(wm.get_states(self.workdir,
+                                       self.server.credentials(),
+                                       ['torque_job'],
+                                       self.logger,
+                                       job_ids={'torque_job': job_id}),
+                         {'torque_job': 'PENDING'})
+
+    def test_torque_cancel(self):
+        """ Stopped Torque jobs are deleted """
+        wm = WorkloadManager.factory("TORQUE")
+        self.assertTrue(self._submit(wm, 'torque_job'))
+        self.assertTrue(wm.stop_job(self.client,
+                                    'torque_job',
+                                    {'type': 'SBATCH'},
+                                    False,
+                                    self.logger,
+                                    workdir=self.workdir))
+        # torque reports deleted jobs as failed
+        self.assertEqual(self._wait_states(wm, ['torque_job']),
+                         {'torque_job': 'FAILED'})
+        self.assertEqual(self.server.jobs('torque_job')[0]['state'],
+                         'CANCELLED')
+
+    def test_execute(self):
+        """ Job scripts are run in the workdir when asked to """
+        self.server.configure(execute=True, queue_wait=0)
+        wm = WorkloadManager.factory("SLURM")
+        self.assertTrue(self._submit(wm, 'slurm_job'))
+        self.assertEqual(self._wait_states(wm, ['slurm_job']),
+                         {'slurm_job': 'COMPLETED'})
+        with open(os.path.join(self.workdir, 'slurm_job.result')) as result:
+            self.assertEqual(result.read(), 'done\n')
+
+    def test_many_jobs(self):
+        """ States of many jobs are retrieved in one poll """
+        self.server.configure(queue_wait=[0, 0.5], runtime=[0, 0.5])
+        wm = WorkloadManager.factory("SLURM")
+        names = ['job' + str(i) for i in range(100)]
+        calls = ["sbatch --parsable -J " + name + " job.sh " + name
+                 for name in names]
+        results = self.client.execute_batch(calls, workdir=self.workdir)
+        self.assertEqual([exit_code for _, _, exit_code in results],
+                         [0] * len(names))
+        states = self._wait_states(wm, names)
+        self.assertEqual(states, dict((name, 'COMPLETED') for name in names))
+
+    def test_host_facts(self):
+        """ The workload manager commands are found on the host """
+        facts = self.client.get_host_facts()
+        self.assertEqual(sorted(facts['binaries']),
+                         ['qdel', 'qselect', 'qstat', 'qsub', 'sacct',
+                          'sbatch', 'scancel', 'squeue', 'srun'])
+        self.assertEqual(sorted(facts['versions']), ['slurm', 'torque'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,586 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+fake_scheduler.py: Stand-in of the Slurm and Torque commands used by Croupier
+
+Every command is run as `fake_scheduler.py <state dir> <command> [args]`.
+Jobs are kept in a SQLite database in the state dir, and their queue wait,
+runtime and exit code are drawn at submission from the distributions of
+`config.json`. It only depends on the standard library, so it starts fast.
+'''
+
+
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+
+try:                 # python3
+    from shlex import quote as shlex_quote
+except ImportError:  # python2
+    from pipes import quote as shlex_quote
+
+TORQUE_SERVER = 'fakehpc'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    array_id INTEGER,
+    array_index INTEGER,
+    name TEXT,
+    scheduler TEXT,
+    workdir TEXT,
+    command TEXT,
+    stdout TEXT,
+    stderr TEXT,
+    submitted REAL,
+    start REAL,
+    end REAL,
+    exit_code INTEGER,
+    cancelled REAL,
+    pid INTEGER
+)"""
+
+# torque exit status of jobs killed by qdel (SIGTERM + 256)
+_TORQUE_KILLED = 271
+
+_SLURM_SHORT_STATES = {'PENDING': 'PD',
+                       'RUNNING': 'R',
+                       'COMPLETED': 'CD',
+                       'FAILED': 'F',
+                       'CANCELLED': 'CA'}
+
+_TORQUE_STATES = {'PENDING': 'Q', 'RUNNING': 'R'}
+
+
+def connect(state_dir):
+    """ Opens the jobs database, creating it if needed """
+    db = sqlite3.connect(os.path.join(state_dir, 'jobs.db'), timeout=60)
+    db.row_factory = sqlite3.Row
+    db.execute(_SCHEMA)
+    return db
+
+
+def load_config(state_dir):
+    try:
+        with open(os.path.join(state_dir, 'config.json')) as config:
+            return json.load(config)
+    except IOError:
+        return {}
+
+
+def sample(spec, rng):
+    """ Draws a value from a constant, [low, high] uniform range or
+    {"exponential": mean} spec """
+    if spec is None:
+        return 0.0
+    if isinstance(spec, (list, tuple)):
+        return rng.uniform(spec[0], spec[1])
+    if isinstance(spec, dict):
+        return rng.expovariate(1.0 / spec['exponential'])
+    return float(spec)
+
+
+def job_state(job, now=None):
+    """ Slurm state of a job row at `now` """
+    now = time.time() if now is None else now
+    if job['cancelled'] is not None and \
+            (job['end'] is None or job['cancelled'] < job['end']):
+        return 'CANCELLED'
+    if now < job['start']:
+        return 'PENDING'
+    if job['end'] is None or now < job['end']:
+        return 'RUNNING'
+    return 'COMPLETED' if job['exit_code'] == 0 else 'FAILED'
+
+
+def _parse_args(args, with_value):
+    """
+    Splits the arguments into options and positionals. Options in
+    `with_value` take the next argument, unless given as `--opt=value`.
+    Parsing stops at the first positional (the script and its arguments).
+    """
+    options = {}
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if not arg.startswith('-') or arg == '-':
+            break
+        if '=' in arg and arg.startswith('--'):
+            key, value = arg.split('=', 1)
+            options[key] = value
+        elif arg in with_value and index + 1 < len(args):
+            index += 1
+            options[arg] = args[index]
+        else:
+            options[arg] = True
+        index += 1
+    return options, args[index:]
+
+
+def _parse_array(spec):
+    """ Indexes of an array spec like `0-9%2` or `1,3,5` """
+    spec = spec.split('%')[0]
+    indexes = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            indexes.extend(range(int(first), int(last) + 1))
+        else:
+            indexes.append(int(part))
+    return indexes
+
+
+def _submit(state_dir, scheduler, name, workdir, command, stdout, stderr,
+            array=None, detached=True):
+    """ Records a job (one row per array task) and returns the row ids """
+    config = load_config(state_dir)
+    db = connect(state_dir)
+    ids = []
+    now = time.time()
+    with db:
+        for index in (array if array else [None]):
+            cursor = db.execute(
+                "INSERT INTO jobs (name, scheduler, workdir, command, stdout, "
+                "stderr, submitted, start) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, scheduler, workdir, command, stdout, stderr, now, now))
+            job_id = cursor.lastrowid
+            seed = config.get('seed')
+            rng = random.Random(job_id if seed is None
+                                else '{0}-{1}'.format(seed, job_id))
+            start = now + sample(config.get('queue_wait'), rng)
+            if config.get('execute'):
+                end = None
+                exit_code = None
+            else:
+                end = start + sample(config.get('runtime'), rng)
+                exit_code = 1 if rng.random() < config.get(
+                    'failure_rate', 0.0) else 0
+            db.execute(
+                "UPDATE jobs SET array_id = ?, array_index = ?, start = ?, "
+                "end = ?, exit_code = ? WHERE id = ?",
+                (ids[0] if ids else job_id, index, start, end, exit_code,
+                 job_id))
+            ids.append(job_id)
+    db.close()
+
+    if config.get('execute') and detached:
+        for job_id in ids:
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  state_dir, '_run', str(job_id)],
+                                 stdin=devnull,
+                                 stdout=devnull,
+                                 stderr=devnull,
+                                 close_fds=True,
+                                 preexec_fn=os.setsid)
+    return ids
+
+
+def _run(state_dir, job_id):
+    """ Runs a job command once its queue wait is over """
+    db = connect(state_dir)
+    job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    delay = job['start'] - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    if job_state(db.execute("SELECT * FROM jobs WHERE id = ?",
+                            (job_id,)).fetchone()) == 'CANCELLED':
+        return 0
+
+    env = dict(os.environ)
+    if job['array_index'] is not None:
+        env['SLURM_ARRAY_TASK_ID'] = str(job['array_index'])
+        env['PBS_ARRAYID'] = str(job['array_index'])
+    env['SLURM_JOB_ID'] = str(job_id)
+    env['PBS_JOBID'] = _torque_id(job)
+
+    def output(path):
+        if path is None:
+            return None
+        return open(os.path.join(job['workdir'], path), 'a')
+
+    stdout = output(job['stdout'])
+    stderr = output(job['stderr'])
+    process = subprocess.Popen(['/bin/sh', '-c', job['command']],
+                               cwd=job['workdir'],
+                               env=env,
+                               stdout=stdout,
+                               stderr=stderr,
+                               preexec_fn=os.setsid)
+    with db:
+        db.execute("UPDATE jobs SET pid = ? WHERE id = ?",
+                   (process.pid, job_id))
+    exit_code = process.wait()
+    with db:
+        db.execute("UPDATE jobs SET end = ?, exit_code = ? WHERE id = ?",
+                   (time.time(), exit_code, job_id))
+    db.close()
+    return exit_code
+
+
+def _cancel(state_dir, where, params):
+    """ Cancels the unfinished jobs matching the condition """
+    db = connect(state_dir)
+    now = time.time()
+    with db:
+        jobs = db.execute("SELECT * FROM jobs WHERE " + where,
+                          params).fetchall()
+        for job in jobs:
+            if job_state(job, now) in ('PENDING', 'RUNNING'):
+                db.execute("UPDATE jobs SET cancelled = ? WHERE id = ?",
+                           (now, job['id']))
+                if job['pid']:
+                    try:
+                        os.killpg(job['pid'], signal.SIGTERM)
+                    except OSError:
+                        pass
+    db.close()
+    return jobs
+
+
+def _script_command(positionals, workdir):
+    """ Command running the batch script, None if it does not exist """
+    if not positionals:
+        return None
+    if not os.path.isfile(os.path.join(workdir, positionals[0])):
+        return None
+    return '/bin/sh ' + ' '.join(map(shlex_quote, positionals))
+
+
+def sbatch(state_dir, args):
+    options, positionals = _parse_args(
+        args, ['-J', '-o', '-e', '-t', '-p', '-N', '-n', '-A', '-c', '-q',
+               '--job-name', '--output', '--error', '--time', '--partition',
+               '--array', '-a'])
+    workdir = os.getcwd()
+    command = _script_command(positionals, workdir)
+    if command is None:
+        sys.stderr.write("sbatch: error: Unable to open file " +
+                         (positionals[0] if positionals else '') + "\n")
+        return 1
+    name = options.get('-J', options.get('--job-name', positionals[0]))
+    array = options.get('--array', options.get('-a'))
+    ids = _submit(state_dir, 'slurm', name, workdir, command,
+                  options.get('-o', options.get('--output', 'slurm.out')),
+                  options.get('-e', options.get('--error', 'slurm.out')),
+                  _parse_array(array) if array else None)
+    if '--parsable' in options:
+        sys.stdout.write(str(ids[0]) + "\n")
+    else:
+        sys.stdout.write("Submitted batch job " + str(ids[0]) + "\n")
+    return 0
+
+
+def srun(state_dir, args):
+    options, positionals = _parse_args(
+        args, ['-J', '-o', '-e', '-t', '-p', '-N', '-n', '-A', '-c', '-q',
+               '--job-name', '--output', '--error', '--time', '--partition'])
+    if not positionals:
+        sys.stderr.write("srun: fatal: No command given to execute.\n")
+        return 1
+    name = options.get('-J', options.get('--job-name', positionals[0]))
+    job_id = _submit(state_dir, 'slurm', name, os.getcwd(),
+                     ' '.join(map(shlex_quote, positionals)),
+                     options.get('-o'),
+                     options.get('-e'), detached=False)[0]
+    if load_config(state_dir).get('execute'):
+        return _run(state_dir, job_id)
+
+    # blocks for the whole life of the job, like the real one
+    db = connect(state_dir)
+    job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    while job_state(job) in ('PENDING', 'RUNNING'):
+        time.sleep(min(0.1, max(0.0, job['end'] - time.time())))
+        job = db.execute("SELECT * FROM jobs WHERE id = ?",
+                         (job_id,)).fetchone()
+    db.close()
+    return 0 if job_state(job) == 'COMPLETED' else 1
+
+
+def _slurm_id(job):
+    if job['array_index'] is None:
+        return str(job['id'])
+    return '{0}_{1}'.format(job['array_id'], job['array_index'])
+
+
+def _select_slurm(state_dir, options, names_option, ids_option):
+    """ Jobs filtered by the --name and --jobs options """
+    where = ["scheduler = 'slurm'"]
+    params = []
+    names = options.get(names_option)
+    if names:
+        names = names.split(',')
+        where.append("name IN (" + ','.join('?' * len(names)) + ")")
+        params.extend(names)
+    db = connect(state_dir)
+    jobs = db.execute("SELECT * FROM jobs WHERE " + ' AND '.join(where) +
+                      " ORDER BY id", params).fetchall()
+    db.close()
+    ids = options.get(ids_option)
+    if ids:
+        ids = set(ids.split(','))
+        jobs = [job for job in jobs
+                if str(job['id']) in ids or _slurm_id(job) in ids or
+                str(job['array_id']) in ids]
+    return jobs
+
+
+def sacct(state_dir, args):
+    options, _ = _parse_args(args, ['-o', '--format', '--name', '-j',
+                                    '--jobs', '-S', '-E', '-u', '-s',
+                                    '--state'])
+    for short, option in [('-j', '--jobs'), ('-s', '--state')]:
+        if short in options:
+            options.setdefault(option, options[short])
+    # states are given by name or short code
+    wanted = None
+    if '--state' in options:
+        wanted = set()
+        for state in options['--state'].split(','):
+            wanted.update(name for name, code in _SLURM_SHORT_STATES.items()
+                          if state.upper() in (name, code))
+    fields = options.get('-o', options.get('--format',
+                                           'JobID,JobName,State,ExitCode'))
+    now = time.time()
+    getters = {
+        'jobid': _slurm_id,
+        'jobname': lambda job: job['name'],
+        'state': lambda job: job_state(job, now),
+        'exitcode': lambda job: '{0}:0'.format(job['exit_code'] or 0)
+    }
+    fields = fields.split(',')
+    parsable = '-P' in options or '--parsable2' in options
+
+    lines = []
+    if '-n' not in options and '--noheader' not in options:
+        lines.append(fields)
+    for job in _select_slurm(state_dir, options, '--name', '--jobs'):
+        if wanted is not None and job_state(job, now) not in wanted:
+            continue
+        lines.append([getters[field.lower()](job)
+                      if field.lower() in getters else ''
+                      for field in fields])
+    for line in lines:
+        if parsable:
+            sys.stdout.write('|'.join(line) + "\n")
+        else:
+            sys.stdout.write(' '.join(value.ljust(12)[:12]
+                                      for value in line) + "\n")
+    return 0
+
+
+def squeue(state_dir, args):
+    options, _ = _parse_args(args, ['-o', '--format', '-n', '--name', '-j',
+                                    '--jobs', '-u', '--user', '-t'])
+    for short, option in [('-n', '--name'), ('-j', '--jobs')]:
+        if short in options:
+            options.setdefault(option, options[short])
+    template = options.get('-o', options.get('--format', '%i %j %T'))
+    now = time.time()
+    codes = {
+        'i': _slurm_id,
+        'F': lambda job: str(job['array_id'] or job['id']),
+        'j': lambda job: job['name'],
+        'T': lambda job: job_state(job, now),
+        't': lambda job: _SLURM_SHORT_STATES[job_state(job, now)],
+        'V': lambda job: time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(job['submitted']))
+    }
+
+    def render(job):
+        result = ''
+        index = 0
+        while index < len(template):
+            if template[index] == '%' and index + 1 < len(template):
+                code = template[index + 1]
+                result += codes[code](job) if job else \
+                    {'i': 'JOBID', 'F': 'ARRAY_JOB_ID', 'j': 'NAME',
+                     'T': 'STATE',
+                     't': 'ST', 'V': 'SUBMIT_TIME'}[code]
+                index += 2
+            else:
+                result += template[index]
+                index += 1
+        return result
+
+    if '-h' not in options and '--noheader' not in options:
+        sys.stdout.write(render(None) + "\n")
+    for job in _select_slurm(state_dir, options, '--name', '--jobs'):
+        if job_state(job, now) in ('PENDING', 'RUNNING'):
+            sys.stdout.write(render(job) + "\n")
+    return 0
+
+
+def scancel(state_dir, args):
+    options, positionals = _parse_args(args, ['-n', '--name', '-u'])
+    name = options.get('--name', options.get('-n'))
+    if name is None and not positionals:
+        sys.stderr.write("scancel: error: No job identification provided\n")
+        return 1
+    if name is not None:
+        _cancel(state_dir, "scheduler = 'slurm' AND name = ?", (name,))
+    for job_id in positionals:
+        _cancel(state_dir,
+                "scheduler = 'slurm' AND (id = ? OR array_id = ?)",
+                (job_id.split('_')[0], job_id.split('_')[0]))
+    return 0
+
+
+def _torque_id(job):
+    return '{0}.{1}'.format(job['id'], TORQUE_SERVER)
+
+
+def qsub(state_dir, args):
+    options, positionals = _parse_args(
+        args, ['-N', '-l', '-q', '-r', '-w', '-W', '-J', '-t', '-o', '-e',
+               '-d', '-A'])
+    workdir = options.get('-w', options.get('-d', os.getcwd()))
+    command = _script_command(positionals, workdir)
+    if command is None:
+        sys.stderr.write("qsub: script file cannot be loaded - " +
+                         (positionals[0] if positionals else '') + "\n")
+        return 1
+    name = options.get('-N', os.path.basename(positionals[0]))
+    array = options.get('-J', options.get('-t'))
+    ids = _submit(state_dir, 'torque', name, workdir, command,
+                  options.get('-o', name + '.o'),
+                  options.get('-e', name + '.e'),
+                  _parse_array(array) if array else None)
+    for job_id in ids:
+        sys.stdout.write('{0}.{1}\n'.format(job_id, TORQUE_SERVER))
+    return 0
+
+
+def qselect(state_dir, args):
+    options, _ = _parse_args(args, ['-N', '-s', '-u', '-q'])
+    where = "scheduler = 'torque'"
+    params = ()
+    if '-N' in options:
+        where += " AND name = ?"
+        params = (options['-N'],)
+    db = connect(state_dir)
+    for job in db.execute("SELECT * FROM jobs WHERE " + where +
+                          " ORDER BY id", params):
+        sys.stdout.write(_torque_id(job) + "\n")
+    db.close()
+    return 0
+
+
+def _torque_jobs(state_dir, ids):
+    """ Torque jobs by id, None for the unknown ones """
+    db = connect(state_dir)
+    jobs = []
+    for job_id in ids:
+        jobs.append((job_id, db.execute(
+            "SELECT * FROM jobs WHERE scheduler = 'torque' AND id = ?",
+            (job_id.split('.')[0],)).fetchone()))
+    db.close()
+    return jobs
+
+
+def qstat(state_dir, args):
+    options, positionals = _parse_args(args, [])
+    now = time.time()
+    exit_code = 0
+    if not positionals:
+        db = connect(state_dir)
+        positionals = [str(job['id']) for job in db.execute(
+            "SELECT id FROM jobs WHERE scheduler = 'torque' ORDER BY id")]
+        db.close()
+    if '-f' not in options and positionals:
+        sys.stdout.write("Job ID                    Name             User"
+                         "            Time Use S Queue\n"
+                         "------------------------- ---------------- "
+                         "--------------- -------- - -----\n")
+    for job_id, job in _torque_jobs(state_dir, positionals):
+        if job is None:
+            sys.stderr.write("qstat: Unknown Job Id " + job_id + "\n")
+            exit_code = 153
+            continue
+        state = job_state(job, now)
+        code = _TORQUE_STATES.get(state, 'C')
+        if '-f' in options:
+            sys.stdout.write("Job Id: " + _torque_id(job) + "\n")
+            sys.stdout.write("    Job_Name = " + job['name'] + "\n")
+            sys.stdout.write("    job_state = " + code + "\n")
+            sys.stdout.write("    queue = batch\n")
+            sys.stdout.write("    init_work_dir = " + job['workdir'] + "\n")
+            if code == 'C':
+                status = _TORQUE_KILLED if state == 'CANCELLED' \
+                    else job['exit_code']
+                sys.stdout.write("    exit_status = " + str(status) + "\n")
+            sys.stdout.write("\n")
+        else:
+            sys.stdout.write("{0:<25} {1:<16} {2:<15} {3:>8} {4} batch\n"
+                             .format(_torque_id(job), job['name'][:16],
+                                     'croupier', '0', code))
+    return exit_code
+
+
+def qdel(state_dir, args):
+    _, positionals = _parse_args(args, [])
+    if not positionals:
+        sys.stderr.write("usage: qdel [{-a|-c|-p|-t|-W delay|-m message}] "
+                         "[<JOBID>[<JOBID>]|'all'|'ALL']...\n")
+        return 2
+    exit_code = 0
+    for job_id, job in _torque_jobs(state_dir, positionals):
+        if job is None:
+            sys.stderr.write("qdel: Unknown Job Id " + job_id + "\n")
+            exit_code = 153
+        else:
+            _cancel(state_dir, "id = ?", (job['id'],))
+    return exit_code
+
+
+COMMANDS = {
+    'sbatch': sbatch,
+    'srun': srun,
+    'sacct': sacct,
+    'squeue': squeue,
+    'scancel': scancel,
+    'qsub': qsub,
+    'qselect': qselect,
+    'qstat': qstat,
+    'qdel': qdel
+}
+
+
+def main(argv):
+    state_dir, command, args = argv[1], argv[2], argv[3:]
+    if command == '_run':
+        return _run(state_dir, int(args[0]))
+    latency = sample(load_config(state_dir).get('command_latency'),
+                     random.Random())
+    if latency:
+        time.sleep(latency)
+    return COMMANDS[command](state_dir, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
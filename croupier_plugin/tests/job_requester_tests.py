@@ -0,0 +1,473 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+job_requester_tests.py: Holds the job states polling tests
+'''
+
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from croupier_plugin import monitor_agent
+from croupier_plugin.job_requester import (JobRequester,
+                                           PollScheduler,
+                                           _HostFuture)
+from croupier_plugin.ssh import SshClient, SshConnectionPool
+from croupier_plugin.tests.fake_hpc import FakeHpc
+from croupier_plugin.workload_managers import slurm
+from croupier_plugin.workload_managers.workload_manager import (
+    COMPLETION_FILE,
+    WorkloadManager,
+    state_str_to_int)
+
+
+class TestPollScheduler(unittest.TestCase):
+    """ Holds the adaptive polling tests """
+
+    def setUp(self):
+        self.scheduler = PollScheduler()
+        self.settings = {'names': ['job'],
+                         'period': 60,
+                         'min_period': 10,
+                         'max_period': 600}
+
+    def _intervals(self, states_list, walltimes=None):
+        settings = dict(self.settings, walltimes=walltimes or {})
+        now = 0
+        intervals = []
+        for states in states_list:
+            self.scheduler.update('host', settings, states, now)
+            interval = self.scheduler.next_poll(now)
+            self.assertFalse(self.scheduler.is_due('host', settings,
+                                                   now + interval - 1))
+            self.assertTrue(self.scheduler.is_due('host', settings,
+                                                  now + interval))
+            intervals.append(interval)
+            now += interval
+        return intervals
+
+    def test_pending_backoff(self):
+        """ Pending jobs are polled less and less often """
+        self.assertEqual(self._intervals([{'job': 'PENDING'}] * 6),
+                         [60, 120, 240, 480, 600, 600])
+
+    def test_state_change(self):
+        """ The period is restored as soon as the jobs change """
+        self.assertEqual(self._intervals([{'job': 'PENDING'}] * 3 +
+                                         [{'job': 'RUNNING'}] * 2),
+                         [60, 120, 240, 60, 60])
+
+    def test_walltime(self):
+        """ Running jobs are polled around their expected end """
+        self.assertEqual(self._intervals([{'job': 'RUNNING'}] * 5,
+                                         walltimes={'job': 130}),
+                         [60, 60, 10, 10, 10])
+
+    def test_failed_poll(self):
+        """ Failed polls restart the backoff """
+        self.assertEqual(self._intervals([{'job': 'PENDING'}] * 2 +
+                                         [None, {'job': 'PENDING'}]),
+                         [60, 120, 60, 120])
+
+    def test_new_jobs(self):
+        """ New jobs are polled at the period even during a backoff """
+        self._intervals([{'job': 'PENDING'}] * 4)
+        self.assertFalse(self.scheduler.is_due('host', self.settings,
+                                               60 + 120 + 240 + 60))
+        settings = dict(self.settings, names=['job', 'new'])
+        self.assertTrue(self.scheduler.is_due('host', settings, 60 + 120 +
+                                              240 + 60))
+
+        self.assertEqual(self.scheduler.next_poll(60 + 120 + 240 + 60), 0)
+
+    def test_next_poll(self):
+        """ The earliest poll of the known hosts is the next one """
+        self.assertIsNone(self.scheduler.next_poll(0))
+        self.scheduler.update('slow', dict(self.settings, period=300),
+                              {'job': 'PENDING'}, 0)
+        self.scheduler.update('host', self.settings, {'job': 'PENDING'}, 0)
+        self.assertEqual(self.scheduler.next_poll(0), 60)
+        self.scheduler.update('host', self.settings, {'job': 'PENDING'}, 60)
+        self.assertEqual(self.scheduler.next_poll(60), 120)
+        self.scheduler.update('host', self.settings, {'job': 'PENDING'}, 180)
+        self.assertEqual(self.scheduler.next_poll(180), 120)
+        self.scheduler.forget('slow')
+        self.assertEqual(self.scheduler.next_poll(180), 240)
+        self.scheduler.forget('host')
+        self.assertIsNone(self.scheduler.next_poll(180))
+
+
+class TestJobRequester(unittest.TestCase):
+    """ Holds the concurrent polling tests, against fake HPCs """
+
+    def setUp(self):
+        self.requester = JobRequester()
+        self.requester.reset()
+        self.logger = logging.getLogger('TestJobRequester')
+        self.servers = {}
+        for host, latency in [('fast', 0), ('slow', 1)]:
+            workdir = tempfile.mkdtemp()
+            server = FakeHpc(workdir).start()
+            with open(os.path.join(workdir, 'job.sh'), 'w') as script:
+                script.write('true\n')
+            client = SshClient(server.credentials())
+            client.execute_shell_command('sbatch -J ' + host + '_job job.sh',
+                                         workdir=workdir,
+                                         wait_result=True)
+            client.close_connection()
+            server.latency = latency
+            self.servers[host] = server
+
+    def tearDown(self):
+        # let the requests that timed out finish before the servers go away
+        deadline = time.time() + 5
+        while time.time() < deadline and not all(
+                future.done()
+                for future in self.requester._running.values()):
+            time.sleep(0.1)
+        self.requester.close_listeners()
+        self.requester.use_status_cache(None)
+        SshConnectionPool().close_all()
+        slurm._history.clear()
+        for server in self.servers.values():
+            server.stop()
+            shutil.rmtree(server.workdir)
+
+    def _monitor_jobs(self):
+        return dict((host, {'config': server.credentials(),
+                            'type': 'SLURM',
+                            'workdir': server.workdir,
+                            'names': [host + '_job'],
+                            'period': 0,
+                            'timeout': 0.5})
+                    for host, server in self.servers.iteritems())
+
+    def test_slow_host(self):
+        """ Slow hosts do not delay the states of the rest """
+        start = time.time()
+        states = self.requester.request(self._monitor_jobs(), self.logger)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(states, {'fast_job': 'COMPLETED'})
+        self.assertEqual(self.requester.timed_out, ['slow'])
+
+        # the late states are merged in the next request
+        late, _ = self.requester._late['slow']
+        deadline = time.time() + 5
+        while not late.done() and time.time() < deadline:
+            time.sleep(0.1)
+        states = self.requester.request(self._monitor_jobs(), self.logger)
+        self.assertEqual(states, {'fast_job': 'COMPLETED',
+                                  'slow_job': 'COMPLETED'})
+
+    def test_completion_events(self):
+        """ Jobs reporting their completion are not polled to know it """
+        server = self.servers['fast']
+        server.configure(execute=True)
+        client = SshClient(server.credentials())
+        wm = WorkloadManager.factory("SLURM")
+        # as the default base dir of the executions
+        workdir = wm.create_new_workdir(client, '$HOME', 'events',
+                                        self.logger)
+        self.assertEqual(os.path.dirname(workdir), server.workdir)
+        with open(os.path.join(workdir, 'events.sh'), 'w') as script:
+            script.write('#!/bin/sh\n# DYNAMIC VARIABLES\nsleep 1\n')
+        # the trap has to be added for the job to report its completion
+        with open(os.path.join(workdir, 'nomark.sh'), 'w') as script:
+            script.write('#!/bin/sh\nsleep 1\n')
+        self.assertFalse(wm.submit_job(
+            client,
+            'nomark_job',
+            {'type': 'SBATCH', 'command': 'nomark.sh'},
+            False,
+            self.logger,
+            workdir=workdir,
+            completion_file=workdir + '/' + COMPLETION_FILE))
+        job_id = wm.submit_job(
+            client,
+            'events_job',
+            {'type': 'SBATCH', 'command': 'events.sh'},
+            False,
+            self.logger,
+            workdir=workdir,
+            completion_file=workdir + '/' + COMPLETION_FILE)
+        client.close_connection()
+
+        monitor_jobs = {'fast': {'config': server.credentials(),
+                                 'type': 'SLURM',
+                                 'workdir': '$HOME/' +
+                                            os.path.basename(workdir),
+                                 'names': ['events_job'],
+                                 'ids': {'events_job': job_id},
+                                 'period': 0,
+                                 'max_period': 3600,
+                                 'events': True}}
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'events_job': 'RUNNING'})
+        deadline = time.time() + 5
+        while not self.requester.has_events() and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertGreater(self.requester.next_poll(), 3000)
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'events_job': 'COMPLETED'})
+        self.assertFalse(self.requester.has_events())
+
+    def test_monitor_agent(self):
+        """ Jobs followed by the agent are not polled to know their
+        states """
+        server = self.servers['fast']
+        server.configure(queue_wait=1, runtime=1)
+        shutil.copy(os.path.splitext(monitor_agent.__file__)[0] + '.py',
+                    os.path.join(server.workdir, monitor_agent.AGENT_FILE))
+        client = SshClient(server.credentials())
+        job_id = WorkloadManager.factory("SLURM").submit_job(
+            client,
+            'agent_job',
+            {'type': 'SBATCH', 'command': 'job.sh'},
+            False,
+            self.logger,
+            workdir=server.workdir)
+        client.close_connection()
+
+        monitor_jobs = {'fast': {'config': server.credentials(),
+                                 'type': 'SLURM',
+                                 # as the default base dir
+                                 'workdir': '$HOME',
+                                 'names': ['agent_job', 'fast_job'],
+                                 'ids': {'agent_job': job_id},
+                                 'period': 0.2,
+                                 'max_period': 3600,
+                                 'agent': True}}
+        self.requester.request(monitor_jobs, self.logger)
+        self.assertGreater(self.requester.next_poll(), 3000)
+        polls = len(server.commands)
+        states = {}
+        deadline = time.time() + 10
+        while states.get('agent_job') != 'COMPLETED' and \
+                time.time() < deadline:
+            time.sleep(0.1)
+            if self.requester.has_events():
+                states.update(self.requester.request(monitor_jobs,
+                                                     self.logger))
+        self.assertEqual(states, {'agent_job': 'COMPLETED',
+                                  'fast_job': 'COMPLETED'})
+        self.assertEqual(len(server.commands), polls)
+
+        # the poller stops once nobody follows its states
+        self.requester.close_listeners()
+        lock = open(os.path.join(server.workdir, '.croupier', 'agent-slurm',
+                                 monitor_agent.POLLER_LOCK))
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                time.sleep(0.1)
+        else:
+            self.fail("the poller is still running")
+        lock.close()
+
+    def test_status_cache(self):
+        """ Executions polling the same host share its job states """
+        server = self.servers['fast']
+        self.requester.use_status_cache(os.path.join(server.workdir,
+                                                     'status.db'))
+        client = SshClient(server.credentials())
+        client.execute_shell_command('sbatch -J other_job job.sh',
+                                     workdir=server.workdir,
+                                     wait_result=True)
+        client.close_connection()
+
+        def monitor_jobs(name):
+            return {'fast': {'config': server.credentials(),
+                             'type': 'SLURM',
+                             'workdir': server.workdir,
+                             'names': [name],
+                             'period': 60}}
+
+        # each execution runs in its own process, with its own scheduler
+        self.assertEqual(self.requester.request(monitor_jobs('other_job'),
+                                                self.logger),
+                         {'other_job': 'COMPLETED'})
+        self.requester._scheduler.reset()
+        self.assertEqual(self.requester.request(monitor_jobs('fast_job'),
+                                                self.logger),
+                         {'fast_job': 'COMPLETED'})
+        polls = len(server.commands)
+        self.requester._scheduler.reset()
+        self.assertEqual(self.requester.request(monitor_jobs('other_job'),
+                                                self.logger),
+                         {'other_job': 'COMPLETED'})
+        self.assertEqual(len(server.commands), polls)
+
+        # states read from the workdir are only shared within it
+        settings = monitor_jobs('job')['fast']
+        self.assertNotIn('scope', self.requester._cache_settings(settings))
+        self.assertEqual(self.requester._cache_settings(
+            dict(settings, type='BASH'))['scope'], server.workdir)
+
+    def test_reset(self):
+        """ Executions do not inherit the polls of the previous one """
+        self.requester.request(self._monitor_jobs(), self.logger)
+        self.assertIsNotNone(self.requester.next_poll())
+        self.assertTrue(self.requester._running)
+        self.requester.reset()
+        self.assertIsNone(self.requester.next_poll())
+        self.assertEqual(self.requester._running, {})
+        self.assertEqual(self.requester._late, {})
+
+    def test_unreachable_host(self):
+        """ Unreachable hosts are skipped """
+        self.servers['slow'].latency = 0
+        self.servers['slow'].stop()
+        states = self.requester.request(self._monitor_jobs(), self.logger)
+        self.assertEqual(states, {'fast_job': 'COMPLETED'})
+        self.assertEqual(self.requester.timed_out, [])
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    """ Answers the job status queries with the canned states """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)['query'][0]
+        self.server.queries.append((self.client_address, query))
+        result = [{'metric': {'job': host, 'name': name},
+                   'value': [time.time(), str(state_str_to_int(state))]}
+                  for (host, name), state in self.server.states.items()]
+        body = json.dumps({'status': 'success',
+                           'data': {'resultType': 'vector',
+                                    'result': result}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrometheus(unittest.TestCase):
+    """ Holds the external monitor tests, against a local Prometheus """
+
+    def setUp(self):
+        self.requester = JobRequester()
+        self.requester.reset()
+        self.logger = logging.getLogger('TestPrometheus')
+        self.server = HTTPServer(('127.0.0.1', 0), _PrometheusHandler)
+        self.server.queries = []
+        self.server.states = {('hpc1', 'job_a'): 'RUNNING',
+                              ('hpc1', 'job_b'): 'COMPLETED',
+                              ('hpc2', 'job_c'): 'FAILED',
+                              ('hpc3', 'job_d'): 'RUNNING'}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        if self.requester._session is not None:
+            self.requester._session.close()
+            self.requester._session = None
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _monitor_jobs(self, names):
+        url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        return dict((host, {'config': {'url': url},
+                            'type': 'PROMETHEUS',
+                            'names': host_names,
+                            'period': 0})
+                    for host, host_names in names.items())
+
+    def test_batched_query(self):
+        """ Hosts sharing a Prometheus are queried at once """
+        monitor_jobs = self._monitor_jobs({'hpc1': ['job_a', 'job_b'],
+                                           'hpc2': ['job_c']})
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'job_a': 'RUNNING',
+                          'job_b': 'COMPLETED',
+                          'job_c': 'FAILED'})
+        self.assertEqual([query for _, query in self.server.queries],
+                         ['job_status{job=~"hpc1|hpc2",'
+                          'name=~"job_a|job_b|job_c"}'])
+
+        # the states of each host are kept apart
+        monitor_jobs = self._monitor_jobs({'hpc1': ['job_c'],
+                                           'hpc2': ['job_a']})
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {})
+        # and the connection is kept alive
+        self.assertEqual(len(set(client
+                                 for client, _ in self.server.queries)), 1)
+
+    def test_escaped_names(self):
+        """ Names are matched literally """
+        self.server.states = {('hpc.1', 'job+1'): 'RUNNING',
+                              ('hpcX1', 'job1'): 'FAILED'}
+        monitor_jobs = self._monitor_jobs({'hpc.1': ['job+1']})
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'job+1': 'RUNNING'})
+        self.assertEqual(self.server.queries[0][1],
+                         'job_status{job=~"hpc\\\\.1",'
+                         'name=~"job\\\\+1"}')
+
+    def test_batch_timeouts(self):
+        """ Hosts that time out do not cancel the batch of the rest """
+        class Batch(object):
+            cancelled = False
+
+            def cancel(self):
+                self.cancelled = True
+                return True
+
+        batch = Batch()
+        waiting = set(['hpc1', 'hpc2'])
+        futures = [_HostFuture(batch, host, waiting)
+                   for host in sorted(waiting)]
+        self.assertFalse(futures[0].cancel())
+        self.assertFalse(batch.cancelled)
+        self.assertTrue(futures[1].cancel())
+        self.assertTrue(batch.cancelled)
+
+    def test_unreachable_monitor(self):
+        """ Unreachable monitors are skipped """
+        monitor_jobs = self._monitor_jobs({'hpc1': ['job_a']})
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {})
+
+
+if __name__ == '__main__':
+    unittest.main()
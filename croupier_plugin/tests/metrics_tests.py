@@ -0,0 +1,151 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+metrics_tests.py: Holds the metrics registry tests
+'''
+
+
+import logging
+import shutil
+import tempfile
+import unittest
+
+from croupier_plugin.metrics import (Metrics,
+                                     current_operation,
+                                     instrumented,
+                                     operation)
+from croupier_plugin.ssh import SshClient, SshConnectionPool, SshExecutor
+from croupier_plugin.tests.ssh_server import LocalSshServer
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+
+
+class TestMetrics(unittest.TestCase):
+    """ Holds metrics registry tests """
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.reset()
+
+    def tearDown(self):
+        self.metrics.reset()
+
+    def test_counters(self):
+        """ Counters add up by name and labels """
+        self.metrics.inc('test_total', host='a')
+        self.metrics.inc('test_total', 2, host='a')
+        self.metrics.inc('test_total', host='b')
+        self.assertEqual(
+            sorted(self.metrics.snapshot()['test_total']),
+            [{'labels': {'host': 'a'}, 'value': 3},
+             {'labels': {'host': 'b'}, 'value': 1}])
+
+    def test_histogram(self):
+        """ Histograms keep cumulative buckets, sum and count """
+        for value in [0.001, 0.3, 0.3, 1000]:
+            self.metrics.observe('test_seconds', value, host='a')
+        sample = self.metrics.snapshot()['test_seconds'][0]
+        buckets = dict(sample['buckets'])
+        self.assertEqual(buckets[0.005], 1)
+        self.assertEqual(buckets[0.25], 1)
+        self.assertEqual(buckets[0.5], 3)
+        self.assertEqual(buckets[120], 3)
+        self.assertEqual(buckets['+Inf'], 4)
+        self.assertEqual(sample['count'], 4)
+        self.assertAlmostEqual(sample['sum'], 1000.601)
+
+    def test_prometheus(self):
+        """ Metrics are exposed in Prometheus text format """
+        self.metrics.inc('test_total', host='a"b')
+        self.metrics.observe('test_seconds', 0.1, host='a')
+        text = self.metrics.to_prometheus()
+        self.assertIn('# TYPE test_total counter\n'
+                      'test_total{host="a\\"b"} 1\n', text)
+        self.assertIn('# TYPE test_seconds histogram\n', text)
+        self.assertIn('test_seconds_bucket{host="a",le="0.05"} 0\n', text)
+        self.assertIn('test_seconds_bucket{host="a",le="0.1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{host="a",le="+Inf"} 1\n', text)
+        self.assertIn('test_seconds_count{host="a"} 1\n', text)
+
+    def test_operation(self):
+        """ Operations nest, and the innermost one is current """
+        @instrumented
+        def get_states():
+            return current_operation()
+
+        self.assertEqual(current_operation(), '')
+        with operation('submit_job'):
+            self.assertEqual(current_operation(), 'submit_job')
+            self.assertEqual(get_states(), 'get_states')
+            self.assertEqual(current_operation(), 'submit_job')
+        self.assertEqual(current_operation(), '')
+
+
+class TestSshMetrics(unittest.TestCase):
+    """ Holds ssh metrics tests """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = LocalSshServer(self.workdir).start()
+        self.metrics = Metrics()
+        self.metrics.reset()
+
+    def tearDown(self):
+        self.metrics.reset()
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_ssh_metrics(self):
+        """ Ssh activity is recorded per host and driver operation """
+        client = SshClient(self.server.credentials())
+        try:
+            wm = WorkloadManager.factory("SLURM")
+            wm.create_new_workdir(client,
+                                  self.workdir,
+                                  'test',
+                                  logging.getLogger('TestSshMetrics'))
+            with operation('publish'):
+                SshExecutor().run(self.server.credentials(),
+                                  'echo hello').get(10)
+        finally:
+            client.close_connection()
+            SshExecutor().close()
+            SshConnectionPool().close_all()
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(
+            sorted(sample['labels']['operation'] for sample in
+                   snapshot['croupier_ssh_connect_seconds']),
+            ['', 'publish'])
+        commands = dict((sample['labels']['operation'], sample['count'])
+                        for sample in
+                        snapshot['croupier_ssh_command_seconds'])
+        self.assertEqual(commands, {'create_new_workdir': 1, 'publish': 1})
+        received = dict((sample['labels']['operation'], sample['value'])
+                        for sample in
+                        snapshot['croupier_ssh_received_bytes_total'])
+        self.assertEqual(received['publish'], len('hello\n'))
+        self.assertIn('croupier_ssh_sent_bytes_total', snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -106,6 +106,27 @@ class TestSlurm(unittest.TestCase):
                                '-e test.err -o test.out ' +
                                '-t 00:05:00 cmd; " &')
 
+    def test_completion_record_srun_call(self):
+        """ srun command reporting its completion. """
+        record = self.wm._build_completion_record('test', 'dir/events')
+        self.assertEqual(record, 'echo "test|${SLURM_JOB_ID}|$?|$(date +%s)"'
+                                 ' >> dir/events')
+        response = self.wm._build_job_submission_call(
+            'test',
+            {'command': 'cmd',
+             'type': 'SRUN',
+             'max_time': '00:05:00',
+             'completion_record': record},
+            self.logger)
+        self.assertNotIn('error', response)
+
+        call = response['call']
+        self.assertEqual(call, 'nohup sh -c "srun -J \'test\' ' +
+                               '-e test.err -o test.out ' +
+                               '-t 00:05:00 cmd; ' +
+                               'echo \\"test|\\${SLURM_JOB_ID}|\\$?|' +
+                               '\\$(date +%s)\\" >> dir/events; " &')
+
     def test_complete_srun_call(self):
         """ Complete srun command. """
         response = self.wm._build_job_submission_call('test',
@@ -247,12 +268,54 @@ class TestSlurm(unittest.TestCase):
                                       'test2': '123456',
                                       'test3': '234567'})
 
+    def test_parse_cancelled(self):
+        """ Parse cancelled jobs from sacct """
+        parsed = self.wm._parse_states("test1|CANCELLED by 1000\n", None)
+
+        self.assertDictEqual(parsed, {'test1': 'CANCELLED'})
+
+    def test_parse_squeue(self):
+        """ Parse states and submission times from squeue """
+        states, submitted = self.wm._parse_squeue(
+            "test1|RUNNING|2019-05-02T10:00:00\n"
+            "test2|PENDING|2019-05-02T11:00:00\n"
+            "test2|RUNNING|2019-05-02T10:30:00\n")
+
+        self.assertDictEqual(states, {'test1': 'RUNNING',
+                                      'test2': 'RUNNING'})
+        self.assertDictEqual(submitted, {'test1': '2019-05-02T10:00:00',
+                                         'test2': '2019-05-02T10:30:00'})
+
     def test_parse_clean_sacct(self):
         """ Parse no output from sacct """
         parsed = self.wm._parse_states("\n", None)
 
         self.assertDictEqual(parsed, {})
 
+    def test_parse_submitted_jobid(self):
+        """ Parse JobID from sbatch --parsable """
+        self.assertEqual(self.wm._parse_job_id("1234\n"), '1234')
+        self.assertEqual(self.wm._parse_job_id("pre output\n1234;cluster\n"),
+                         '1234')
+        self.assertIsNone(self.wm._parse_job_id(""))
+
+    def test_cancellation_call(self):
+        """ Jobs are cancelled by id when known """
+        self.assertEqual(self.wm._build_job_cancellation_call(
+            'test', {}, logging.getLogger()), "scancel --name test")
+        self.assertEqual(self.wm._build_job_cancellation_call(
+            'test', {}, logging.getLogger(), job_id='1234'), "scancel 1234")
+
+    def test_get_walltime(self):
+        """ Parse Slurm time limits """
+        self.assertEqual(self.wm.get_walltime('30'), 1800)
+        self.assertEqual(self.wm.get_walltime('30:15'), 1815)
+        self.assertEqual(self.wm.get_walltime('01:30:15'), 5415)
+        self.assertEqual(self.wm.get_walltime('1-2'), 93600)
+        self.assertEqual(self.wm.get_walltime('1-02:30'), 95400)
+        self.assertEqual(self.wm.get_walltime('1-02:30:15'), 95415)
+        self.assertIsNone(self.wm.get_walltime('unlimited'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,261 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+ssh_benchmark.py: Micro-benchmarks of the ssh layer against a local server
+
+Run with `python -m croupier_plugin.tests.ssh_benchmark`
+'''
+
+
+import logging
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from croupier_plugin.ssh import (SshClient,
+                                 SshConnectionPool,
+                                 SshTunnelManager)
+from croupier_plugin.tests.fake_hpc import FakeHpc
+from croupier_plugin.tests.ssh_server import LocalSshServer
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+
+
+def _legacy_send_command(ssh_client, command, read_chunk_timeout=500):
+    """ Polling loop used by `SshClient.send_command` up to now """
+    stdin, stdout, stderr = ssh_client._client.exec_command(command,
+                                                            timeout=3000)
+    channel = stdout.channel
+    stdin.close()
+    channel.shutdown_write()
+
+    stdout_chunks = []
+    stdout_chunks.append(channel.recv(len(channel.in_buffer)))
+    while (not channel.closed
+           or channel.recv_ready()
+           or channel.recv_stderr_ready()):
+        got_chunk = False
+        readq, _, _ = select.select([channel], [], [], read_chunk_timeout)
+        for c in readq:
+            if c.recv_ready():
+                stdout_chunks.append(channel.recv(len(c.in_buffer)))
+                got_chunk = True
+            if c.recv_stderr_ready():
+                channel.recv_stderr(len(c.in_stderr_buffer))
+                got_chunk = True
+        if (not got_chunk
+                and channel.exit_status_ready()
+                and not channel.recv_stderr_ready()
+                and not channel.recv_ready()):
+            channel.shutdown_read()
+            channel.close()
+            break
+
+    stdout.close()
+    stderr.close()
+    return (''.join(stdout_chunks), channel.recv_exit_status())
+
+
+def _serve_loopback(size):
+    """
+    Loopback stand-in for the tunnelled service: each connection either
+    uploads (first byte 'u') or downloads `size` bytes
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    payload = '\0' * size
+
+    def serve(conn):
+        if conn.recv(1) == 'u':
+            while conn.recv(262144):
+                pass
+        else:
+            conn.sendall(payload)
+        conn.close()
+
+    def accept():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _transfer(conn, size, upload):
+    """ MB/s of an upload or download over a socket or a channel """
+    start = time.time()
+    if upload:
+        conn.sendall('u' + '\0' * size)
+        conn.shutdown(socket.SHUT_WR)
+        conn.recv(1)
+    else:
+        conn.sendall('d')
+        received = 0
+        while received < size:
+            data = conn.recv(262144)
+            if not data:
+                break
+            received += len(data)
+    elapsed = time.time() - start
+    conn.close()
+    return size / elapsed / 1024 / 1024
+
+
+def benchmark_tunnel(size=64 * 1024 * 1024):
+    """ Throughput of a direct connection and of a channel tunnelled
+    through the shared jump host connection """
+    workdir = tempfile.mkdtemp()
+    bastion = LocalSshServer(workdir).start()
+    loopback = _serve_loopback(size)
+    address = loopback.getsockname()
+    tunnel = bastion.credentials()
+    try:
+        print "{0:<30} {1:>12} {2:>12}".format("transfer",
+                                               "direct MB/s",
+                                               "tunnel MB/s")
+        for upload in [True, False]:
+            direct = _transfer(socket.create_connection(address),
+                               size,
+                               upload)
+            channel = SshTunnelManager().open_channel(tunnel, *address)
+            try:
+                tunnelled = _transfer(channel, size, upload)
+            finally:
+                SshTunnelManager().release(tunnel)
+            print "{0:<30} {1:>12.2f} {2:>12.2f}".format(
+                "upload" if upload else "download", direct, tunnelled)
+    finally:
+        SshTunnelManager().close_all()
+        loopback.close()
+        bastion.stop()
+        shutil.rmtree(workdir)
+
+
+def _measure(function, repetitions):
+    start = time.time()
+    for _ in range(repetitions):
+        function()
+    return (time.time() - start) / repetitions * 1000
+
+
+def benchmark_send_command(repetitions=200):
+    """ Per-command time of the legacy loop and the current send_command """
+    workdir = tempfile.mkdtemp()
+    server = LocalSshServer(workdir).start()
+    ssh_client = SshClient(server.credentials())
+    try:
+        print "{0:<30} {1:>12} {2:>12}".format("command",
+                                               "before (ms)",
+                                               "after (ms)")
+        for command in ['true',
+                        'echo hello; echo error >&2',
+                        'seq 1 100000']:
+            before = _measure(
+                lambda: _legacy_send_command(ssh_client, command),
+                repetitions)
+            after = _measure(
+                lambda: ssh_client.send_command(command, wait_result=True),
+                repetitions)
+            print "{0:<30} {1:>12.2f} {2:>12.2f}".format(command,
+                                                         before,
+                                                         after)
+    finally:
+        ssh_client.close_connection()
+        server.stop()
+        shutil.rmtree(workdir)
+
+
+def benchmark_jobs(jobs=1000, workload_manager='SLURM', poll_interval=1):
+    """
+    Submission and monitoring of many jobs on a fake HPC, with queue waits
+    and runtimes of a few seconds
+    """
+    workdir = tempfile.mkdtemp()
+    server = FakeHpc(workdir,
+                     command_latency=0.01,
+                     queue_wait={'exponential': 5},
+                     runtime=[1, 10],
+                     failure_rate=0.05,
+                     seed=0).start()
+    with open(os.path.join(workdir, 'job.sh'), 'w') as script:
+        script.write('true\n')
+    wm = WorkloadManager.factory(workload_manager)
+    logger = logging.getLogger('benchmark_jobs')
+    names = ['job' + str(i) for i in range(jobs)]
+    ssh_client = SshClient(server.credentials())
+    try:
+        start = time.time()
+        for name in names:
+            wm.submit_job(ssh_client,
+                          name,
+                          {'type': 'SBATCH', 'command': 'job.sh'},
+                          False,
+                          logger,
+                          workdir=workdir)
+        submitted = time.time()
+
+        polls = []
+        while True:
+            poll = time.time()
+            states = wm.get_states(workdir,
+                                   server.credentials(),
+                                   names,
+                                   logger)
+            polls.append(time.time() - poll)
+            if len(states) == jobs and all(
+                    state not in ('PENDING', 'RUNNING')
+                    for state in states.values()):
+                break
+            time.sleep(poll_interval)
+        finished = time.time()
+
+        print "{0:<30} {1:>12}".format(workload_manager + " jobs", jobs)
+        print "{0:<30} {1:>12.2f}".format("submissions / s",
+                                          jobs / (submitted - start))
+        print "{0:<30} {1:>12.2f}".format("mean poll (ms)",
+                                          sum(polls) / len(polls) * 1000)
+        print "{0:<30} {1:>12.2f}".format("makespan (s)", finished - start)
+    finally:
+        ssh_client.close_connection()
+        SshConnectionPool().close_all()
+        server.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    benchmark_send_command()
+    benchmark_tunnel()
+    benchmark_jobs()
@@ -0,0 +1,369 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+ssh_server.py: Local paramiko ssh server that runs commands on the local shell
+'''
+
+
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """ Accepts the test user and runs every exec request locally """
+
+    def __init__(self, server):
+        self._server = server
+        self.forwards = {}
+
+    def check_auth_password(self, username, password):
+        if username == self._server.user and \
+                password == self._server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._server.run_command,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class _SftpHandle(paramiko.SFTPHandle):
+    """ Open local file served through SFTP """
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr.st_mode is not None:
+            os.chmod(self.filename, attr.st_mode)
+        return paramiko.SFTP_OK
+
+
+class _SftpServerInterface(paramiko.SFTPServerInterface):
+    """ Serves the local filesystem, relative paths from the workdir """
+
+    def __init__(self, server, workdir, *args, **kwargs):
+        super(_SftpServerInterface, self).__init__(server, *args, **kwargs)
+        self._workdir = workdir
+
+    def _path(self, path):
+        return os.path.join(self._workdir, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+            if attr is not None and attr.st_mode is not None:
+                os.chmod(path, attr.st_mode)
+            mode = 'r+b' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb'
+            if flags & os.O_WRONLY and not flags & os.O_RDWR:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            handle = _SftpHandle(flags)
+            handle.filename = path
+            handle.readfile = os.fdopen(fd, mode)
+            handle.writefile = handle.readfile
+            return handle
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self._path(path), attr.st_mode)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                os.stat(os.path.join(path, name)), name)
+                for name in os.listdir(path)]
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class LocalSshServer(object):
+    """
+    Minimal ssh server listening on localhost
+
+    Commands sent through exec requests are executed by the local `/bin/sh`,
+    with `workdir` as home directory, SFTP serves the local filesystem and
+    direct-tcpip channels are forwarded, so it can also act as jump host.
+    It is only meant for tests and benchmarks of the ssh layer.
+    """
+    _host_key = None
+
+    def __init__(self, workdir=None, latency=0.0):
+        self.user = 'croupier'
+        self.password = 'croupier'
+        self.workdir = workdir if workdir else os.getcwd()
+        self.latency = latency
+        self.connections = 0
+        self.port = None
+        self.commands = []
+        self.forwarded = []
+        # extra variables of the commands environment
+        self.environment = {}
+        self._socket = None
+        self._transports = []
+        self._channels = set()
+        self._lock = threading.Lock()
+
+        if LocalSshServer._host_key is None:
+            LocalSshServer._host_key = paramiko.RSAKey.generate(1024)
+
+    def start(self):
+        """ Binds to a free port on localhost and starts accepting """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        thread = threading.Thread(target=self._accept_loop)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """ Closes the listening socket and every open transport """
+        if self._socket is not None:
+            # wakes up the blocked accept, that keeps the socket open
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            transports = list(self._transports)
+        for transport in transports:
+            transport.close()
+
+    def credentials(self, **kwargs):
+        """ Croupier credentials to connect to this server """
+        credentials = {
+            'host': '127.0.0.1',
+            'port': self.port,
+            'user': self.user,
+            'password': self.password
+        }
+        credentials.update(kwargs)
+        return credentials
+
+    def _accept_loop(self):
+        while self._socket is not None:
+            try:
+                sock, _ = self._socket.accept()
+            except (socket.error, AttributeError):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(LocalSshServer._host_key)
+            transport.set_subsystem_handler('sftp',
+                                            paramiko.SFTPServer,
+                                            _SftpServerInterface,
+                                            self.workdir)
+            with self._lock:
+                self.connections += 1
+                self._transports.append(transport)
+            interface = _ServerInterface(self)
+            try:
+                transport.start_server(server=interface)
+            except (paramiko.SSHException, EOFError, socket.error):
+                continue
+            thread = threading.Thread(target=self._channel_loop,
+                                      args=(transport, interface))
+            thread.daemon = True
+            thread.start()
+
+    def _channel_loop(self, transport, interface):
+        # channels are served from the exec requests, but paramiko only keeps
+        # weak references to them, so hold them until they are closed
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                with self._lock:
+                    self._channels = set(chan for chan in self._channels
+                                         if not chan.closed)
+                    self._channels.add(channel)
+                destination = interface.forwards.pop(channel.get_id(), None)
+                if destination is not None:
+                    thread = threading.Thread(target=self._forward,
+                                              args=(channel, destination))
+                    thread.daemon = True
+                    thread.start()
+
+    def _forward(self, channel, destination):
+        """ Pipes a direct-tcpip channel to its destination """
+        with self._lock:
+            self.forwarded.append(destination)
+        sock = socket.create_connection(destination)
+        readers = [sock, channel]
+        try:
+            while readers:
+                readable, _, _ = select.select(readers, [], [])
+                if sock in readable:
+                    data = sock.recv(65536)
+                    if data:
+                        channel.sendall(data)
+                    else:
+                        channel.shutdown_write()
+                        readers.remove(sock)
+                if channel in readable:
+                    data = channel.recv(65536)
+                    if data:
+                        sock.sendall(data)
+                    else:
+                        sock.shutdown(socket.SHUT_WR)
+                        readers.remove(channel)
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        finally:
+            sock.close()
+            channel.close()
+
+    def run_command(self, channel, command):
+        """ Runs the command and pipes its streams through the channel """
+        with self._lock:
+            self.commands.append(command)
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+        env = dict(os.environ)
+        env['HOME'] = self.workdir
+        env.update(self.environment)
+        # the commands must not keep the sockets of the clients open
+        process = subprocess.Popen(['/bin/sh', '-c', command],
+                                   cwd=self.workdir,
+                                   env=env,
+                                   close_fds=True,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+
+        def pump(source, send):
+            try:
+                while True:
+                    data = os.read(source.fileno(), 65536)
+                    if not data:
+                        break
+                    send(data)
+            except socket.error:
+                # like sshd, the process finds out when it writes again
+                source.close()
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (IOError, OSError, socket.error):
+                pass
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        pumps = [threading.Thread(target=pump,
+                                  args=(process.stdout, channel.sendall)),
+                 threading.Thread(target=pump,
+                                  args=(process.stderr,
+                                        channel.sendall_stderr))]
+        for thread in pumps:
+            thread.daemon = True
+            thread.start()
+        for thread in pumps:
+            thread.join()
+        exit_code = process.wait()
+
+        try:
+            channel.send_exit_status(exit_code)
+            channel.shutdown_write()
+            # let the client close first, so the close never overtakes the
+            # reply to the exec request sent by the transport thread
+            deadline = time.time() + 1
+            while not channel.closed and time.time() < deadline:
+                time.sleep(0.005)
+            channel.close()
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
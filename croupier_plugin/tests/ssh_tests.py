@@ -0,0 +1,502 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+ssh_tests.py: Holds the ssh layer tests, run against a local ssh server
+'''
+
+
+import io
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import TimeoutError
+
+from paramiko import ssh_exception
+
+from croupier_plugin.ssh import (HostUnavailableError,
+                                 SshClient,
+                                 SshConnectionPool,
+                                 SshExecutor,
+                                 SshTunnelManager,
+                                 _circuit_breaker,
+                                 _probe_cache)
+from croupier_plugin.tests.ssh_server import LocalSshServer
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+
+
+class TestSshConnectionPool(unittest.TestCase):
+    """ Holds ssh connection pool tests """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = LocalSshServer(self.workdir).start()
+        self.pool = SshConnectionPool()
+        self.pool.close_all()
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_reuse_connection(self):
+        """ Released clients are reused by the next checkout """
+        credentials = self.server.credentials()
+        for _ in range(5):
+            with self.pool.connection(credentials) as client:
+                output, exit_code = client.execute_shell_command(
+                    'echo hello', wait_result=True)
+                self.assertEqual(exit_code, 0)
+                self.assertEqual(output, 'hello\n')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_different_users_do_not_share(self):
+        """ Connections are keyed by user """
+        credentials = self.server.credentials()
+        other = self.server.credentials(login_shell=True)
+        with self.pool.connection(credentials) as client:
+            with self.pool.connection(other) as other_client:
+                self.assertIsNot(client, other_client)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_dead_connection_is_replaced(self):
+        """ Dead idle clients fail the liveness check on checkout """
+        credentials = self.server.credentials()
+        with self.pool.connection(credentials) as client:
+            pass
+        client.get_transport().close()
+        with self.pool.connection(credentials) as new_client:
+            self.assertIsNot(client, new_client)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_timeout(self):
+        """ Clients idle for too long are closed """
+        credentials = self.server.credentials()
+        with self.pool.connection(credentials) as client:
+            transport = client.get_transport()
+        self.pool.instance.idle_timeout = -1
+        try:
+            with self.pool.connection(credentials) as new_client:
+                self.assertIsNot(client, new_client)
+        finally:
+            del self.pool.instance.idle_timeout
+        self.assertFalse(transport.is_active())
+
+    def test_max_connections_per_host(self):
+        """ Checkout blocks and times out when the host is saturated """
+        credentials = self.server.credentials()
+        self.pool.instance.max_connections_per_host = 1
+        self.pool.instance.checkout_timeout = 0.2
+        try:
+            with self.pool.connection(credentials):
+                self.assertRaises(ssh_exception.SSHException,
+                                  self.pool.acquire,
+                                  credentials)
+        finally:
+            del self.pool.instance.max_connections_per_host
+            del self.pool.instance.checkout_timeout
+
+
+class TestSshExecutor(unittest.TestCase):
+    """ Holds background ssh operations tests """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.servers = [LocalSshServer(self.workdir, latency=0.5).start()
+                        for _ in range(3)]
+        self.executor = SshExecutor()
+
+    def tearDown(self):
+        self.executor.close()
+        SshConnectionPool().close_all()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_many_hosts(self):
+        """ Operations on different hosts run at the same time """
+        start = time.time()
+        futures = [self.executor.run(server.credentials(), 'echo $HOME')
+                   for server in self.servers]
+        futures.append(self.executor.run_batch(self.servers[0].credentials(),
+                                               ['true', 'exit 2']))
+        futures.append(self.executor.upload(self.servers[1].credentials(),
+                                            [('data', 'data.txt', 0o644)],
+                                            workdir=self.workdir))
+        results = [future.get(10) for future in futures]
+        self.assertEqual(results, [(self.workdir + '\n', 0)] * 3 +
+                         [[('', '', 0), ('', '', 2)], None])
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_timeout_and_cancel(self):
+        """ Waits time out and queued operations can be cancelled """
+        self.executor.close()
+        self.executor.instance.max_workers = 1
+        try:
+            credentials = self.servers[0].credentials()
+            running = self.executor.run(credentials, 'echo 1')
+            queued = self.executor.run(credentials, 'echo 2')
+            self.assertRaises(TimeoutError, running.get, 0.1)
+            self.assertTrue(queued.cancel())
+            self.assertEqual(running.get(10), ('1\n', 0))
+            self.assertFalse(running.cancel())
+            self.assertIsNone(queued.get(10))
+            self.assertTrue(queued.done())
+        finally:
+            self.executor.close()
+            del self.executor.instance.max_workers
+
+    def test_done_callback(self):
+        """ Callbacks are called once operations finish or are cancelled """
+        self.executor.close()
+        self.executor.instance.max_workers = 1
+        try:
+            credentials = self.servers[0].credentials()
+            finished = []
+            running = self.executor.run(credentials, 'exit 1')
+            queued = self.executor.run(credentials, 'true')
+            running.add_done_callback(finished.append)
+            queued.add_done_callback(finished.append)
+            queued.cancel()
+            self.assertEqual(finished, [queued])
+            self.assertEqual(running.get(10), ('', 1))
+            self.assertEqual(finished, [queued, running])
+            running.add_done_callback(finished.append)
+            self.assertEqual(finished, [queued, running, running])
+        finally:
+            self.executor.close()
+            del self.executor.instance.max_workers
+
+
+class TestSshTunnelManager(unittest.TestCase):
+    """ Holds jump host tunnel tests """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.bastion = LocalSshServer(self.workdir).start()
+        self.server = LocalSshServer(self.workdir).start()
+        self.credentials = self.server.credentials(
+            tunnel=self.bastion.credentials())
+
+    def tearDown(self):
+        SshTunnelManager().close_all()
+        self.bastion.stop()
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_shared_bastion(self):
+        """ Tunnelled clients share one jump host connection """
+        clients = [SshClient(self.credentials) for _ in range(3)]
+        for ssh_client in clients:
+            self.assertEqual(ssh_client.execute_shell_command(
+                'echo hello', wait_result=True), ('hello\n', 0))
+        self.assertEqual(self.bastion.connections, 1)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.bastion.forwarded,
+                         [('127.0.0.1', self.server.port)] * 3)
+
+        bastion = SshTunnelManager().instance._bastions.values()[0][0]
+        for ssh_client in clients[:-1]:
+            ssh_client.close_connection()
+        self.assertTrue(bastion.get_transport().is_active())
+        clients[-1].close_connection()
+        clients[-1].close_connection()
+        self.assertIsNone(bastion.get_transport())
+        self.assertEqual(SshTunnelManager().instance._bastions, {})
+
+    def test_channel_data(self):
+        """ Tunnelled channels keep the data in both directions """
+        echo = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        echo.bind(('127.0.0.1', 0))
+        echo.listen(1)
+
+        def serve_echo():
+            conn, _ = echo.accept()
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+            conn.close()
+        thread = threading.Thread(target=serve_echo)
+        thread.daemon = True
+        thread.start()
+
+        tunnel = self.bastion.credentials()
+        channel = SshTunnelManager().open_channel(tunnel,
+                                                  '127.0.0.1',
+                                                  echo.getsockname()[1])
+        try:
+            payload = os.urandom(4 * 1024 * 1024)
+            received = []
+
+            def read():
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    received.append(data)
+            reader = threading.Thread(target=read)
+            reader.start()
+            channel.sendall(payload)
+            # the half-close reaches the service, that closes in turn
+            channel.shutdown_write()
+            reader.join(30)
+            self.assertTrue(''.join(received) == payload)
+        finally:
+            channel.close()
+            SshTunnelManager().release(tunnel)
+            echo.close()
+
+
+class TestSshClient(unittest.TestCase):
+    """ Holds ssh client tests """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = LocalSshServer(self.workdir).start()
+        self.client = SshClient(self.server.credentials())
+
+    def tearDown(self):
+        self.client.close_connection()
+        self.server.stop()
+        _circuit_breaker.success('127.0.0.1:' + str(self.server.port))
+        _probe_cache.invalidate()
+        shutil.rmtree(self.workdir)
+
+    def test_reconnect(self):
+        """ Dead connections are reopened before the next command """
+        self.client.get_transport().close()
+        self.assertFalse(self.client.is_active())
+        self.assertEqual(self.client.execute_shell_command(
+            'echo hello', wait_result=True), ('hello\n', 0))
+        self.assertTrue(self.client.is_active())
+        self.assertEqual(self.server.connections, 2)
+
+    def test_circuit_breaker(self):
+        """ Hosts failing repeatedly are not tried for a while """
+        credentials = self.server.credentials()
+        self.server.stop()
+        for _ in range(3):
+            self.assertRaises(socket.error, SshClient, credentials)
+        start = time.time()
+        self.assertRaises(HostUnavailableError, SshClient, credentials)
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_run_command(self):
+        """ Both streams are drained and the exit code returned """
+        self.assertEqual(self.client._run_command(
+            'seq 1 100000; echo err >&2; exit 2', 10),
+            (''.join(str(i) + '\n' for i in range(1, 100001)), 'err\n', 2))
+
+    def test_stream_shell_command(self):
+        """ Output lines are yielded as they arrive """
+        with self.client.stream_shell_command(
+                'echo first; echo err >&2; sleep 0.5; printf "a\\nb"; '
+                'exit 3') as stream:
+            lines = iter(stream)
+            start = time.time()
+            self.assertEqual(next(lines), 'first')
+            self.assertLess(time.time() - start, 0.5)
+            self.assertEqual(list(lines), ['a', 'b'])
+            self.assertEqual(stream.stderr, 'err\n')
+            self.assertEqual(stream.exit_code, 3)
+
+    def test_stream_states(self):
+        """ Job states are parsed from the streamed output """
+        with open(os.path.join(self.workdir, 'msomonitor.data'), 'w') as data:
+            data.write(''.join('job' + str(i) + ',' + str(i % 2) + '\n'
+                               for i in range(10000)))
+        wm = WorkloadManager.factory("BASH")
+        states = wm.get_states(self.workdir,
+                               self.server.credentials(),
+                               ['job0'],
+                               logging.getLogger('TestSshClient'))
+        SshConnectionPool().close_all()
+        self.assertEqual(len(states), 10000)
+        self.assertEqual(states['job0'], 'COMPLETED')
+        self.assertEqual(states['job1'], 'FAILED')
+
+    def test_concurrent_commands(self):
+        """ Commands run in parallel channels of one connection """
+        start = time.time()
+        results = self.client.execute_shell_commands(
+            ['sleep 0.5; echo ' + str(i) for i in range(5)])
+        elapsed = time.time() - start
+
+        self.assertEqual(results, [(str(i) + '\n', 0) for i in range(5)])
+        self.assertLess(elapsed, 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrent_commands_max_sessions(self):
+        """ Concurrent commands are bounded by max_sessions """
+        self.client.close_connection()
+        self.client = SshClient(self.server.credentials(max_sessions=1))
+        start = time.time()
+        results = [self.client.submit_shell_command('sleep 0.3; exit 3')
+                   for _ in range(3)]
+        self.assertEqual([result.get() for result in results],
+                         [('', 3)] * 3)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_batch(self):
+        """ Batched commands keep their own outputs and exit codes """
+        results = self.client.execute_batch(['echo out; echo err >&2',
+                                             'printf "no newline"',
+                                             'exit 4',
+                                             'echo $VAR; pwd'],
+                                            workdir=self.workdir,
+                                            env={'VAR': 'value'})
+        self.assertEqual(results, [('out\n', 'err\n', 0),
+                                   ('no newline', '', 0),
+                                   ('', '', 4),
+                                   ('value\n' + self.workdir + '\n', '', 0)])
+        self.assertEqual(len(self.server.commands), 1)
+
+    def test_batch_stop_on_error(self):
+        """ Batch stops at the first failing command """
+        results = self.client.execute_batch(['true', 'false', 'echo no'],
+                                            stop_on_error=True)
+        self.assertEqual(results, [('', '', 0),
+                                   ('', '', 1),
+                                   (None, None, None)])
+
+    def test_persistent_session(self):
+        """ Login shell commands share one remote shell session """
+        self.client.close_connection()
+        self.client = SshClient(self.server.credentials(
+            login_shell=True, persistent_session=True))
+        results = [self.client.execute_shell_command(cmd, wait_result=True)
+                   for cmd in ['echo out; echo err >&2',
+                               'printf "no newline"',
+                               'cd /; exit 4',
+                               'pwd; cat']]
+        self.assertEqual(results, [('out\n', 0),
+                                   ('no newline', 0),
+                                   ('', 4),
+                                   (self.workdir + '\n', 0)])
+        self.assertEqual(self.server.commands, ['bash -l -s'])
+
+    def test_create_new_workdir(self):
+        """ New workdirs never reuse an existing directory """
+        wm = WorkloadManager.factory("SLURM")
+        logger = logging.getLogger('TestSshClient')
+        first = wm.create_new_workdir(self.client, self.workdir, 'test',
+                                      logger)
+        second = wm.create_new_workdir(self.client, self.workdir, 'test',
+                                       logger)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertNotEqual(first, second)
+
+    def test_put_files(self):
+        """ Files are uploaded through SFTP replacing stale contents """
+        with open(os.path.join(self.workdir, 'script.sh'), 'w') as stale:
+            stale.write('stale contents\n')
+        self.client.put_files([('#!/bin/sh\necho "$1 `x` \\$HOME"\n',
+                                'script.sh',
+                                0o755),
+                               (io.BytesIO('data'), 'data.txt', 0o600)],
+                              workdir='$HOME')
+
+        with open(os.path.join(self.workdir, 'script.sh')) as script:
+            self.assertEqual(script.read(),
+                             '#!/bin/sh\necho "$1 `x` \\$HOME"\n')
+        with open(os.path.join(self.workdir, 'data.txt')) as data:
+            self.assertEqual(data.read(), 'data')
+        self.assertEqual(
+            os.stat(os.path.join(self.workdir, 'script.sh')).st_mode & 0o777,
+            0o755)
+        self.assertEqual(
+            os.stat(os.path.join(self.workdir, 'data.txt')).st_mode & 0o777,
+            0o600)
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         ['data.txt', 'script.sh'])
+
+    def test_create_shell_script(self):
+        """ Shell scripts are uploaded executable """
+        wm = WorkloadManager.factory("SLURM")
+        logger = logging.getLogger('TestSshClient')
+        self.assertTrue(wm._create_shell_script(self.client,
+                                                'test.sh',
+                                                'echo "$0"\n',
+                                                logger,
+                                                workdir=self.workdir))
+        output, exit_code = self.client.execute_shell_command(
+            './test.sh', workdir=self.workdir, wait_result=True)
+        self.assertEqual((output, exit_code), ('./test.sh\n', 0))
+
+    def test_probe(self):
+        """ Probes are run once per host and user until invalidated """
+        command = 'echo x >> probes; wc -l < probes'
+        self.assertEqual(self.client.probe(command), ('1\n', 0))
+        other = SshClient(self.server.credentials())
+        try:
+            self.assertEqual(other.probe(command), ('1\n', 0))
+        finally:
+            other.close_connection()
+        self.client.invalidate_probes(command)
+        self.assertEqual(self.client.probe(command), ('2\n', 0))
+        self.client.invalidate_probes()
+        self.assertEqual(self.client.probe(command, ttl=0), ('3\n', 0))
+        self.assertEqual(self.client.probe(command), ('4\n', 0))
+
+    def test_failed_probe(self):
+        """ Failed probes are not cached """
+        command = 'echo x >> probes; exit 1'
+        self.client.probe(command)
+        self.client.probe(command)
+        with open(os.path.join(self.workdir, 'probes')) as probes:
+            self.assertEqual(probes.read(), 'x\nx\n')
+
+    def test_host_facts(self):
+        """ Host facts are gathered once and resolve the home directory """
+        facts = self.client.get_host_facts()
+        self.assertEqual(facts['home'], self.workdir)
+        self.assertEqual(facts['os'], os.uname()[0])
+        self.assertEqual(facts['binaries'], {})
+        commands = len(self.server.commands)
+        self.assertIs(self.client.get_host_facts(), facts)
+        self.assertEqual(self.client._resolve_remote_path('~/dir'),
+                         self.workdir + '/dir')
+        self.assertEqual(len(self.server.commands), commands)
+
+    def test_cache_host_facts(self):
+        """ Host facts of previous operations are reused """
+        SshClient.cache_host_facts(self.server.credentials(),
+                                   {'home': '/remote/home',
+                                    'binaries': {},
+                                    'versions': {}})
+        self.assertEqual(self.client.get_host_facts()['home'],
+                         '/remote/home')
+        self.assertEqual(self.client._resolve_remote_path('$HOME/dir'),
+                         '/remote/home/dir')
+        self.assertEqual(self.server.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
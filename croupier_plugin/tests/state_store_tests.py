@@ -0,0 +1,124 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+state_store_tests.py: Holds the job states timeline tests
+'''
+
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from croupier_plugin.state_store import StateStore
+
+
+class TestStateStore(unittest.TestCase):
+    """ Holds the state store tests, over a temporary file """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store', 'states.db')
+        self.store = StateStore()
+        self.store.open(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _record_lifecycle(self, deployment, execution, instance, start):
+        for offset, state in enumerate(['PENDING', 'RUNNING', 'COMPLETED']):
+            self.store.record(deployment, execution, instance,
+                              'croupier' + instance, '1', state,
+                              start + offset * 10)
+
+    def test_timeline(self):
+        """ State changes are queried by deployment, execution and time """
+        self._record_lifecycle('dep', 'exec1', 'job_a', 100)
+        self._record_lifecycle('dep', 'exec2', 'job_a', 200)
+        self._record_lifecycle('other', 'exec3', 'job_b', 100)
+        self.store.flush()
+
+        self.assertEqual([(t.execution, t.state, t.at)
+                          for t in self.store.timeline(deployment='dep')],
+                         [('exec1', 'PENDING', 100),
+                          ('exec1', 'RUNNING', 110),
+                          ('exec1', 'COMPLETED', 120),
+                          ('exec2', 'PENDING', 200),
+                          ('exec2', 'RUNNING', 210),
+                          ('exec2', 'COMPLETED', 220)])
+        self.assertEqual([t.state for t in self.store.timeline(
+                             execution='exec2', since=210, until=220)],
+                         ['RUNNING'])
+        self.assertEqual(len(self.store.timeline()), 9)
+
+    def test_last_states(self):
+        """ The last state of each instance is kept to resume """
+        self._record_lifecycle('dep', 'exec1', 'job_a', 100)
+        self.store.record('dep', 'exec1', 'job_b', 'croupierjob_b', None,
+                          'PENDING', 105)
+        self.store.close()
+
+        # also from other processes, once written
+        last = StateStore().last_states('exec1', path=self.path)
+        self.assertEqual(dict((instance, transition.state)
+                              for instance, transition in last.items()),
+                         {'job_a': 'COMPLETED', 'job_b': 'PENDING'})
+        self.assertIsNone(last['job_b'].job_id)
+
+    def test_batched_writes(self):
+        """ Recording does not wait for the disk """
+        start = time.time()
+        for index in range(2000):
+            self.store.record('dep', 'exec', 'job' + str(index),
+                              'croupier' + str(index), str(index),
+                              'PENDING')
+        self.assertLess(time.time() - start, 1)
+        self.store.flush()
+        self.assertEqual(len(self.store.timeline(execution='exec')), 2000)
+
+    def test_closed(self):
+        """ Nothing is recorded while the store is closed """
+        self.store.close()
+        self.assertFalse(self.store.is_open())
+        self.store.record('dep', 'exec', 'job', 'croupierjob', '1',
+                          'PENDING')
+        self.store.flush()
+        self.assertEqual(self.store.timeline(path=self.path), [])
+
+    def test_open_failure(self):
+        """ Stores that cannot be opened stay closed """
+        blocker = os.path.join(self.directory, 'file')
+        open(blocker, 'w').close()
+        for path in [os.path.join(blocker, 'states.db'),
+                     os.path.join(blocker, 'store', 'states.db')]:
+            self.assertRaises((OSError, sqlite3.Error), self.store.open, path)
+        self.assertFalse(self.store.is_open())
+        self.store.record('dep', 'exec', 'job', 'croupierjob', '1',
+                          'PENDING')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+status_cache_tests.py: Holds the shared job states tests
+'''
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from croupier_plugin.status_cache import StatusCache
+
+
+class TestStatusCache(unittest.TestCase):
+    """ Holds the status cache tests, over a temporary file """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'cache', 'status.db')
+        # two executions of the manager
+        self.cache = StatusCache(path)
+        self.other = StatusCache(path)
+        self.settings = {'config': {'host': 'hpc', 'user': 'croupier'},
+                         'names': ['job'],
+                         'ids': {'job': '7'},
+                         'period': 60}
+
+    def tearDown(self):
+        self.cache.close()
+        self.other.close()
+        shutil.rmtree(self.directory)
+
+    def test_fresh_states(self):
+        """ States are shared while they are fresh """
+        self.assertIsNone(self.cache.get('hpc', self.settings, 0))
+        self.cache.put('hpc', self.settings, {'job': 'RUNNING'}, 0)
+        self.assertEqual(self.other.get('hpc', self.settings, 59),
+                         {'job': 'RUNNING'})
+        self.assertIsNone(self.other.get('hpc', self.settings, 60))
+
+    def test_keys(self):
+        """ States are kept by host, port, user, scope and job id """
+        self.cache.put('hpc', self.settings, {'job': 'RUNNING'}, 0)
+        for host, config, ids, scope in [
+                ('other', self.settings['config'], {'job': '7'}, None),
+                ('hpc', dict(self.settings['config'], port=2222),
+                 {'job': '7'}, None),
+                ('hpc', dict(self.settings['config'], user='other'),
+                 {'job': '7'}, None),
+                ('hpc', self.settings['config'], {'job': '8'}, None),
+                ('hpc', self.settings['config'], {'job': '7'}, '/wB')]:
+            self.assertIsNone(self.other.get(
+                host,
+                dict(self.settings, config=config, ids=ids, scope=scope),
+                1))
+        # jobs without id are found by name
+        self.assertEqual(self.other.get(host, dict(self.settings, ids={}), 1),
+                         {'job': 'RUNNING'})
+
+    def test_missing_jobs(self):
+        """ Jobs not found by the poll are not polled again """
+        self.cache.put('hpc', self.settings, {}, 0)
+        self.assertEqual(self.other.get('hpc', self.settings, 1), {})
+
+    def test_shared_settings(self):
+        """ Polls include the jobs watched by every execution """
+        other_settings = dict(self.settings,
+                              names=['other_job'],
+                              ids={'other_job': '8'})
+        self.assertIsNone(self.other.get('hpc', other_settings, 0))
+        shared = self.cache.shared_settings('hpc', self.settings, 1)
+        self.assertEqual(shared['names'], ['job', 'other_job'])
+        self.assertEqual(shared['ids'], {'job': '7', 'other_job': '8'})
+
+        self.cache.put('hpc', shared, {'job': 'RUNNING',
+                                       'other_job': 'PENDING'}, 1)
+        self.assertEqual(self.other.get('hpc', other_settings, 2),
+                         {'other_job': 'PENDING'})
+
+        # jobs of other executions not found are polled by them again
+        self.cache.put('hpc', shared, {'job': 'RUNNING'}, 3)
+        self.assertIsNone(self.other.get('hpc', other_settings, 4))
+
+        # the jobs stop being watched after a couple of periods
+        shared = self.cache.shared_settings('hpc', self.settings, 200)
+        self.assertEqual(shared['names'], ['job'])
+
+    def test_scoped_jobs(self):
+        """ Jobs read from a workdir are only polled from it """
+        settings = dict(self.settings, scope='/wA')
+        other_settings = dict(self.settings,
+                              names=['other_job'],
+                              ids={'other_job': '8'},
+                              scope='/wB')
+        self.assertIsNone(self.other.get('hpc', other_settings, 0))
+        shared = self.cache.shared_settings('hpc', settings, 1)
+        self.assertEqual(shared['names'], ['job'])
+        self.cache.put('hpc', shared, {}, 1)
+        self.assertEqual(self.cache.get('hpc', settings, 2), {})
+        self.assertIsNone(self.other.get('hpc', other_settings, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -264,6 +264,23 @@ class TestTorque(unittest.TestCase):
 
         self.assertDictEqual(parsed, {})
 
+    def test_parse_submitted_jobid(self):
+        """ Parse job ids from qsub """
+        self.assertEqual(self.wm._parse_job_id("12.some.host\n"),
+                         '12.some.host')
+        self.assertEqual(self.wm._parse_job_id("12[].some.host\n"),
+                         '12[].some.host')
+        self.assertEqual(self.wm._parse_job_id("12.host\n13.host\n"),
+                         '12.host 13.host')
+        self.assertIsNone(self.wm._parse_job_id("qsub: error\n"))
+
+    def test_get_walltime(self):
+        """ Parse Torque walltimes """
+        self.assertEqual(self.wm.get_walltime('30'), 30)
+        self.assertEqual(self.wm.get_walltime('30:15'), 1815)
+        self.assertEqual(self.wm.get_walltime('01:30:15'), 5415)
+        self.assertIsNone(self.wm.get_walltime('1-02:30'))
+
 
 if __name__ == '__main__':
     unittest.main()
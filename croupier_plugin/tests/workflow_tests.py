@@ -26,10 +26,14 @@ workflow_tests.py
 
 import logging
 import os
+import time
 import unittest
 
 import yaml
 from cloudify.test_utils import workflow_test
+from cloudify.workflows import tasks
+from croupier_plugin import workflows
+from croupier_plugin.workflows import JobGraphInstance, Monitor
 
 
 class TestPlugin(unittest.TestCase):
@@ -429,5 +433,179 @@ class TestPlugin(unittest.TestCase):
             logging.warning('[WARNING] Login could not be tested')
 
 
+class _Stub(object):
+    """ Object with the given attributes """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def _job_instance(instance_id, host, workdir, queued_id=None, **properties):
+    """ Job instance of a node, as built by the workflow, whose operations
+    succeed and queue it with `queued_id` """
+    runtime_properties = {'simulate': False,
+                          'credentials': {'host': host},
+                          'workdir': workdir,
+                          'external_monitor_entrypoint': '',
+                          'workload_manager': 'SLURM',
+                          'monitor_period': 60,
+                          'job_prefix': instance_id.split('_')[0] + '_'}
+    runtime_properties.update(properties)
+    task = _Stub(wait_for_terminated=lambda: None,
+                 get_state=lambda: tasks.TASK_SUCCEEDED)
+    parent = _Stub(is_job=True, cfy_node=_Stub(properties={}))
+    instance = _Stub(id=instance_id,
+                     _node_instance=_Stub(
+                         runtime_properties=runtime_properties),
+                     send_event=lambda message: None,
+                     execute_operation=lambda operation, kwargs: _Stub(
+                         task=task, get=lambda: queued_id))
+    return JobGraphInstance(parent, instance)
+
+
+class _StubRequester(object):
+    """ Answers the requests of the monitor with the given states """
+
+    def __init__(self, states=None, next_poll=None, events_after=None):
+        self.states = states or {}
+        self.requests = []
+        self._next_poll = next_poll
+        # checks without events before some job reports its completion
+        self._events_after = events_after
+
+    def request(self, monitor_jobs, logger):  # pylint: disable=W0613
+        self.requests.append(monitor_jobs)
+        return dict(self.states)
+
+    def next_poll(self):
+        return self._next_poll
+
+    def has_events(self):
+        if self._events_after is None:
+            return False
+        self._events_after -= 1
+        return self._events_after < 0
+
+
+class TestMonitor(unittest.TestCase):
+    """ Test the monitoring of the running job instances """
+
+    def setUp(self):
+        self.logger = logging.getLogger('TestMonitor')
+        # the state changes are recorded outside a workflow context
+        self.ctx = workflows.ctx
+        workflows.ctx = _Stub(deployment=_Stub(id='deployment'),
+                              execution_id='execution',
+                              logger=self.logger)
+
+    def tearDown(self):
+        workflows.ctx = self.ctx
+
+    def _monitor(self, requester):
+        monitor = Monitor({}, self.logger)
+        monitor.jobs_requester = requester
+        return monitor
+
+    def _wait(self, monitor):
+        start = time.time()
+        monitor.wait()
+        return time.time() - start
+
+    def test_wait(self):
+        """ Waits until the next poll is due """
+        self.assertLess(self._wait(self._monitor(_StubRequester(
+            next_poll=0))), 0.5)
+        elapsed = self._wait(self._monitor(_StubRequester(next_poll=1.5)))
+        self.assertGreaterEqual(elapsed, 1.5)
+        self.assertLess(elapsed, 2)
+        # nothing polled yet
+        elapsed = self._wait(self._monitor(_StubRequester()))
+        self.assertGreaterEqual(elapsed, workflows.LOOP_PERIOD)
+        self.assertLess(elapsed, workflows.LOOP_PERIOD + 0.5)
+
+    def test_wait_events(self):
+        """ Jobs reporting their completion wake the monitor up """
+        monitor = self._monitor(_StubRequester(next_poll=60,
+                                               events_after=1))
+        self.assertLess(self._wait(monitor),
+                        workflows.LOOP_PERIOD + 0.5)
+        monitor = self._monitor(_StubRequester(next_poll=60))
+        monitor._nodes_added = True
+        self.assertLess(self._wait(monitor), 0.5)
+
+    def test_job_ids(self):
+        """ The ids given by the workload manager reach the requester """
+        job_instance = _job_instance('job_1', 'hpc', '/job', queued_id='42')
+        self.assertIsNone(job_instance.job_id)
+        job_instance.queue()
+        self.assertEqual(job_instance.job_id, '42')
+
+        requester = _StubRequester(states={'job_1': 'COMPLETED'})
+        monitor = self._monitor(requester)
+        monitor.job_instances_map['job_1'] = job_instance
+        monitor.add_node(_Stub(name='job',
+                               is_job=True,
+                               instances=[job_instance]))
+        monitor.update_status()
+        self.assertEqual(requester.requests[0]['hpc']['ids'],
+                         {'job_1': '42'})
+        self.assertEqual(requester.requests[0]['hpc']['names'], ['job_1'])
+        self.assertTrue(job_instance.completed)
+        # finished jobs are no longer polled
+        monitor.update_status()
+        self.assertEqual(requester.requests[1], {})
+
+    def test_monitor_events(self):
+        """ Only jobs writing their completion record report it """
+        self.assertTrue(_job_instance('job_1', 'hpc', '/job',
+                                      monitor_events=True).monitor_events)
+        self.assertFalse(_job_instance('job_1', 'hpc', '/job',
+                                       monitor_events=True,
+                                       workload_manager='SPARK')
+                         .monitor_events)
+
+    def test_monitor_agent(self):
+        """ Only jobs of the workload managers the agent knows follow it """
+        self.assertTrue(_job_instance('job_1', 'hpc', '/job',
+                                      monitor_agent=True).monitor_agent)
+        bash = _job_instance('bash_1', 'hpc', '/bash',
+                             monitor_agent=True,
+                             workload_manager='BASH')
+        self.assertFalse(bash.monitor_agent)
+        monitor = Monitor({}, self.logger)
+        monitor._add_active_job(bash)
+        settings = monitor._active_jobs['hpc']['settings']
+        self.assertFalse(settings['agent'])
+        self.assertIsNone(monitor.jobs_requester._listener_class(settings))
+
+    def test_host_settings(self):
+        """ Hosts are monitored as their first running instance says """
+        first = _job_instance('first_1', 'hpc', '/first',
+                              job_id='1', workload_manager='BASH')
+        second = _job_instance('second_1', 'hpc', '/second', job_id='2')
+        other = _job_instance('other_1', 'hpc2', '/other')
+        monitor = Monitor({}, self.logger)
+        for job_instance in [first, second, other]:
+            monitor._add_active_job(job_instance)
+
+        settings = monitor._active_jobs['hpc']['settings']
+        self.assertEqual(settings['workdir'], '/first')
+        self.assertEqual(settings['type'], 'BASH')
+        self.assertEqual(settings['ids'], {'first_1': '1', 'second_1': '2'})
+        self.assertEqual(monitor._active_jobs['hpc2']['settings']['workdir'],
+                         '/other')
+
+        monitor._remove_active_job(first)
+        settings = monitor._active_jobs['hpc']['settings']
+        self.assertEqual(settings['workdir'], '/second')
+        self.assertEqual(settings['type'], 'SLURM')
+        self.assertEqual(settings['ids'], {'second_1': '2'})
+        self.assertEqual(monitor._active_jobs['hpc']['instances'].keys(),
+                         ['second_1'])
+
+        monitor._remove_active_job(second)
+        self.assertEqual(monitor._active_jobs.keys(), ['hpc2'])
+
+
 if __name__ == '__main__':
     unittest.main()
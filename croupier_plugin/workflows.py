@@ -24,13 +24,19 @@ license information in the project root.
 workflows.py - Holds the plugin workflows
 '''
 
+import sqlite3
 import sys
 import time
+from collections import OrderedDict
 
 from cloudify.decorators import workflow
 from cloudify.workflows import ctx, api, tasks
 from croupier_plugin.job_requester import JobRequester
+from croupier_plugin.monitor_agent import SCHEDULERS
+from croupier_plugin.state_store import StateStore
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
 
+# Seconds between checks for cancel requests while waiting for the next poll
 LOOP_PERIOD = 1
 
 
@@ -67,11 +73,47 @@ class JobGraphInstance(object):
                 self.monitor_config = runtime_properties["credentials"]
 
             self.monitor_period = int(runtime_properties["monitor_period"])
+            self.monitor_min_period = int(runtime_properties.get(
+                "monitor_min_period", self.monitor_period))
+            self.monitor_max_period = int(runtime_properties.get(
+                "monitor_max_period", self.monitor_period))
+            wm = WorkloadManager.factory(
+                runtime_properties["workload_manager"])
+            # only jobs monitored through ssh report their completion, if
+            # their workload manager writes the record
+            self.monitor_events = \
+                bool(runtime_properties.get("monitor_events", False)) and \
+                not runtime_properties["external_monitor_entrypoint"]
+            if self.monitor_events and not (wm and wm.completion_records):
+                ctx.logger.warning(
+                    "Jobs of " + runtime_properties["workload_manager"] +
+                    " do not report their completion, '" + instance.id +
+                    "' will be polled")
+                self.monitor_events = False
+            self.monitor_agent = \
+                bool(runtime_properties.get("monitor_agent", False)) and \
+                not runtime_properties["external_monitor_entrypoint"]
+            if self.monitor_agent and \
+                    runtime_properties["workload_manager"] not in SCHEDULERS:
+                ctx.logger.warning(
+                    "The agent does not follow jobs of " +
+                    runtime_properties["workload_manager"] + ", '" +
+                    instance.id + "' will be polled")
+                self.monitor_agent = False
+
+            # expected run time, to poll the job around its end
+            self.walltime = None
+            job_options = parent.cfy_node.properties.get('job_options', {})
+            if wm and job_options.get('max_time'):
+                self.walltime = wm.get_walltime(job_options['max_time'])
 
             # build job name
             instance_components = instance.id.split('_')
             self.name = runtime_properties["job_prefix"] +\
                 instance_components[-1]
+
+            # given by the workload manager when the job is queued
+            self.job_id = runtime_properties.get("job_id")
         else:
             self._status = 'NONE'
             self.name = instance.id
@@ -92,6 +134,7 @@ class JobGraphInstance(object):
         else:
             self.winstance.send_event('.. job queued')
             init_state = 'PENDING'
+            self.job_id = result.get()
         self.set_status(init_state)
         return result.task
 
@@ -110,11 +153,23 @@ class JobGraphInstance(object):
 
         return result.task
 
+    def _record_status(self):
+        """ Keeps the state change in the timeline of the manager """
+        if not self.parent_node.is_job:
+            return
+        StateStore().record(ctx.deployment.id,
+                            ctx.execution_id,
+                            self.winstance.id,
+                            self.name,
+                            self.job_id,
+                            self._status)
+
     def set_status(self, status):
         """ Update the instance state """
         if not status == self._status:
             self._status = status
             self.winstance.send_event('State changed to ' + self._status)
+            self._record_status()
 
             self.completed = not self.parent_node.is_job or \
                 (self._status == 'COMPLETED')
@@ -163,6 +218,7 @@ class JobGraphInstance(object):
         result.task.wait_for_terminated()
 
         self._status = 'CANCELLED'
+        self._record_status()
 
 
 class JobGraphNode(object):
@@ -332,44 +388,46 @@ class Monitor(object):
         self.job_instances_map = job_instances_map
         self.logger = logger
         self.jobs_requester = JobRequester()
+        # new nodes are monitored without waiting for the next poll
+        self._nodes_added = False
+        # host -> monitor settings and the job instances still running in
+        # it, updated as nodes are added and jobs finish
+        self._active_jobs = {}
 
     def update_status(self):
         """Gets all executing instances and update their state"""
+        self._nodes_added = False
 
         # first get the instances we need to check
         monitor_jobs = {}
-        for _, job_node in self.get_executions_iterator():
-            if job_node.is_job:
-                for job_instance in job_node.instances:
-                    if not job_instance.simulate:
-                        if job_instance.host in monitor_jobs:
-                            monitor_jobs[job_instance.host]['names'].append(
-                                job_instance.name)
-                        else:
-                            monitor_jobs[job_instance.host] = {
-                                'config': job_instance.monitor_config,
-                                'type': job_instance.monitor_type,
-                                'workdir': job_instance.workdir,
-                                'names': [job_instance.name],
-                                'period': job_instance.monitor_period
-                            }
-                    else:
-                        job_instance.set_status('COMPLETED')
-
-        # nothing to do if we don't have nothing to monitor
-        if not monitor_jobs:
-            return
+        for host, active in self._active_jobs.iteritems():
+            monitor_jobs[host] = dict(active['settings'],
+                                      names=active['instances'].keys())
 
-        # then look for the status of the instances through its name
+        # then look for the status of the instances through its name, hosts
+        # without jobs to monitor are no longer polled
         states = self.jobs_requester.request(monitor_jobs, self.logger)
 
         # finally set job status
         for inst_name, state in states.iteritems():
-            self.job_instances_map[inst_name].set_status(state)
-
-        # We wait to slow down the loop
+            job_instance = self.job_instances_map[inst_name]
+            job_instance.set_status(state)
+            if job_instance.completed or job_instance.failed:
+                self._remove_active_job(job_instance)
+
+    def wait(self):
+        """ Sleeps until the next poll is due, new nodes are added, some
+        job reports its completion or the execution is cancelled """
         sys.stdout.flush()  # necessary to output work properly with sleep
-        time.sleep(LOOP_PERIOD)
+        next_poll = self.jobs_requester.next_poll()
+        deadline = time.time() + \
+            (LOOP_PERIOD if next_poll is None else next_poll)
+        while not self._nodes_added and not api.has_cancel_request() and \
+                not self.jobs_requester.has_events():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, LOOP_PERIOD))
 
     def get_executions_iterator(self):
         """ Executing nodes iterator """
@@ -378,10 +436,60 @@ class Monitor(object):
     def add_node(self, node):
         """ Adds a node to the execution pool """
         self._execution_pool[node.name] = node
+        self._nodes_added = True
+        if not node.is_job:
+            return
+
+        for job_instance in node.instances:
+            if job_instance.simulate:
+                job_instance.set_status('COMPLETED')
+            elif not job_instance.completed and not job_instance.failed:
+                self._add_active_job(job_instance)
 
     def finish_node(self, node_name):
         """ Delete a node from the execution pool """
-        del self._execution_pool[node_name]
+        node = self._execution_pool.pop(node_name)
+        if node.is_job:
+            for job_instance in node.instances:
+                self._remove_active_job(job_instance)
+
+    def _add_active_job(self, job_instance):
+        """ Starts monitoring a job instance """
+        active = self._active_jobs.setdefault(job_instance.host,
+                                              {'instances': OrderedDict()})
+        active['instances'][job_instance.name] = job_instance
+        self._update_settings(active)
+
+    def _remove_active_job(self, job_instance):
+        """ Stops monitoring a job instance """
+        active = self._active_jobs.get(job_instance.host)
+        if active is None:
+            return
+        active['instances'].pop(job_instance.name, None)
+        if active['instances']:
+            self._update_settings(active)
+        else:
+            del self._active_jobs[job_instance.host]
+
+    @staticmethod
+    def _update_settings(active):
+        """ The host is monitored as its first running instance says """
+        instances = active['instances'].values()
+        first = instances[0]
+        active['settings'] = {
+            'config': first.monitor_config,
+            'type': first.monitor_type,
+            'workdir': first.workdir,
+            'period': first.monitor_period,
+            'min_period': first.monitor_min_period,
+            'max_period': first.monitor_max_period,
+            'events': first.monitor_events,
+            'agent': first.monitor_agent,
+            'walltimes': dict((instance.name, instance.walltime)
+                              for instance in instances if instance.walltime),
+            'ids': dict((instance.name, instance.job_id)
+                        for instance in instances if instance.job_id)
+        }
 
     def is_something_executing(self):
         """ True if there are nodes executing """
@@ -389,50 +497,69 @@ class Monitor(object):
 
 
 @workflow
-def run_jobs(**kwargs):  # pylint: disable=W0613
+def run_jobs(status_cache=None,
+             state_store=None,
+             **kwargs):  # pylint: disable=W0613
     """ Workflow to execute long running batch operations """
-
     root_nodes, job_instances_map = build_graph(ctx.nodes)
     monitor = Monitor(job_instances_map, ctx.logger)
+    # executions polling the same hosts share their job states
+    monitor.jobs_requester.use_status_cache(status_cache)
+    # every state change of the jobs is kept in the manager
+    if state_store:
+        try:
+            StateStore().open(state_store)
+        except (sqlite3.Error, OSError) as err:
+            ctx.logger.warning("Cannot record the job states: " + str(err))
 
-    # Execution of first job instances
-    tasks_list = []
-    for root in root_nodes:
-        tasks_list += root.queue_all_instances()
-        monitor.add_node(root)
-    wait_tasks_to_finish(tasks_list)
-
-    # Monitoring and next executions loop
-    while monitor.is_something_executing() and not api.has_cancel_request():
-        # Monitor the infrastructure
-        monitor.update_status()
-        exec_nodes_finished = []
-        new_exec_nodes = []
-        for node_name, exec_node in monitor.get_executions_iterator():
-            if exec_node.check_status():
-                if exec_node.completed:
-                    exec_node.clean_all_instances()
-                    exec_nodes_finished.append(node_name)
-                    new_nodes_to_execute = exec_node.get_children_ready()
-                    for new_node in new_nodes_to_execute:
-                        new_exec_nodes.append(new_node)
-            else:
-                # Something went wrong in the node, cancel execution
-                cancel_all(monitor.get_executions_iterator())
-                return
-
-        # remove finished nodes
-        for node_name in exec_nodes_finished:
-            monitor.finish_node(node_name)
-        # perform new executions
+    try:
+        # Execution of first job instances
         tasks_list = []
-        for new_node in new_exec_nodes:
-            tasks_list += new_node.queue_all_instances()
-            monitor.add_node(new_node)
+        for root in root_nodes:
+            tasks_list += root.queue_all_instances()
+            monitor.add_node(root)
         wait_tasks_to_finish(tasks_list)
 
-    if monitor.is_something_executing():
-        cancel_all(monitor.get_executions_iterator())
+        # Monitoring and next executions loop
+        while monitor.is_something_executing() and \
+                not api.has_cancel_request():
+            # Monitor the infrastructure
+            monitor.update_status()
+            exec_nodes_finished = []
+            new_exec_nodes = []
+            for node_name, exec_node in monitor.get_executions_iterator():
+                if exec_node.check_status():
+                    if exec_node.completed:
+                        exec_node.clean_all_instances()
+                        exec_nodes_finished.append(node_name)
+                        new_nodes_to_execute = exec_node.get_children_ready()
+                        for new_node in new_nodes_to_execute:
+                            new_exec_nodes.append(new_node)
+                else:
+                    # Something went wrong in the node, cancel execution
+                    cancel_all(monitor.get_executions_iterator())
+
+            # remove finished nodes
+            for node_name in exec_nodes_finished:
+                monitor.finish_node(node_name)
+            # perform new executions
+            tasks_list = []
+            for new_node in new_exec_nodes:
+                tasks_list += new_node.queue_all_instances()
+                monitor.add_node(new_node)
+            wait_tasks_to_finish(tasks_list)
+
+            # We wait until the next poll is due to slow down the loop
+            monitor.wait()
+
+        if monitor.is_something_executing():
+            # the cancellations are recorded before the store is closed
+            cancel_all(monitor.get_executions_iterator())
+    finally:
+        # also when the execution is cancelled or fails
+        monitor.jobs_requester.reset()
+        monitor.jobs_requester.use_status_cache(None)
+        StateStore().close()
 
     ctx.logger.info(
         "------------------Workflow Finished-----------------------")
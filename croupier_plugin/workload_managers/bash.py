@@ -25,11 +25,14 @@ bash.py
 '''
 
 
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.metrics import instrumented
+from croupier_plugin.ssh import SshConnectionPool
 from croupier_plugin.workload_managers import workload_manager
 
 
 class Bash(workload_manager.WorkloadManager):
+    workdir_states = True
+    completion_records = True
 
     def _build_job_submission_call(self, name, job_settings, logger):
         # check input information correctness
@@ -62,6 +65,10 @@ class Bash(workload_manager.WorkloadManager):
             for entry in job_settings['post']:
                 bash_call += entry + '; '
 
+        if 'completion_record' in job_settings:
+            bash_call += self._quote_in_double_quotes(
+                job_settings['completion_record']) + '; '
+
         # Run in the background detached from terminal
         bash_call = 'nohup sh -c "' + bash_call + '" &'
 
@@ -69,36 +76,35 @@ class Bash(workload_manager.WorkloadManager):
         response['call'] = bash_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def _build_job_cancellation_call(self, name, job_settings, logger,
+                                     job_id=None):
         return "pkill -f " + name
 
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    @instrumented
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None):
         # TODO set start time of consulting
         # (sacct only check current day)
         call = "cat msomonitor.data"
 
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-
-        client.close_connection()
+        with SshConnectionPool().connection(credentials) as client:
+            with client.stream_shell_command(call, workdir=workdir) as output:
+                states = self._parse_states(output, logger)
+                exit_code = output.exit_code
 
-        states = {}
-        if exit_code == 0:
-            states = self._parse_states(output, logger)
+        if exit_code != 0:
+            states = {}
 
         return states
 
     def _parse_states(self, raw_states, logger):
-        """ Parse two colums exit codes into a dict """
-        jobs = raw_states.splitlines()
+        """ Parse two colums exit codes (text or lines) into a dict """
+        if isinstance(raw_states, basestring):
+            raw_states = raw_states.splitlines()
         parsed = {}
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            for job in jobs:
+        for job in raw_states:
+            if job.strip():
                 first, second = job.strip().split(',')
                 parsed[first] = self._parse_exit_codes(second)
 
@@ -25,14 +25,106 @@ slurm.py: Holds the slurm functions
 '''
 
 
-from croupier_plugin.ssh import SshClient
+import re
+import time
+from threading import Lock
+
+from croupier_plugin.metrics import instrumented
+from croupier_plugin.ssh import SshConnectionPool
 from croupier_plugin.workload_managers.workload_manager import (
     WorkloadManager,
     get_prevailing_state)
 
+_PARSABLE_JOB_ID = re.compile(r"^(?P<id>\d+)(;\S+)?$")
+
+# states of the jobs that left the queue for good, the preempted jobs and
+# the ones of failed nodes may be requeued
+_FINISHED_STATES = ('BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE',
+                    'FAILED', 'OUT_OF_MEMORY', 'REVOKED', 'TIMEOUT')
+
+# seconds looked back by sacct from the first poll of a job never seen in
+# the queue, as the clocks of the manager and the cluster may differ
+_SACCT_MARGIN = 86400
+
+
+class _JobHistory(object):
+    """
+    What is known of the jobs of every host from previous polls
+
+    Keeps the submission time of the queued jobs, to bound the sacct
+    queries of the ones that leave the queue, and the final state of the
+    finished ones, that are not queried again. Jobs are kept by id when
+    known, so a job submitted again with the same name is not taken for the
+    finished one.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._finished = {}
+        self._submitted = {}
+        self._first_polled = {}
+
+    @staticmethod
+    def _key(host, name, job_ids):
+        if name in job_ids:
+            return (host, 'id', job_ids[name])
+        return (host, 'name', name)
+
+    def finished(self, host, names, job_ids):
+        """ Final states of the jobs already finished """
+        with self._lock:
+            keys = [(name, self._key(host, name, job_ids)) for name in names]
+            return dict((name, self._finished[key])
+                        for name, key in keys if key in self._finished)
+
+    def queued(self, host, names, submitted):
+        """ Keeps the submission time of the jobs, from their first poll
+        if they were not seen in the queue """
+        now = time.time()
+        with self._lock:
+            for name in names:
+                self._first_polled.setdefault((host, name), now)
+                if name in submitted:
+                    self._submitted.setdefault((host, name), submitted[name])
+
+    def start_time(self, host, names):
+        """ Earliest submission time of the jobs, in sacct format """
+        with self._lock:
+            times = [self._submitted[(host, name)] for name in names
+                     if (host, name) in self._submitted]
+            first_polled = [self._first_polled[(host, name)]
+                            for name in names
+                            if (host, name) not in self._submitted and
+                            (host, name) in self._first_polled]
+        if first_polled:
+            times.append(time.strftime(
+                '%Y-%m-%dT%H:%M:%S',
+                time.localtime(min(first_polled) - _SACCT_MARGIN)))
+        return min(times) if times else None
+
+    def finish(self, host, states, job_ids):
+        """ Keeps the final states of the jobs that finished """
+        with self._lock:
+            for name, state in states.iteritems():
+                if state in _FINISHED_STATES:
+                    self._finished[self._key(host, name, job_ids)] = state
+                    self._submitted.pop((host, name), None)
+                    self._first_polled.pop((host, name), None)
+
+    def clear(self):
+        with self._lock:
+            self._finished.clear()
+            self._submitted.clear()
+            self._first_polled.clear()
+
+
+_history = _JobHistory()
+
 
 class Slurm(WorkloadManager):
     """ Slurm Workload Manger Driver """
+    _job_id_variable = 'SLURM_JOB_ID'
+    completion_records = True
 
     def _build_container_script(self, name, job_settings, logger):
         # check input information correctness
@@ -143,15 +235,29 @@ class Slurm(WorkloadManager):
                 slurm_call += entry + '; '
 
         if job_settings['type'] == 'SRUN':
+            if 'completion_record' in job_settings:
+                slurm_call += self._quote_in_double_quotes(
+                    job_settings['completion_record']) + '; '
             # Run in the background detached from terminal
             slurm_call = 'nohup sh -c "' + slurm_call + '" &'
 
         response['call'] = slurm_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def _build_job_cancellation_call(self, name, job_settings, logger,
+                                     job_id=None):
+        if job_id:
+            return "scancel " + job_id
         return "scancel --name " + name
 
+    def _parse_job_id(self, output):
+        """ Job id printed by `sbatch --parsable`, as "id[;cluster]" """
+        for line in output.splitlines():
+            match = _PARSABLE_JOB_ID.match(line.strip())
+            if match:
+                return match.group('id')
+        return None
+
     def _parse_slurm_job_settings(self, job_id, job_settings, prefix, suffix):
         _prefix = prefix if prefix else ''
         _suffix = suffix if suffix else ''
@@ -219,35 +325,92 @@ class Slurm(WorkloadManager):
         return _settings
 
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
-        # TODO set start time of consulting
-        # (sacct only check current day)
-        call = "sacct -n -o JobName,State -X -P --name=" + ','.join(job_names)
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-
-        client.close_connection()
-
-        states = {}
-        if exit_code == 0:
-            states = self._parse_states(output, logger)
-        else:
+    @instrumented
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None):
+        """
+        Live jobs are read from the controller with squeue, and only the
+        ones that left the queue are read from the accounting database with
+        sacct, once. Jobs are looked up by id when known.
+        """
+        host = (credentials['host'], credentials.get('port', 22))
+        job_ids = job_ids or {}
+        states = _history.finished(host, job_names, job_ids)
+        names = [name for name in job_names if name not in states]
+        if not names:
+            return states
+
+        with SshConnectionPool().connection(credentials) as client:
+            # unknown ids make squeue fail, so both calls are always run
+            call = '; '.join(self._build_lookup_calls(
+                "squeue -h -o '%j|%T|%V'", names, job_ids))
+            with client.stream_shell_command(call, workdir=workdir) as output:
+                queued, submitted = self._parse_squeue(output)
+            _history.queued(host, names, submitted)
+            states.update(queued)
+
+            names = [name for name in names if name not in queued]
+            if not names:
+                return states
+            call = "sacct -n -o JobName,State -X -P"
+            start_time = _history.start_time(host, names)
+            if start_time:
+                call += " -S " + start_time
+            call = ' && '.join(self._build_lookup_calls(call, names, job_ids))
+            with client.stream_shell_command(call, workdir=workdir) as output:
+                finished = self._parse_states(output, logger)
+                exit_code = output.exit_code
+
+        if exit_code != 0:
             logger.warning("Failed to get states")
+            return states
 
+        _history.finish(host, finished, job_ids)
+        states.update(finished)
         return states
 
+    @staticmethod
+    def _build_lookup_calls(call, names, job_ids):
+        """ Calls looking for the jobs by id when known, by name if not """
+        calls = []
+        ids = [job_ids[name] for name in names if name in job_ids]
+        if ids:
+            calls.append(call + " -j " + ','.join(ids))
+        names = [name for name in names if name not in job_ids]
+        if names:
+            calls.append(call + " --name=" + ','.join(names))
+        return calls
+
+    def _parse_squeue(self, raw_states):
+        """ Parse three columns squeue entries (text or lines) into a dict
+        of states and a dict of submission times """
+        if isinstance(raw_states, basestring):
+            raw_states = raw_states.splitlines()
+        states = {}
+        submitted = {}
+        for job in raw_states:
+            columns = job.strip().split('|')
+            if len(columns) != 3:
+                continue
+            name, state, submit_time = columns
+            if name in states:
+                states[name] = get_prevailing_state(states[name], state)
+                submitted[name] = min(submitted[name], submit_time)
+            else:
+                states[name] = state
+                submitted[name] = submit_time
+        return states, submitted
+
     def _parse_states(self, raw_states, logger):
-        """ Parse two colums sacct entries into a dict """
-        jobs = raw_states.splitlines()
+        """ Parse two colums sacct entries (text or lines) into a dict """
+        if isinstance(raw_states, basestring):
+            raw_states = raw_states.splitlines()
         parsed = {}
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            for job in jobs:
+        for job in raw_states:
+            if job.strip():
                 first, second = job.strip().split('|')
+                # cancelled jobs are reported as "CANCELLED by <uid>"
+                second = second.split(' ')[0]
                 if first in parsed:
                     parsed[first] = get_prevailing_state(parsed[first], second)
                 else:
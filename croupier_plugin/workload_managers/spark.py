@@ -27,7 +27,8 @@ import json
 # from time import gmtime, strftime
 from inspect import currentframe, getframeinfo
 from paramiko import AuthenticationException
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.metrics import instrumented
+from croupier_plugin.ssh import SshConnectionPool
 from croupier_plugin.workload_managers.workload_manager import (
     WorkloadManager,
     get_prevailing_state)
@@ -186,7 +187,9 @@ class Spark(WorkloadManager):
         return _settings
 
 # monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    @instrumented
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None):
         states = {}
         frameinfo = getframeinfo(currentframe())
         logger.debug("{2}: {0} - {1}".format(frameinfo.filename,
@@ -197,8 +200,9 @@ class Spark(WorkloadManager):
 
         for i in range(5):
             try:
-                client = SshClient(credentials)
+                client = SshConnectionPool().acquire(credentials)
                 user = client._user
+                break
             except AuthenticationException as ae:
                 logger.debug(ae)
                 import time
@@ -210,20 +214,23 @@ class Spark(WorkloadManager):
                                                           user,
                                                           frameinfo.function))
 
-        output, exit_code = client.execute_shell_command(call_format,
-                                                         workdir=workdir,
-                                                         wait_result=True)
-        if exit_code == 0:
-            json_output = json.loads(output)
-            states = self._parse_frameworks_states(json_output,
-                                                   job_names[0], logger)
-        else:
-            logger.warning("failed to get states from {0}".format(
-                call_format))
+        try:
+            output, exit_code = client.execute_shell_command(
+                call_format,
+                workdir=workdir,
+                wait_result=True)
+            if exit_code == 0:
+                json_output = json.loads(output)
+                states = self._parse_frameworks_states(json_output,
+                                                       job_names[0], logger)
+            else:
+                logger.warning("failed to get states from {0}".format(
+                    call_format))
+        finally:
+            SshConnectionPool().release(client)
 
         logger.debug("{0}: job_state:{1}".format(frameinfo.function,
                                                  states))
-        client.close_connection()
         return states
 
     def _parse_frameworks_states(self, frameworks_json, job_name, logger):
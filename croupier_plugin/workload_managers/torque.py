@@ -25,13 +25,20 @@ torque.py
 '''
 
 
-from croupier_plugin.ssh import SshClient
+import re
+
+from croupier_plugin.metrics import instrumented
+from croupier_plugin.ssh import SshConnectionPool
 from workload_manager import WorkloadManager
 from croupier_plugin.utilities import shlex_quote
 
+_QSUB_JOB_ID = re.compile(r"^\d+(\[\d*\])?(\.\S+)?$")
+
 
 class Torque(WorkloadManager):
     """ Holds the Torque functions. Acts similarly to the class `Slurm`."""
+    _job_id_variable = 'PBS_JOBID'
+    completion_records = True
 
     def _build_container_script(self, name, job_settings, logger):
         """ Check input information correctness """
@@ -206,19 +213,42 @@ class Torque(WorkloadManager):
         response['call'] = torque_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def get_walltime(self, max_time):
+        """ Seconds of a Torque walltime, "[[hours:]minutes:]seconds" """
+        try:
+            seconds = 0
+            for part in str(max_time).strip().split(':'):
+                seconds = seconds * 60 + int(part)
+            return seconds
+        except ValueError:
+            return None
+
+    def _build_job_cancellation_call(self, name, job_settings, logger,
+                                     job_id=None):
+        if job_id:
+            return "qdel " + job_id
         return r"qselect -N {} | xargs qdel".format(shlex_quote(name))
 
+    def _parse_job_id(self, output):
+        """ Job ids printed by `qsub`, as "id[.server]" lines """
+        job_ids = [line.strip() for line in output.splitlines()
+                   if _QSUB_JOB_ID.match(line.strip())]
+        return ' '.join(job_ids) if job_ids else None
+
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    @instrumented
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None):
         return self._get_states_detailed(
             workdir,
             credentials,
             job_names,
-            logger) if len(job_names) > 0 else {}
+            logger,
+            job_ids=job_ids) if len(job_names) > 0 else {}
 
     @staticmethod
-    def _get_states_detailed(workdir, credentials, job_names, logger):
+    def _get_states_detailed(workdir, credentials, job_names, logger,
+                             job_ids=None):
         """
         Get job states by job names
 
@@ -231,42 +261,45 @@ class Torque(WorkloadManager):
         It allows to a precise mapping of Torque states to
         Slurm states by taking into account `exit_code`.
         Unlike `get_states_tabular` it parses output on host
-        and uses several SSH commands.
+        and uses several SSH commands. Jobs whose ids are known are not
+        looked up with `qselect`.
         """
-        # identify job ids
-        call = "echo {} | xargs -n 1 qselect -N".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        job_ids = Torque._parse_qselect(output)
-        if not job_ids:
-            return {}
-
-        # get detailed information about jobs
-        call = "qstat -f {}".format(' '.join(map(str, job_ids)))
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        client.close_connection()
-        try:
-            job_states = Torque._parse_qstat_detailed(output)
-        except SyntaxError as e:
-            logger.warning(
-                "cannot parse state response for job ids=[{}]".format(
-                    ','.join(map(str, job_ids))))
-            logger.warning(
-                "{err}\n`qstat -f` output to parse:\n\\[\n{text}\n\\]".format(
-                    err=str(e), text=output))
-            # TODO: think whether error ignoring is better
-            #       for the correct lifecycle
-            raise e
+        known_ids = job_ids or {}
+        job_ids = []
+        for name in job_names:
+            if name in known_ids:
+                job_ids += known_ids[name].split()
+        names = [name for name in job_names if name not in known_ids]
+
+        with SshConnectionPool().connection(credentials) as client:
+            if names:
+                # identify job ids
+                call = "echo {} | xargs -n 1 qselect -N".format(
+                    shlex_quote(' '.join(map(shlex_quote, names))))
+                output, exit_code = client.execute_shell_command(
+                    call,
+                    workdir=workdir,
+                    wait_result=True)
+                job_ids += Torque._parse_qselect(output)
+            if not job_ids:
+                return {}
+
+            # get detailed information about jobs
+            call = "qstat -f {}".format(' '.join(map(str, job_ids)))
+
+            with client.stream_shell_command(call, workdir=workdir) as output:
+                try:
+                    job_states = Torque._parse_qstat_detailed(output)
+                except SyntaxError as e:
+                    logger.warning(
+                        "cannot parse state response for job ids=[{}]".format(
+                            ','.join(map(str, job_ids))))
+                    logger.warning(
+                        "{err}\n`qstat -f` stderr:\n{text}".format(
+                            err=str(e), text=output.stderr))
+                    # TODO: think whether error ignoring is better
+                    #       for the correct lifecycle
+                    raise e
 
         return job_states
 
@@ -281,9 +314,11 @@ class Torque(WorkloadManager):
 
     @staticmethod
     def _parse_qstat_detailed(qstat_output):
-        from StringIO import StringIO
+        """ Parse `qstat -f` output, given as text or lines """
+        if isinstance(qstat_output, basestring):
+            qstat_output = qstat_output.splitlines()
         jobs = {}
-        for job in Torque._tokenize_qstat_detailed(StringIO(qstat_output)):
+        for job in Torque._tokenize_qstat_detailed(qstat_output):
             # ignore job['Job_Id'], use identification by name
             name = job.get('Job_Name', '')
             state_code = job.get('job_state', None)
@@ -298,7 +333,7 @@ class Torque(WorkloadManager):
         return jobs
 
     @staticmethod
-    def _tokenize_qstat_detailed(fp):
+    def _tokenize_qstat_detailed(lines):
         import re
         # regexps for tokenization (buiding AST) of `qstat -f` output
         pattern_attribute_first = re.compile(
@@ -310,7 +345,7 @@ class Torque(WorkloadManager):
 
         # tokenizes stream output and
         job_attr_tokens = {}
-        for line_no, line in enumerate(fp.readlines()):
+        for line_no, line in enumerate(lines):
             line = line.rstrip('\n\r')  # strip trailing newline character
             if len(line) > 1:  # skip empty lines
                 # find match for the new attribute
@@ -27,7 +27,10 @@ workload_manager.py
 import string
 import random
 from datetime import datetime
+from paramiko import ssh_exception
+from croupier_plugin.metrics import instrumented
 from croupier_plugin.ssh import SshClient
+from croupier_plugin.utilities import shlex_quote
 
 
 BOOTFAIL = 0
@@ -138,7 +141,22 @@ def get_prevailing_state(state1, state2):
     return state1
 
 
+# file of the workdir where the jobs append their completion records
+COMPLETION_FILE = '.croupier_events'
+
+# line of the job scripts after which croupier adds its variables
+_DYNAMIC_VARIABLES = '# DYNAMIC VARIABLES'
+
+
 class WorkloadManager(object):
+    # environment variable with the job id, inside the jobs
+    _job_id_variable = None
+    # True if the states are read from the workdir, so each one only knows
+    # the jobs that run in it
+    workdir_states = False
+    # True if the jobs can append their completion record to a file of the
+    # workdir when they end
+    completion_records = False
 
     @staticmethod
     def factory(workload_manager):
@@ -157,6 +175,7 @@ class WorkloadManager(object):
         else:
             return None
 
+    @instrumented
     def submit_job(self,
                    ssh_client,
                    name,
@@ -164,7 +183,8 @@ class WorkloadManager(object):
                    is_singularity,
                    logger,
                    workdir=None,
-                   context=None):
+                   context=None,
+                   completion_file=None):
         """
         Sends a job to the HPC
 
@@ -183,11 +203,21 @@ class WorkloadManager(object):
         @rtype string
         @param context: Dictionary containing context env vars
         @rtype dictionary of strings
-        @return Slurm's job name sent. None if an error arise.
+        @param completion_file: Path of the file where the job appends its
+            completion record when it ends, if any
+        @rtype string
+        @return the job id given by the workload manager, True if it does
+            not give any. False if an error arise.
         """
         if not SshClient.check_ssh_client(ssh_client, logger):
             return False
 
+        # job arrays end task by task, so they are only polled
+        record = None
+        if completion_file and self.completion_records and \
+                int(job_settings.get('scale', 1)) <= 1:
+            record = self._build_completion_record(name, completion_file)
+
         if is_singularity:
             # generate script content for singularity
             script_content = self._build_container_script(name,
@@ -195,6 +225,12 @@ class WorkloadManager(object):
                                                           logger)
             if script_content is None:
                 return False
+            if record:
+                script_content = script_content.replace(
+                    _DYNAMIC_VARIABLES + '\n',
+                    _DYNAMIC_VARIABLES + '\n' + self._build_exit_trap(record) +
+                    '\n',
+                    1)
 
             if not self._create_shell_script(ssh_client,
                                              name + ".script",
@@ -216,6 +252,8 @@ class WorkloadManager(object):
                         job_settings['scale_max_in_parallel']
         else:
             settings = job_settings
+            if record:
+                settings = dict(job_settings, completion_record=record)
 
         # build the call to submit the job
         response = self._build_job_submission_call(name,
@@ -228,23 +266,37 @@ class WorkloadManager(object):
                 response['error'])
             return False
 
-        # prepare the scale env variables
+        # batch scripts report their completion with an exit trap
+        mapping_calls = []
         if 'scale_env_mapping_call' in response:
-            scale_env_mapping_call = response['scale_env_mapping_call']
-            output, exit_code = ssh_client.execute_shell_command(
-                scale_env_mapping_call,
-                workdir=workdir,
-                wait_result=True)
-            if exit_code != 0:
-                logger.error("Scale env vars mapping '" +
-                             scale_env_mapping_call +
-                             "' failed with code " +
-                             str(exit_code) + ":\n" + output)
-                return False
+            mapping_calls.append(response['scale_env_mapping_call'])
+        if record and not is_singularity and settings['type'] == 'SBATCH':
+            mapping_calls.append(self._build_exit_trap_call(
+                record,
+                settings['command'].split()[0]))  # file only
 
-        # submit the job
+        # prepare the script variables and submit the job
         call = response['call']
-        if (settings['type'] == 'SPARK'):
+        output = ''
+        if mapping_calls:
+            # every call is sent in one round trip
+            results = ssh_client.execute_batch(mapping_calls + [call],
+                                               env=context,
+                                               workdir=workdir,
+                                               stop_on_error=True)
+            for mapping_call, (output, error, exit_code) in \
+                    zip(mapping_calls, results):
+                if exit_code != 0:
+                    logger.error("Script variables mapping '" +
+                                 mapping_call +
+                                 "' failed with code " +
+                                 str(exit_code) + ":\n" + str(output) +
+                                 str(error))
+                    return False
+            output, error, exit_code = results[-1]
+            if exit_code != 0:
+                output = str(output) + str(error)
+        elif (settings['type'] == 'SPARK'):
             exit_code = ssh_client.execute_shell_command(
                 call,
                 env=context,
@@ -278,8 +330,9 @@ class WorkloadManager(object):
             # Parse output to get the framework ID
         #    framework_id = _parse_spark_output(output)
             # Store framework_id in each executables
-        return True
+        return self._parse_job_id(output) or True
 
+    @instrumented
     def clean_job_aux_files(self,
                             ssh_client,
                             name,
@@ -310,13 +363,15 @@ class WorkloadManager(object):
                 workdir=workdir)
         return True
 
+    @instrumented
     def stop_job(self,
                  ssh_client,
                  name,
                  job_options,
                  is_singularity,
                  logger,
-                 workdir=None):
+                 workdir=None,
+                 job_id=None):
         """
         Stops a job from the HPC
 
@@ -328,6 +383,8 @@ class WorkloadManager(object):
         @param job_settings: dictionary with the job options
         @type is_singularity: bool
         @param is_singularity: True if the job is in a container
+        @type job_id: string
+        @param job_id: id given to the job when it was submitted, if any
         @rtype string
         @return Slurm's job name stopped. None if an error arise.
         """
@@ -339,7 +396,8 @@ class WorkloadManager(object):
                                                      logger)
         else:
             call = self._build_job_cancellation_call(name, job_options,
-                                                     logger)
+                                                     logger,
+                                                     job_id=job_id)
         if call is None:
             return False
 
@@ -349,21 +407,32 @@ class WorkloadManager(object):
             call,
             workdir=workdir)
 
+    @instrumented
     def create_new_workdir(self, ssh_client, base_dir, base_name, logger):
+        """ Creates a new directory in the base dir, returning its absolute
+        path so it can be used where the shell does not expand the base dir,
+        like `$HOME` """
         workdir = self._get_time_name(base_name)
 
         # we make sure that the workdir does not exists
         base_name = workdir
-        while self._exists_path(ssh_client, base_dir + "/" + workdir):
-            workdir = self._get_random_name(base_name)
-
         full_path = base_dir + "/" + workdir
-        if ssh_client.execute_shell_command(
-                "mkdir -p " + base_dir + "/" + workdir):
-            return full_path
-        else:
-            logger.warning("Failed to create '" + base_dir +
-                           "/" + workdir + "' directory.")
+        while True:
+            # probe and create the directory in one round trip
+            results = ssh_client.execute_batch(
+                ['[ ! -d "' + full_path + '" ]',
+                 "mkdir -p " + full_path + " && cd " + full_path + " && pwd"],
+                stop_on_error=True)
+            if results[0][2] != 0 and results[0][2] is not None:
+                # already exists
+                workdir = self._get_random_name(base_name)
+                full_path = base_dir + "/" + workdir
+                continue
+            if results[1][2] == 0:
+                return results[1][0].strip() or full_path
+
+            logger.warning("Failed to create '" + full_path +
+                           "' directory.")
             return None
 
 #   ################ ABSTRACT METHODS ################
@@ -407,7 +476,8 @@ class WorkloadManager(object):
     def _build_job_cancellation_call(self,
                                      name,
                                      job_settings,
-                                     logger):
+                                     logger,
+                                     job_id=None):
         """
         Generates cancel command line as a string
 
@@ -415,6 +485,8 @@ class WorkloadManager(object):
         @param name: name of the job
         @type job_settings: dictionary
         @param job_settings: dictionary with the job options
+        @type job_id: string
+        @param job_id: id given to the job when it was submitted, if any
         @rtype string
         @return string to call slurm with its parameters.
             None if an error arise.
@@ -422,15 +494,71 @@ class WorkloadManager(object):
         raise NotImplementedError(
             "'_build_job_cancellation_call' not implemented.")
 
+    def _build_completion_record(self, name, completion_file):
+        """
+        Shell command appending the completion record of the job to the
+        file, as "name|job id|exit code|timestamp". The exit code is the one
+        of the last command run.
+        """
+        job_id = '${' + self._job_id_variable + '}' \
+            if self._job_id_variable else ''
+        return 'echo "{0}|{1}|$?|$(date +%s)" >> {2}'.format(
+            name, job_id, shlex_quote(completion_file))
+
+    @staticmethod
+    def _build_exit_trap(record):
+        """ Script line running the record when the script exits """
+        return "trap '" + record + "' EXIT"
+
+    def _build_exit_trap_call(self, record, script):
+        """ Call adding the exit trap to a job script, replacing the one
+        of a previous submission. It fails if the trap is not added, as
+        in scripts without the dynamic variables mark. """
+        trap = self._build_exit_trap(record)
+        return ("sed -i -e {0} -e {1} {2} && "
+                "{{ grep -q -x -F -e {3} {2} || "
+                "{{ echo {4} >&2; exit 1; }}; }}").format(
+            shlex_quote('/^trap .*' + COMPLETION_FILE.replace('.', '\\.') +
+                        '.* EXIT$/d'),
+            shlex_quote('/' + _DYNAMIC_VARIABLES + '/a\\' + trap),
+            script,
+            shlex_quote(trap),
+            shlex_quote("No '" + _DYNAMIC_VARIABLES + "' line in " +
+                        script + " to add the completion trap after"))
+
+    @staticmethod
+    def _quote_in_double_quotes(text):
+        """ Escapes the text to be used literally inside double quotes """
+        for char in ('\\', '"', '$', '`'):
+            text = text.replace(char, '\\' + char)
+        return text
+
+    def _parse_job_id(self, output):
+        """
+        Gets the job id from the output of the submission call
+
+        @type output: string
+        @param output: output of the submission call
+        @rtype string
+        @return the job id. None if the workload manager does not give one.
+        """
+        return None
+
     # Monitor
-    def get_states(self, ssh_client, names, logger):
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None):
         """
         Get the states of the jobs names
 
+        @type workdir: string
+        @param workdir: path of the working directory of the jobs
         @type credentials: dictionary
         @param credentials: dictionary with the HPC SSH credentials
-        @type names: list
-        @param names: list of the job names to retrieve their states
+        @type job_names: list
+        @param job_names: list of the job names to retrieve their states
+        @type job_ids: dictionary
+        @param job_ids: ids given to the jobs when they were submitted, by
+            job name. Jobs without id are looked up by name.
         @rtype dict
         @return a dictionary of job names and its states
         """
@@ -443,30 +571,46 @@ class WorkloadManager(object):
                              script_content,
                              logger,
                              workdir=None):
-        # @TODO: why not to use ctx.download_resource and
-        #        ssh_client.open_sftp().put(...)?
-        # escape for echo command
-        script_data = script_content \
-            .replace("\\", "\\\\") \
-            .replace("$", "\\$") \
-            .replace("`", "\\`") \
-            .replace('"', '\\"')
-
-        create_call = "echo \"" + script_data + "\" >> " + name + \
-            "; chmod +x " + name
-        _, exit_code = ssh_client.execute_shell_command(
-            create_call,
-            workdir=workdir,
-            wait_result=True)
-
-        if exit_code != 0:
+        try:
+            ssh_client.put_file(script_content,
+                                name,
+                                mode=0o755,
+                                workdir=workdir)
+        except (IOError, OSError, ssh_exception.SSHException) as err:
             logger.error(
-                "failed to create script: call '" + create_call +
-                "', exit code " + str(exit_code))
+                "failed to create script '" + name + "': " + str(err))
             return False
 
         return True
 
+    def get_walltime(self, max_time):
+        """
+        Seconds of a job time limit, in Slurm format: "minutes",
+        "minutes:seconds", "hours:minutes:seconds", "days-hours",
+        "days-hours:minutes" or "days-hours:minutes:seconds"
+
+        @rtype int
+        @return seconds of the limit. None if it cannot be parsed.
+        """
+        try:
+            days = 0
+            max_time = str(max_time).strip()
+            if '-' in max_time:
+                days, max_time = max_time.split('-', 1)
+                parts = [int(part) for part in max_time.split(':')]
+                parts += [0] * (3 - len(parts))
+                hours, minutes, seconds = parts
+            else:
+                parts = [int(part) for part in max_time.split(':')]
+                if len(parts) == 3:
+                    hours, minutes, seconds = parts
+                else:
+                    hours = 0
+                    minutes, seconds = (parts + [0])[:2]
+            return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+        except ValueError:
+            return None
+
     def _get_random_name(self, base_name):
         """ Get a random name with a prefix """
         return base_name + '_' + self.__id_generator()
@@ -480,13 +624,3 @@ class WorkloadManager(object):
                        chars=string.digits + string.ascii_letters):
         return ''.join(random.SystemRandom().choice(chars)
                        for _ in range(size))
-
-    def _exists_path(self, ssh_client, path):
-        _, exit_code = ssh_client.execute_shell_command(
-            '[ -d "' + path + '" ]',
-            wait_result=True)
-
-        if exit_code == 0:
-            return True
-        else:
-            return False